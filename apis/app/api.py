@@ -2,27 +2,41 @@
 API controllers
 """
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.exception_handlers import request_validation_exception_handler
 from fastapi.middleware.cors import CORSMiddleware
-from botocore.exceptions import ClientError
 
 from . import logger
-from .util import http_response
+from .util import http_response, APIResponse
+from .startup import lifespan
+from .metrics import MetricsMiddleware, render
+from .request_stats import RequestStatsMiddleware
 from .user import get_user, \
                 create_new_user, \
                 set_user_role, \
                 update_timestamp, \
                 update_user_password, \
                 validate_auth_key, \
-                compare_to_hash, \
-                is_valid_user, \
-                is_valid_password
+                verify_password, \
+                rehash_password, \
+                HashingOverloaded, \
+                user_unit_of_work
 
 from .registration import validate_access_key, \
                         send_reset_password_email, \
                         send_registration_email
 
-from .session import new_session, validate_session_key, invalidate_session
+from .rate_limit import reserve_login_attempt, \
+                        release_login_attempt, \
+                        TooManyAttempts
+
+from .session import new_session, validate_session_key, invalidate_session, revoke_user_sessions
+from .storage import storage
+from .rollups import get_user_rollup
+from .queries import log_queries, query_history, QueryLogFull
+from .flags import flag_document, flag_queue, resolve_flags, is_moderator
 
 from .models import LoggedInUser, \
                 EmailConfirmation, \
@@ -31,7 +45,13 @@ from .models import LoggedInUser, \
                 SetNewPassword, \
                 NewUser, \
                 ExistingUser, \
-                AuthenticatingUser
+                AuthenticatingUser, \
+                QueryLog, \
+                QueryHistory, \
+                FlagDocument, \
+                FlagQueue, \
+                ResolveFlags, \
+                CREDENTIAL_FIELDS
 
 origins = [
     "http://localhost",
@@ -40,25 +60,85 @@ origins = [
     "http://local.host:3000"
 ]
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=APIResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=['GET', 'POST', 'OPTIONS', 'HEAD']
 )
+app.add_middleware(RequestStatsMiddleware)
+# Outermost, so it times everything including CORS
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(HashingOverloaded)
+async def hashing_overloaded(request: Request, err: HashingOverloaded):
+    """Shed load when password hashing is saturated"""
+    logger.warning('Password hashing overloaded on %s', request.url.path)
+    return JSONResponse(status_code=503, content={"detail": "Server busy"}, headers={"Retry-After": "1"})
+
+@app.exception_handler(QueryLogFull)
+async def query_log_full(request: Request, err: QueryLogFull):
+    """Push back on query logging while the buffer is full"""
+    logger.warning('Query log buffer full on %s', request.url.path)
+    return JSONResponse(status_code=503, content={"detail": "Server busy"}, headers={"Retry-After": "1"})
+
+@app.exception_handler(TooManyAttempts)
+async def too_many_attempts(request: Request, err: TooManyAttempts):
+    """Reject logins from locked out users and clients"""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Too many failed attempts"},
+        headers={"Retry-After": str(max(1, round(err.retry_after)))}
+    )
+
+def client_ip(request: Request):
+    """The address the request came from, if known"""
+    return request.client.host if request and request.client else None
+
+@app.exception_handler(RequestValidationError)
+async def invalid_request(request: Request, err: RequestValidationError):
+    """Reject malformed credentials the frontend would never have sent"""
+    if any(error['type'] != 'missing' and error['loc'][-1] in CREDENTIAL_FIELDS
+           for error in err.errors()):
+        logger.error('Request to %s attempted to bypass frontend security.', request.url.path)
+        return JSONResponse(status_code=403, content={"detail": "Forbidden"})
+    return await request_validation_exception_handler(request, err)
 
 @app.get('/')
 async def home():
     """Default route """
     return {"test": "success"}
 
+@app.get('/metrics')
+async def metrics():
+    """Prometheus metrics"""
+    body, content_type = render()
+    return Response(body, media_type=content_type)
+
+@app.post('/stats/users')
+async def user_stats(user: AuthenticatingUser):
+    """User counts from the last rollup, never a scan of the Users table, for moderators (POST)"""
+    username = user.username
+    if await validate_session_key(user.authKey) != username:
+        return http_response(401, {"message": "Invalid session."})
+    if not await is_moderator(username):
+        return http_response(403, {"message": "Forbidden"})
+
+    rollup = await get_user_rollup()
+    if not rollup:
+        return http_response(404, {"message": "No rollup computed yet"})
+    return http_response(200, {
+        key: value for key, value in rollup.items() if key != 'RollupId'
+    })
+
 # Handler methods
 @app.post("/confirm_email", response_model=LoggedInUser)
+@user_unit_of_work
 async def confirm_email(user: EmailConfirmation):
     """Confirm registration email endpoint (GET)"""
     access_key = user.accessKey
-    username = validate_access_key(access_key)
+    username = await validate_access_key(access_key)
     if username:
         await set_user_role(username, 'viewer')
         session_key = await new_session(username)
@@ -79,32 +159,33 @@ async def reset_password(user: ResetPassword):
     """Allow user to reset their password (POST)"""
     username = user.username
     # send reset password link in an email
-    if send_reset_password_email(username):
+    if await send_reset_password_email(username):
         return http_response(200, { "message": "Password reset email sent." })
     return http_response(500, {"message": 'Server error'})
 
 @app.post("/update_password", response_model=LoggedInUser)
-async def update_password(user: UpdatePassword):
+@user_unit_of_work
+async def update_password(user: UpdatePassword, request: Request = None):
     """Allow user to change their password (POST)"""
     username = user.username
     password = user.password
     new_password = user.newPassword
+    ip = client_ip(request)
 
-    # validate data
-    if not is_valid_user(username) or \
-       not is_valid_password(password) or \
-       not is_valid_password(new_password):
-        logger.error('User %s attempted to bypass frontend security.', username)
-        return http_response(403, {"message": 'Forbidden'})
+    # count the attempt before reading the user or hashing, so concurrent
+    # attempts can't all get past the lockout while the first is verified
+    attempt = await reserve_login_attempt(username, ip)
 
     # validate user and password
-    pw_hash = get_user(username).get('Password')
-    if not compare_to_hash(password, pw_hash):
+    pw_hash = (await get_user(username)).get('Password')
+    if not await verify_password(password, pw_hash):
         return http_response(401, {"message": "Incorrect Password"})
-    
+    await release_login_attempt(attempt, reset=True)
+
     await update_user_password(username, new_password)
+    await revoke_user_sessions(username)
 
-    _user = get_user(username)
+    _user = await get_user(username)
 
     payload = {
         "username": username,
@@ -118,24 +199,20 @@ async def update_password(user: UpdatePassword):
     return http_response(200, payload)
 
 @app.post("/set_new_password", response_model=LoggedInUser)
+@user_unit_of_work
 async def set_new_password(user: SetNewPassword):
     """Allow user to change their password (POST)"""
     username = user.username
     access_key = user.accessKey
     password = user.password
 
-    # validate data
-    if not is_valid_user(username) or \
-       not is_valid_password(password):
-        logger.error('User %s attempted to bypass frontend security.', username)
-        return http_response(403, {"message": 'Forbidden'})
-
     # validate user
-    if not username == validate_access_key(access_key):
+    if not username == await validate_access_key(access_key):
         return http_response(401, {"message": "Invalid access key."})
     
     await update_user_password(username, password)
-    _user = get_user(username)
+    await revoke_user_sessions(username)
+    _user = await get_user(username)
     payload = {
         "username": username,
         "role": _user.get('AuthRole', ''),
@@ -148,24 +225,20 @@ async def set_new_password(user: SetNewPassword):
     return http_response(200, payload)
 
 @app.post("/register")
+@user_unit_of_work
 async def register(new_user: NewUser):
     """Allow the user to register via (POST)"""
     username = new_user.username
     password = new_user.password
-    # validate / scrub data
-    if not is_valid_user(username) or not is_valid_password(password):
-        logger.error('User %s attempted to bypass frontend security.', username)
-        return http_response(403, {"message": 'Forbidden'})
-
     # check for existing records
-    if username == get_user(username).get('UserName'):
+    if username == (await get_user(username)).get('UserName'):
         return http_response(409, {"message": 'Username taken'})
 
     # write to DB
     try:
-        create_new_user(username, password)
-        send_registration_email(username)
-    except ClientError as err:
+        await create_new_user(username, password)
+        await send_registration_email(username)
+    except storage.errors as err:
         logger.error('Error registering user %s: %s', username, err)
         return http_response(500, {"message": 'Server error'})
 
@@ -173,32 +246,39 @@ async def register(new_user: NewUser):
     return http_response(201, {"message": "Registration success"})
 
 @app.post("/login", response_model=LoggedInUser)
-async def login(user: ExistingUser):
+@user_unit_of_work
+async def login(user: ExistingUser, request: Request = None):
     """Allow the user to login (POST)"""
     username = user.username
     password = user.password
-    # validate / scrub data
-    if not is_valid_user(username) or not is_valid_password(password):
-        logger.error('User %s attempted to bypass frontend security.', username)
-        return http_response(403, {"message": 'Forbidden'})
+    ip = client_ip(request)
 
-    user = get_user(username)
+    # count the attempt before reading the user or hashing, so concurrent
+    # attempts can't all get past the lockout while the first is verified
+    attempt = await reserve_login_attempt(username, ip)
+
+    user = await get_user(username)
     pw_hash = user.get('Password')
 
-    auth_key = validate_auth_key(username)
+    auth_key = await validate_auth_key(username)
 
     if not auth_key:
+        if user:
+            # Only guessing at usernames counts against the client
+            await release_login_attempt(attempt)
         # The user hasn't validated their email yet
         return http_response(401, {"message": 'Please validate your email address.'})
 
-    if not compare_to_hash(password, pw_hash):
-        # log pw attempts and lock account for 10 min if failed more than 5 times
+    if not await verify_password(password, pw_hash):
+        # the username and client are locked out after too many failures
         logger.warning('Faild password attempt by %s', username)
         return http_response(401, {"message": "Invalid username or password attempt."})
+    await release_login_attempt(attempt, reset=True)
 
     try:
-        update_timestamp(username)
-    except ClientError as err:
+        await rehash_password(username, password, pw_hash)
+        await update_timestamp(username)
+    except storage.errors as err:
         logger.warning('Error updating user %s: %s', username, err)
         return http_response(500, {"message": 'Server Error'})
     
@@ -214,12 +294,13 @@ async def login(user: ExistingUser):
     return http_response(200, payload)
 
 @app.post("/logout")
+@user_unit_of_work
 async def logout(user: AuthenticatingUser):
     """Allow the user to logout (POST)"""
     username = user.username
     session_key = user.authKey
-    if validate_auth_key(username) and validate_session_key(session_key):
-        invalidate_session(session_key)
+    if await validate_session_key(session_key) == username:
+        await invalidate_session(session_key)
 
     payload = {
         "username": username,
@@ -228,3 +309,116 @@ async def logout(user: AuthenticatingUser):
     }
 
     return http_response(200, payload)
+
+@app.post("/logout_all")
+@user_unit_of_work
+async def logout_all(user: AuthenticatingUser):
+    """Allow the user to logout of every session (POST)"""
+    username = user.username
+    if await validate_session_key(user.authKey) != username:
+        return http_response(401, {"message": "Invalid session."})
+
+    count = await revoke_user_sessions(username)
+
+    payload = {
+        "username": username,
+        "authKey": "",
+        "sessions": count,
+        "message": "Logged out everywhere"
+    }
+
+    return http_response(200, payload)
+
+@app.post("/queries", status_code=202)
+async def save_queries(log: QueryLog):
+    """Log one or more of the user's queries, written in the background (POST)"""
+    username = log.username
+    if await validate_session_key(log.authKey) != username:
+        return http_response(401, {"message": "Invalid session."})
+
+    query_ids = await log_queries(username, log.queries)
+
+    # QueryIds don't fit in a JavaScript number, so they are sent as strings
+    return http_response(202, {
+        "queryIds": [str(query_id) for query_id in query_ids],
+        "message": "Queries accepted"
+    })
+
+@app.post("/queries/history")
+async def get_query_history(history: QueryHistory):
+    """A page of the user's queries, newest first (POST)"""
+    username = history.username
+    if await validate_session_key(history.authKey) != username:
+        return http_response(401, {"message": "Invalid session."})
+
+    try:
+        queries, cursor = await query_history(username, history.limit, history.cursor)
+    except ValueError:
+        return http_response(400, {"message": "Invalid cursor."})
+
+    return http_response(200, {
+        "queries": [{
+            "queryId": str(query["QueryId"]),
+            "query": query.get("Query", ""),
+            "response": query.get("Response"),
+            "createdAt": int(query["CreatedAt"])
+        } for query in queries],
+        "cursor": cursor
+    })
+
+def flag_response(flag: dict) -> dict:
+    """A flag as sent to clients"""
+    return {
+        "flaggedId": str(flag["FlaggedId"]),
+        "documentId": flag.get("DocumentId", ""),
+        "reason": flag.get("Reason"),
+        "flagCount": int(flag.get("FlagCount", 0)),
+        "firstFlaggedAt": int(flag.get("FirstFlaggedAt", 0)),
+        "lastFlaggedAt": int(flag["LastFlaggedAt"])
+    }
+
+@app.post("/flags")
+async def flag_doc(document: FlagDocument):
+    """Flag a document for moderation, repeated flags are counted on one item (POST)"""
+    username = document.username
+    if await validate_session_key(document.authKey) != username:
+        return http_response(401, {"message": "Invalid session."})
+
+    flagged = await flag_document(username, document.documentId, document.reason)
+
+    return http_response(200, {**flag_response(flagged), "message": "Document flagged"})
+
+@app.post("/flags/queue")
+async def get_flag_queue(queue: FlagQueue):
+    """A page of flags, most recently flagged first, for moderators (POST)"""
+    username = queue.username
+    if await validate_session_key(queue.authKey) != username:
+        return http_response(401, {"message": "Invalid session."})
+    if not await is_moderator(username):
+        return http_response(403, {"message": "Forbidden"})
+
+    try:
+        flags, cursor = await flag_queue(queue.status, queue.limit, queue.cursor)
+    except ValueError:
+        return http_response(400, {"message": "Invalid cursor."})
+
+    return http_response(200, {
+        "flags": [flag_response(flag) for flag in flags],
+        "cursor": cursor
+    })
+
+@app.post("/flags/resolve")
+async def resolve(resolution: ResolveFlags):
+    """Resolve open flags in bulk, for moderators (POST)"""
+    username = resolution.username
+    if await validate_session_key(resolution.authKey) != username:
+        return http_response(401, {"message": "Invalid session."})
+    if not await is_moderator(username):
+        return http_response(403, {"message": "Forbidden"})
+
+    resolved = await resolve_flags(username, resolution.flaggedIds)
+
+    return http_response(200, {
+        "resolved": [str(flagged_id) for flagged_id in resolved],
+        "message": "Flags resolved"
+    })
@@ -0,0 +1,114 @@
+"""
+Async access to DynamoDB tables
+"""
+
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+from .dynamodb_tables import get_resource
+
+# boto3 is blocking, so calls are run on a bounded pool of worker threads
+# sized to match the botocore connection pool in dynamodb_tables.
+MAX_WORKERS = getattr(config, 'DYNAMODB_MAX_WORKERS', 32)
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='dynamodb')
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking call on the DynamoDB executor without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    # Copy the context so context variables are visible in the worker thread
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await loop.run_in_executor(_executor, call)
+
+class AsyncTable:
+    """
+    Awaitable wrapper around a boto3 Table, or a function returning one on
+    first use. The function may create the table and wait for it, so it is
+    called on the executor by the first call made through the wrapper.
+    """
+
+    def __init__(self, table):
+        self._factory = table if callable(table) else None
+        self._table = None if callable(table) else table
+        self._lock = threading.Lock()
+
+    @property
+    def table(self):
+        """The wrapped boto3 Table, blocks until it is ready on first use"""
+        if self._table is None:
+            with self._lock:
+                if self._table is None:
+                    self._table = self._factory()
+        return self._table
+
+    @property
+    def name(self) -> str:
+        """The name of the wrapped table, blocks until it is ready on first use"""
+        return self.table.name
+
+    def _call(self, method: str, **kwargs):
+        return getattr(self.table, method)(**kwargs)
+
+    async def get_item(self, **kwargs) -> dict:
+        """Table.get_item"""
+        return await run_blocking(self._call, 'get_item', **kwargs)
+
+    async def put_item(self, **kwargs) -> dict:
+        """Table.put_item"""
+        return await run_blocking(self._call, 'put_item', **kwargs)
+
+    async def update_item(self, **kwargs) -> dict:
+        """Table.update_item"""
+        return await run_blocking(self._call, 'update_item', **kwargs)
+
+    async def delete_item(self, **kwargs) -> dict:
+        """Table.delete_item"""
+        return await run_blocking(self._call, 'delete_item', **kwargs)
+
+    async def query(self, **kwargs) -> dict:
+        """Table.query"""
+        return await run_blocking(self._call, 'query', **kwargs)
+
+    async def scan(self, **kwargs) -> dict:
+        """Table.scan"""
+        return await run_blocking(self._call, 'scan', **kwargs)
+
+    def _batch_delete(self, keys: list):
+        # batch_writer sends 25 deletes per BatchWriteItem and resends unprocessed ones
+        with self.table.batch_writer() as batch:
+            for key in keys:
+                batch.delete_item(Key=key)
+
+    async def batch_delete(self, keys: list):
+        """Deletes the items with the given keys in batches"""
+        await run_blocking(self._batch_delete, keys)
+
+    def _batch_put(self, items: list):
+        with self.table.batch_writer() as batch:
+            for item in items:
+                batch.put_item(Item=item)
+
+    async def batch_put(self, items: list):
+        """Writes the items in batches"""
+        await run_blocking(self._batch_put, items)
+
+def transact_item(action: str, table: AsyncTable, **params) -> dict:
+    """Builds one TransactWriteItems entry, its table name is looked up by transact_write"""
+    return {action: {"TableName": table, **params}}
+
+def _transact_write(items: list) -> dict:
+    items = [
+        {action: {**params, "TableName": params["TableName"].name}}
+        for item in items for action, params in item.items()
+    ]
+    # The resource's client serializes attribute values like Table methods do
+    return get_resource().meta.client.transact_write_items(TransactItems=items)
+
+async def transact_write(items: list) -> dict:
+    """Writes the items built by transact_item in a single transaction"""
+    return await run_blocking(_transact_write, items)
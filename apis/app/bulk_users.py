@@ -0,0 +1,395 @@
+"""
+Bulk user import and export
+
+Streams users between a JSONL or CSV file and the Users table. Imports
+are written with BatchWriteItem by a pool of workers, which retry
+unprocessed items and slow down together when DynamoDB throttles.
+Exports read the table with a parallel segmented Scan. Both keep a
+bounded number of batches in memory and record their progress in a
+checkpoint file, so an interrupted run continues where it stopped when
+started again with the same arguments.
+
+    cd apis && python -m app.bulk_users import users.jsonl --workers 8
+    cd apis && python -m app.bulk_users export users.csv --segments 8
+
+Imported records are user items as exported, e.g.
+{"UserName": "user@example.com", "Password": "scrypt$...", "AuthRole": "viewer"}.
+Passwords are copied as hashes, records without a valid UserName are
+skipped. Writes are puts, so running an import twice is harmless.
+"""
+
+import os
+import csv
+import json
+import time
+import queue
+import random
+import argparse
+import threading
+import collections
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from botocore.exceptions import ClientError
+
+from . import config
+from . import logger
+from .models import EMAIL_REGEX
+from .metrics import THROTTLE_CODES
+from .dynamodb_tables import get_resource, get_users_table
+
+# BatchWriteItem takes at most 25 items
+BATCH_SIZE = 25
+
+# Columns of CSV exports, JSONL exports keep every attribute
+CSV_FIELDS = ("UserName", "Password", "AuthRole", "Valid", "LastLogin")
+
+# CSV values are strings, these attributes are converted back on import
+CSV_BOOLEANS = {"Valid"}
+
+class BulkError(Exception):
+    """Raised when a batch can't be written or a checkpoint doesn't match the run"""
+
+def file_format(path: str, fmt: str = None) -> str:
+    """The format named, or the one the file extension implies"""
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    if fmt not in ('csv', 'jsonl'):
+        raise BulkError(f'Unknown format {fmt}')
+    return fmt
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def _from_csv(row: dict) -> dict:
+    item = {}
+    for attr, value in row.items():
+        if value in (None, ''):
+            continue
+        item[attr] = value.lower() == 'true' if attr in CSV_BOOLEANS else value
+    return item
+
+def read_records(path: str, fmt: str = None, skip: int = 0):
+    """Yields (record number, item) from a file, starting after skip records"""
+    fmt = file_format(path, fmt)
+    with open(path, newline='', encoding='utf-8') as file:
+        if fmt == 'csv':
+            rows = (_from_csv(row) for row in csv.DictReader(file))
+        else:
+            # Numbers are read as Decimal, which is what DynamoDB takes
+            rows = (json.loads(line, parse_float=Decimal) for line in file if line.strip())
+        for number, item in enumerate(rows, start=1):
+            if number > skip:
+                yield number, item
+
+def batches(records, size: int = BATCH_SIZE):
+    """Groups records into (last record number, items, rejected count) batches"""
+    items = {}
+    rejected = 0
+    number = 0
+    for number, item in records:
+        username = item.get('UserName')
+        if not isinstance(username, str) or not EMAIL_REGEX.match(username):
+            logger.warning('Skipping record %s without a valid UserName', number)
+            rejected += 1
+            continue
+        # A batch can't write the same key twice, the later record wins
+        items[username] = item
+        if len(items) == size:
+            yield number, list(items.values()), rejected
+            items, rejected = {}, 0
+    if items or rejected:
+        yield number, list(items.values()), rejected
+
+class AdaptiveRate:
+    """
+    Items per second shared by the workers, halved when DynamoDB throttles
+    and raised a step after each batch written in full.
+    """
+
+    def __init__(self, rate: float, min_rate: float = BATCH_SIZE, max_rate: float = None):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate or float('inf')
+        self.step = rate / 10
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, count: int):
+        """Waits until count more items can be written"""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + count / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def succeeded(self):
+        """Speeds up after a batch went through"""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.step)
+
+    def throttled(self):
+        """Slows down after DynamoDB refused some of a batch"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+def write_batch(client, table_name: str, items: list, rate: AdaptiveRate,
+                max_attempts: int = 8, base_delay: float = 0.05) -> int:
+    """Writes the items, retrying unprocessed ones with backoff, returns the retries made"""
+    requests = [{"PutRequest": {"Item": item}} for item in items]
+    retries = 0
+    while True:
+        rate.acquire(len(requests))
+        try:
+            response = client.batch_write_item(RequestItems={table_name: requests})
+            requests = response.get('UnprocessedItems', {}).get(table_name, [])
+        except ClientError as err:
+            if err.response['Error']['Code'] not in THROTTLE_CODES:
+                raise
+        if not requests:
+            rate.succeeded()
+            return retries
+        rate.throttled()
+        retries += 1
+        if retries >= max_attempts:
+            raise BulkError(f'{len(requests)} items still unprocessed after {retries} retries')
+        time.sleep(base_delay * 2 ** retries * random.uniform(0.5, 1.0))
+
+class Checkpoint:
+    """Progress of a run, saved as JSON and replaced atomically"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> dict:
+        """The saved progress, or an empty dict for a new run"""
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        with open(self.path, encoding='utf-8') as file:
+            return json.load(file)
+
+    def save(self, state: dict):
+        """Saves the progress"""
+        if not self.path:
+            return
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as file:
+            json.dump(state, file, default=_json_default)
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        """Removes the checkpoint of a finished run"""
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+def import_users(path: str,
+                 table_name: str = config.USERS_TABLE,
+                 workers: int = 4,
+                 fmt: str = None,
+                 checkpoint_path: str = None,
+                 rate: float = 1000.0,
+                 max_rate: float = None) -> dict:
+    """Writes the users in a file to the table, returns counts of what was done"""
+    checkpoint = Checkpoint(checkpoint_path)
+    state = checkpoint.load()
+    if state and state.get('input') != os.path.abspath(path):
+        raise BulkError(f'Checkpoint {checkpoint_path} is for {state.get("input")}')
+    state = state or {"input": os.path.abspath(path), "record": 0, "written": 0, "rejected": 0}
+    if state["record"]:
+        logger.info('Resuming import of %s after record %s', path, state["record"])
+
+    client = get_users_table(table_name).meta.client
+    limiter = AdaptiveRate(rate, max_rate=max_rate)
+    stats = {"written": 0, "rejected": 0, "retries": 0}
+    started = time.monotonic()
+
+    # Batches finish out of order, the checkpoint only moves past a record
+    # once every batch up to it has been written
+    in_flight = {}
+    order = collections.deque()
+    finished = {}
+
+    def finish(last, count, rejected):
+        stats["written"] += count
+        stats["rejected"] += rejected
+        finished[last] = (count, rejected)
+
+    def settle(done):
+        for future in done:
+            last, count, rejected = in_flight.pop(future)
+            stats["retries"] += future.result()
+            finish(last, count, rejected)
+        while order and order[0] in finished:
+            state["record"] = order.popleft()
+            count, rejected = finished.pop(state["record"])
+            state["written"] += count
+            state["rejected"] += rejected
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bulk-import') as pool:
+        try:
+            for last, items, rejected in batches(read_records(path, fmt, skip=state["record"])):
+                order.append(last)
+                if not items:
+                    # Only rejected records, there is nothing to write
+                    finish(last, 0, rejected)
+                    settle(())
+                    continue
+                future = pool.submit(write_batch, client, table_name, items, limiter)
+                in_flight[future] = (last, len(items), rejected)
+                # Bounded, so memory doesn't grow with the file
+                if len(in_flight) >= workers * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    settle(done)
+                    checkpoint.save(state)
+            settle(wait(in_flight)[0])
+        finally:
+            checkpoint.save(state)
+
+    checkpoint.clear()
+    logger.info('Imported %s users from %s in %.1f s (%s skipped, %s retries)',
+                stats["written"], path, time.monotonic() - started,
+                stats["rejected"], stats["retries"])
+    return stats
+
+def _scan_segment(table, segment: int, segments: int, start_key, page_size: int,
+                  pages: queue.Queue, stop: threading.Event):
+    """Puts (segment, items, last key) for each page of a segment, then (segment, None, error)"""
+    def put(page) -> bool:
+        # Gives up once the writer has stopped, rather than block on a full queue
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    scan = {"Segment": segment, "TotalSegments": segments}
+    if page_size:
+        scan["Limit"] = page_size
+    if start_key:
+        scan["ExclusiveStartKey"] = start_key
+    try:
+        while True:
+            response = table.scan(**scan)
+            last_key = response.get('LastEvaluatedKey')
+            if not put((segment, response.get('Items', []), last_key)) or not last_key:
+                break
+            scan["ExclusiveStartKey"] = last_key
+    except Exception as err:  # pylint: disable=broad-except
+        put((segment, None, err))
+    else:
+        put((segment, None, None))
+
+def export_users(path: str,
+                 table_name: str = config.USERS_TABLE,
+                 segments: int = 4,
+                 fmt: str = None,
+                 checkpoint_path: str = None,
+                 page_size: int = None) -> int:
+    """Writes the users in the table to a file, returns how many were written"""
+    fmt = file_format(path, fmt)
+    checkpoint = Checkpoint(checkpoint_path)
+    state = checkpoint.load()
+    if state and (state.get('output') != os.path.abspath(path) or len(state['segments']) != segments):
+        raise BulkError(f'Checkpoint {checkpoint_path} is for another export')
+    state = state or {
+        "output": os.path.abspath(path),
+        "exported": 0,
+        "segments": {str(segment): {"start": None, "done": False} for segment in range(segments)}
+    }
+    resuming = bool(state["exported"]) or any(s["start"] for s in state["segments"].values())
+    if resuming:
+        logger.info('Resuming export to %s after %s users', path, state["exported"])
+
+    table = get_resource().Table(table_name)
+    started = time.monotonic()
+    exported = 0
+    # Each scanner can get a couple of pages ahead of the writer, no more
+    pages = queue.Queue(maxsize=segments * 2)
+    stop = threading.Event()
+    remaining = [int(segment) for segment, progress in state["segments"].items()
+                 if not progress["done"]]
+
+    # Pages are written before the checkpoint moves past them, so an
+    # interrupted export repeats at most the pages that were in flight
+    with open(path, 'a' if resuming else 'w', newline='', encoding='utf-8') as file, \
+         ThreadPoolExecutor(max_workers=max(len(remaining), 1),
+                            thread_name_prefix='bulk-export') as pool:
+        writer = None
+        if fmt == 'csv':
+            writer = csv.DictWriter(file, CSV_FIELDS, extrasaction='ignore')
+            if not resuming:
+                writer.writeheader()
+
+        for segment in remaining:
+            pool.submit(_scan_segment, table, segment, segments,
+                        state["segments"][str(segment)]["start"], page_size, pages, stop)
+
+        errors = []
+        active = len(remaining)
+        try:
+            while active:
+                segment, items, last_key = pages.get()
+                if items is None:
+                    active -= 1
+                    if last_key:
+                        errors.append(last_key)
+                    continue
+                for item in items:
+                    if writer:
+                        writer.writerow(item)
+                    else:
+                        file.write(json.dumps(item, default=_json_default) + '\n')
+                file.flush()
+                exported += len(items)
+                state["exported"] += len(items)
+                state["segments"][str(segment)] = {"start": last_key, "done": last_key is None}
+                checkpoint.save(state)
+        finally:
+            stop.set()
+
+    if errors:
+        raise BulkError(f'{len(errors)} segments failed, rerun to resume: {errors[0]}')
+    checkpoint.clear()
+    logger.info('Exported %s users to %s in %.1f s', exported, path, time.monotonic() - started)
+    return exported
+
+def main():
+    """Runs an import or an export"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    importer = commands.add_parser('import', help='write the users in a file to the table')
+    importer.add_argument('path')
+    importer.add_argument('--workers', type=int, default=4)
+    importer.add_argument('--rate', type=float, default=1000.0,
+                          help='items per second to start at, adjusted to throttling')
+    importer.add_argument('--max-rate', type=float, help='items per second never to exceed')
+
+    exporter = commands.add_parser('export', help='write the users in the table to a file')
+    exporter.add_argument('path')
+    exporter.add_argument('--segments', type=int, default=4, help='parallel scan segments')
+    exporter.add_argument('--page-size', type=int, help='items per Scan call')
+
+    for command in (importer, exporter):
+        command.add_argument('--table', default=config.USERS_TABLE)
+        command.add_argument('--format', choices=('jsonl', 'csv'),
+                             help='defaults to the file extension')
+        command.add_argument('--checkpoint',
+                             help='progress file, defaults to <path>.checkpoint')
+
+    args = parser.parse_args()
+    checkpoint_path = args.checkpoint or f'{args.path}.checkpoint'
+    if args.command == 'import':
+        import_users(args.path, args.table, args.workers, args.format, checkpoint_path,
+                     args.rate, args.max_rate)
+    else:
+        export_users(args.path, args.table, args.segments, args.format, checkpoint_path,
+                     args.page_size)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+In-process caches
+"""
+
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire after a time to live.
+
+    Entries holding None are negative entries and use negative_ttl, so
+    lookups for unknown keys can be answered without a round trip too.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float = None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key) -> tuple:
+        """Returns (True, value) on a hit and (False, None) on a miss"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self._entries[key]
+            self.expirations += 1
+        self.misses += 1
+        return False, None
+
+    def set(self, key, value):
+        """Caches a value, evicting the least recently used entry when full"""
+        if self.maxsize <= 0:
+            return
+        ttl = self.negative_ttl if value is None else self.ttl
+        self._entries[key] = (self.clock() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Drops a key from the cache"""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Drops every entry"""
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """Returns the cache counters"""
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
@@ -2,138 +2,301 @@
 Functions to get or create DynamoDB tables
 """
 
-import boto3
+import time
+import threading
+import functools
+
+from botocore.exceptions import ClientError
+
 from . import config
+from . import logger
 
-# connect to DB
-dynamodb = boto3.resource('dynamodb', region_name=config.AWS_REGION)
+@functools.lru_cache(maxsize=None)
+def get_resource():
+    """Connects to DB on first use, so importing the app doesn't pay for it"""
+    # pylint: disable=import-outside-toplevel
+    import boto3
+    from botocore.config import Config
 
-def get_users_table(table_name: str = config.USERS_TABLE) -> dynamodb.Table:
-    """Creates the User table if it doesn't exist and returns the client"""
-    if table_name not in [table.name for table in dynamodb.tables.all()]:
-        client = boto3.client('dynamodb')
-        client.create_table(
-            TableName=table_name,
-            ProvisionedThroughput={
-                "ReadCapacityUnits": 5,
-                "WriteCapacityUnits": 5
-            },
-            KeySchema=[
-                {
-                    "AttributeName": "UserName",
-                    "KeyType": "HASH"
-                }
-            ],
-            AttributeDefinitions=[
-                {
-                    "AttributeName": "UserName",
-                    "AttributeType": "S"
-                }
-            ],
-        )
+    # Keep enough pooled HTTPS connections for every executor thread in async_table
+    boto_config = Config(
+        max_pool_connections=getattr(config, 'DYNAMODB_MAX_POOL_CONNECTIONS', 32),
+        tcp_keepalive=True
+    )
+    from . import metrics, request_stats
 
-    return dynamodb.Table(table_name)
+    resource = boto3.resource(
+        'dynamodb',
+        region_name=config.AWS_REGION,
+        endpoint_url=getattr(config, 'DYNAMODB_ENDPOINT_URL', None),
+        config=boto_config
+    )
+    metrics.instrument_dynamodb(resource.meta.client)
+    request_stats.instrument_dynamodb(resource.meta.client)
+    return resource
 
-def get_tokens_table(table_name: str = config.TOKENS_TABLE) -> dynamodb.Table:
-    """Creates the Token table if it doesn't exist and returns the client"""
-    if table_name not in [table.name for table in dynamodb.tables.all()]:
-        client = boto3.client('dynamodb')
-        client.create_table(
+# Skip the ListTables/CreateTable bootstrap where tables are provisioned ahead of time
+ASSUME_TABLES_EXIST = getattr(config, 'DYNAMODB_ASSUME_TABLES_EXIST', False)
+
+# Indexes added to existing tables are built one at a time, polled every
+# INDEX_WAIT_DELAY seconds for up to an hour each
+INDEX_WAIT_DELAY = 5
+INDEX_WAIT_ATTEMPTS = 720
+# Tries at creating an index while the table is busy with another update
+INDEX_CREATE_ATTEMPTS = 10
+
+def _schema(hash_key: str, key_type: str, indexes: list = None) -> dict:
+    schema = {
+        "ProvisionedThroughput": {
+            "ReadCapacityUnits": 5,
+            "WriteCapacityUnits": 5
+        },
+        "KeySchema": [
+            {
+                "AttributeName": hash_key,
+                "KeyType": "HASH"
+            }
+        ],
+        "AttributeDefinitions": [
+            {
+                "AttributeName": hash_key,
+                "AttributeType": key_type
+            }
+        ],
+    }
+    if indexes:
+        schema["GlobalSecondaryIndexes"] = [index for index, _ in indexes]
+        for _, attributes in indexes:
+            schema["AttributeDefinitions"] += attributes
+    return schema
+
+def _index(name: str, hash_key: tuple, range_key: tuple, projected: list) -> tuple:
+    """Builds a GSI on (name, type) keys and the attribute definitions it needs"""
+    index = {
+        "IndexName": name,
+        "KeySchema": [
+            {"AttributeName": hash_key[0], "KeyType": "HASH"},
+            {"AttributeName": range_key[0], "KeyType": "RANGE"}
+        ],
+        "Projection": {"ProjectionType": "INCLUDE", "NonKeyAttributes": projected},
+        "ProvisionedThroughput": {
+            "ReadCapacityUnits": 5,
+            "WriteCapacityUnits": 5
+        }
+    }
+    attributes = [
+        {"AttributeName": hash_key[0], "AttributeType": hash_key[1]},
+        {"AttributeName": range_key[0], "AttributeType": range_key[1]}
+    ]
+    return index, attributes
+
+# Epoch seconds attribute DynamoDB deletes expired items by, per table kind
+TTL_ATTRIBUTE = "ExpiresAt"
+TTL_TABLES = {"tokens", "sessions", "rate_limits", "revocations"}
+
+# Only created when failed logins are counted in DynamoDB
+RATE_LIMITS_TABLE = getattr(config, 'RATE_LIMITS_TABLE', 'RateLimits')
+
+# Precomputed summaries, e.g. the user activity rollup
+ROLLUPS_TABLE = getattr(config, 'ROLLUPS_TABLE', 'Rollups')
+
+# Counters that numeric IDs are leased from
+COUNTERS_TABLE = getattr(config, 'COUNTERS_TABLE', 'Counters')
+
+# Only created when sessions are signed tokens
+REVOCATIONS_TABLE = getattr(config, 'REVOCATIONS_TABLE', 'Revocations')
+
+# Sessions of a user, newest first
+USER_SESSIONS_INDEX = "UserSessions"
+# Queries of a user, newest first
+USER_QUERIES_INDEX = "UserQueries"
+# Flags with a status, most recently flagged first
+FLAG_STATUS_INDEX = "FlagsByStatus"
+
+# Table definitions by kind, the table names come from config
+TABLE_SCHEMAS = {
+    "users": _schema("UserName", "S"),
+    "tokens": _schema("AccessKey", "S"),
+    "sessions": _schema("SessionKey", "S", [
+        _index(USER_SESSIONS_INDEX, ("UserName", "S"), ("CreatedAt", "N"), ["Active", "ExpiresAt"])
+    ]),
+    "queries": _schema("QueryId", "N", [
+        _index(USER_QUERIES_INDEX, ("UserName", "S"), ("CreatedAt", "N"), ["Query", "Response"])
+    ]),
+    "flagged_docs": _schema("FlaggedId", "N", [
+        _index(FLAG_STATUS_INDEX, ("Status", "S"), ("LastFlaggedAt", "N"),
+               ["DocumentId", "FlagCount", "Reason", "FirstFlaggedAt"])
+    ]),
+    "rate_limits": _schema("LimitKey", "S"),
+    "rollups": _schema("RollupId", "S"),
+    "counters": _schema("CounterName", "S"),
+    "revocations": _schema("RevocationKey", "S"),
+}
+
+_existing_tables = None
+_ttl_enabled = set()
+_indexes_checked = set()
+_lock = threading.Lock()
+
+def _list_tables() -> set:
+    """Lists the tables once per process"""
+    global _existing_tables  # pylint: disable=global-statement
+    if _existing_tables is None:
+        paginator = get_resource().meta.client.get_paginator('list_tables')
+        _existing_tables = {
+            name for page in paginator.paginate() for name in page.get('TableNames', [])
+        }
+    return _existing_tables
+
+def _create_table(kind: str, table_name: str):
+    """Creates a table, tolerating another process creating it first"""
+    logger.info('Creating %s table %s', kind, table_name)
+    try:
+        get_resource().meta.client.create_table(TableName=table_name, **TABLE_SCHEMAS[kind])
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ResourceInUseException':
+            raise
+
+def _enable_ttl(table_name: str):
+    """Turns on TTL for a table unless it is on already"""
+    client = get_resource().meta.client
+    status = client.describe_time_to_live(TableName=table_name)['TimeToLiveDescription']
+    if status.get('TimeToLiveStatus') not in ('ENABLED', 'ENABLING'):
+        logger.info('Enabling TTL on %s', table_name)
+        client.update_time_to_live(
             TableName=table_name,
-            ProvisionedThroughput={
-                "ReadCapacityUnits": 5,
-                "WriteCapacityUnits": 5
-            },
-            KeySchema=[
-                {
-                    "AttributeName": "AccessKey",
-                    "KeyType": "HASH"
-                }
-            ],
-            AttributeDefinitions=[
-                {
-                    "AttributeName": "AccessKey",
-                    "AttributeType": "S"
-                }
-            ],
+            TimeToLiveSpecification={"Enabled": True, "AttributeName": TTL_ATTRIBUTE}
         )
+    _ttl_enabled.add(table_name)
+
+def _wait_until_active(table_name: str) -> dict:
+    """Waits until the table and its indexes are ACTIVE and returns its description"""
+    client = get_resource().meta.client
+    for _ in range(INDEX_WAIT_ATTEMPTS):
+        table = client.describe_table(TableName=table_name)['Table']
+        statuses = [table['TableStatus']] + \
+            [index['IndexStatus'] for index in table.get('GlobalSecondaryIndexes', [])]
+        if all(status == 'ACTIVE' for status in statuses):
+            return table
+        time.sleep(INDEX_WAIT_DELAY)
+    raise TimeoutError(f'{table_name} and its indexes are not ACTIVE')
+
+def _create_missing_indexes(kind: str, table_name: str):
+    """Adds indexes defined since the table was created, one at a time"""
+    schema = TABLE_SCHEMAS[kind]
+    client = get_resource().meta.client
+    for index in schema["GlobalSecondaryIndexes"]:
+        for attempt in range(INDEX_CREATE_ATTEMPTS):
+            # DynamoDB builds one index per table at a time, so the previous one has to finish
+            table = _wait_until_active(table_name)
+            existing = {index['IndexName'] for index in table.get('GlobalSecondaryIndexes', [])}
+            if index["IndexName"] in existing:
+                break
+            logger.info('Creating index %s on %s', index["IndexName"], table_name)
+            key_names = {key["AttributeName"] for key in index["KeySchema"]}
+            try:
+                client.update_table(
+                    TableName=table_name,
+                    AttributeDefinitions=[
+                        attr for attr in schema["AttributeDefinitions"]
+                        if attr["AttributeName"] in key_names
+                    ],
+                    GlobalSecondaryIndexUpdates=[{"Create": index}]
+                )
+                break
+            except ClientError as err:
+                # Another process is updating the table or building an index on it
+                if err.response['Error']['Code'] not in ('ResourceInUseException',
+                                                         'LimitExceededException') \
+                   or attempt == INDEX_CREATE_ATTEMPTS - 1:
+                    raise
+                logger.info('Table %s is busy, retrying index %s: %s',
+                            table_name, index["IndexName"], err)
+                time.sleep(INDEX_WAIT_DELAY)
+    # Queries can't use an index until it is backfilled
+    _wait_until_active(table_name)
+    _indexes_checked.add(table_name)
+
+def ensure_tables(tables: dict) -> dict:
+    """
+    Creates any missing tables from a {table name: kind} mapping and waits
+    until they exist. Returns the Table objects by name.
+    """
+    with _lock:
+        if not ASSUME_TABLES_EXIST:
+            missing = {name: kind for name, kind in tables.items() if name not in _list_tables()}
+            for table_name, kind in missing.items():
+                _create_table(kind, table_name)
+            waiter = get_resource().meta.client.get_waiter('table_exists')
+            for table_name in missing:
+                waiter.wait(TableName=table_name, WaiterConfig={"Delay": 1, "MaxAttempts": 60})
+                _existing_tables.add(table_name)
+            # Tables created before expiry and indexes were added get them too
+            for table_name, kind in tables.items():
+                if kind in TTL_TABLES and table_name not in _ttl_enabled:
+                    _enable_ttl(table_name)
+                if "GlobalSecondaryIndexes" in TABLE_SCHEMAS[kind] \
+                   and table_name not in _indexes_checked:
+                    if table_name in missing:
+                        _indexes_checked.add(table_name)
+                    else:
+                        _create_missing_indexes(kind, table_name)
+
+    return {table_name: get_resource().Table(table_name) for table_name in tables}
 
-    return dynamodb.Table(table_name)
+def ensure_all_tables() -> dict:
+    """Bootstraps every table named in config"""
+    tables = {
+        config.USERS_TABLE: "users",
+        config.TOKENS_TABLE: "tokens",
+        config.SESSIONS_TABLE: "sessions",
+        config.QUERIES_TABLE: "queries",
+        config.FLAGGED_DOCS_TABLE: "flagged_docs",
+        ROLLUPS_TABLE: "rollups",
+        COUNTERS_TABLE: "counters",
+    }
+    if getattr(config, 'LOGIN_SHARED_LIMITS', False):
+        tables[RATE_LIMITS_TABLE] = "rate_limits"
+    if getattr(config, 'SESSION_MODE', 'table') == 'signed':
+        tables[REVOCATIONS_TABLE] = "revocations"
+    return ensure_tables(tables)
 
-def get_sessions_table(table_name: str = config.SESSIONS_TABLE) -> dynamodb.Table:
+def get_table(kind: str, table_name: str) -> 'Table':
+    """Creates the table if it doesn't exist and returns the client"""
+    return ensure_tables({table_name: kind})[table_name]
+
+def get_users_table(table_name: str = config.USERS_TABLE) -> 'Table':
+    """Creates the User table if it doesn't exist and returns the client"""
+    return get_table("users", table_name)
+
+def get_tokens_table(table_name: str = config.TOKENS_TABLE) -> 'Table':
     """Creates the Token table if it doesn't exist and returns the client"""
-    if table_name not in [table.name for table in dynamodb.tables.all()]:
-        client = boto3.client('dynamodb')
-        client.create_table(
-            TableName=table_name,
-            ProvisionedThroughput={
-                "ReadCapacityUnits": 5,
-                "WriteCapacityUnits": 5
-            },
-            KeySchema=[
-                {
-                    "AttributeName": "SessionKey",
-                    "KeyType": "HASH"
-                }
-            ],
-            AttributeDefinitions=[
-                {
-                    "AttributeName": "SessionKey",
-                    "AttributeType": "S"
-                }
-            ],
-        )
+    return get_table("tokens", table_name)
 
-    return dynamodb.Table(table_name)
+def get_sessions_table(table_name: str = config.SESSIONS_TABLE) -> 'Table':
+    """Creates the Sessions table if it doesn't exist and returns the client"""
+    return get_table("sessions", table_name)
 
-def get_queries_table(table_name: str = config.QUERIES_TABLE) -> dynamodb.Table:
+def get_queries_table(table_name: str = config.QUERIES_TABLE) -> 'Table':
     """Creates the Queries table if it doesn't exist and returns the client"""
-    if table_name not in [table.name for table in dynamodb.tables.all()]:
-        client = boto3.client('dynamodb')
-        client.create_table(
-            TableName=table_name,
-            ProvisionedThroughput={
-                "ReadCapacityUnits": 5,
-                "WriteCapacityUnits": 5
-            },
-            KeySchema=[
-                {
-                    "AttributeName": "QueryId",
-                    "KeyType": "HASH"
-                }
-            ],
-            AttributeDefinitions=[
-                {
-                    "AttributeName": "QueryId",
-                    "AttributeType": "N"
-                }
-            ],
-        )
+    return get_table("queries", table_name)
 
-    return dynamodb.Table(table_name)
-
-def get_flagged_docs_table(table_name: str = config.FLAGGED_DOCS_TABLE) -> dynamodb.Table:
+def get_flagged_docs_table(table_name: str = config.FLAGGED_DOCS_TABLE) -> 'Table':
     """Creates the Flagged table if it doesn't exist and returns the client"""
-    if table_name not in [table.name for table in dynamodb.tables.all()]:
-        client = boto3.client('dynamodb')
-        client.create_table(
-            TableName=table_name,
-            ProvisionedThroughput={
-                "ReadCapacityUnits": 5,
-                "WriteCapacityUnits": 5
-            },
-            KeySchema=[
-                {
-                    "AttributeName": "FlaggedId",
-                    "KeyType": "HASH"
-                }
-            ],
-            AttributeDefinitions=[
-                {
-                    "AttributeName": "FlaggedId",
-                    "AttributeType": "N"
-                }
-            ],
-        )
+    return get_table("flagged_docs", table_name)
+
+def get_rate_limits_table(table_name: str = RATE_LIMITS_TABLE) -> 'Table':
+    """Creates the RateLimits table if it doesn't exist and returns the client"""
+    return get_table("rate_limits", table_name)
+
+def get_rollups_table(table_name: str = ROLLUPS_TABLE) -> 'Table':
+    """Creates the Rollups table if it doesn't exist and returns the client"""
+    return get_table("rollups", table_name)
+
+def get_counters_table(table_name: str = COUNTERS_TABLE) -> 'Table':
+    """Creates the Counters table if it doesn't exist and returns the client"""
+    return get_table("counters", table_name)
 
-    return dynamodb.Table(table_name)
+def get_revocations_table(table_name: str = REVOCATIONS_TABLE) -> 'Table':
+    """Creates the Revocations table if it doesn't exist and returns the client"""
+    return get_table("revocations", table_name)
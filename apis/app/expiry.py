@@ -0,0 +1,59 @@
+"""
+Expiry of short lived items
+"""
+
+import time
+import asyncio
+
+from . import config
+from . import logger
+from .dynamodb_tables import TTL_ATTRIBUTE
+
+# Seconds between sweeps deleting expired items, for backends like DynamoDB
+# Local that don't implement TTL. 0 leaves expired items to DynamoDB's TTL.
+SWEEP_INTERVAL = getattr(config, 'EXPIRY_SWEEP_INTERVAL', 0)
+
+def expires_at(ttl: float) -> int:
+    """The epoch second an item written now should expire at"""
+    return int(time.time() + ttl)
+
+def is_expired(item: dict) -> bool:
+    """Checks an item's expiry, items written before expiry was added never expire"""
+    # TTL deletes expired items within days, until then reads still return them
+    return TTL_ATTRIBUTE in item and item[TTL_ATTRIBUTE] <= time.time()
+
+def sweep_expired(table) -> int:
+    """Deletes the expired items of a table, returns how many were deleted"""
+    key_names = [key['AttributeName'] for key in table.key_schema]
+    scan = {
+        "FilterExpression": "#ttl <= :now",
+        "ProjectionExpression": ', '.join(f'#k{i}' for i in range(len(key_names))),
+        "ExpressionAttributeNames": {
+            "#ttl": TTL_ATTRIBUTE,
+            **{f'#k{i}': name for i, name in enumerate(key_names)}
+        },
+        "ExpressionAttributeValues": {":now": int(time.time())}
+    }
+    deleted = 0
+    with table.batch_writer() as batch:
+        while True:
+            response = table.scan(**scan)
+            for item in response.get('Items', []):
+                batch.delete_item(Key=item)
+                deleted += 1
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return deleted
+
+async def sweep_forever(sweeps: dict, interval: float):
+    """Awaits each {name: sweep} every interval seconds, sweeps return how many items they deleted"""
+    while True:
+        await asyncio.sleep(interval)
+        for name, sweep in sweeps.items():
+            try:
+                deleted = await sweep()
+                if deleted:
+                    logger.info('Deleted %s expired items from %s', deleted, name)
+            except Exception as err:  # pylint: disable=broad-except
+                logger.warning('Error sweeping %s: %s', name, err)
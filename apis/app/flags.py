@@ -0,0 +1,57 @@
+"""
+Flagged documents moderation queue
+"""
+
+import time
+import hashlib
+
+from . import config
+from .user import get_user
+from .storage import storage
+from .util import encode_cursor, decode_cursor
+
+# Roles allowed to list and resolve flags
+MODERATOR_ROLES = set(getattr(config, 'MODERATOR_ROLES', ('moderator', 'admin')))
+
+# Queue pages continue after the last flag's position in the FlagsByStatus index
+CURSOR_FIELDS = ("LastFlaggedAt", "FlaggedId")
+
+def flagged_id(document_id: str) -> int:
+    """
+    The FlaggedId of a document, the same every time it is flagged so
+    repeated flags land on one item. 63 bits of a BLAKE2 hash, which fits
+    a signed 64 bit integer and makes collisions negligible.
+    """
+    digest = hashlib.blake2b(document_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+async def is_moderator(username: str) -> bool:
+    """Whether the user may work the moderation queue"""
+    return (await get_user(username)).get('AuthRole') in MODERATOR_ROLES
+
+async def flag_document(username: str, document_id: str, reason: str = None) -> dict:
+    """Flags a document, or counts another flag of one already flagged, returns the flag"""
+    attrs = {
+        "DocumentId": document_id,
+        "Status": "open",
+        "LastFlaggedAt": int(time.time() * 1000),
+        "LastFlaggedBy": username
+    }
+    if reason:
+        attrs["Reason"] = reason
+    return await storage.flagged_docs.flag(flagged_id(document_id), attrs)
+
+async def flag_queue(status: str, limit: int, cursor: str = '') -> tuple:
+    """A page of flags, most recently flagged first, and the cursor of the next page"""
+    after = decode_cursor(cursor, CURSOR_FIELDS) if cursor else None
+    flags, more = await storage.flagged_docs.page_by_status(status, limit, after)
+    return flags, encode_cursor(flags[-1], CURSOR_FIELDS) if more and flags else ''
+
+async def resolve_flags(username: str, flagged_ids: list) -> list:
+    """Resolves the open flags among flagged_ids, returns the ones resolved"""
+    # Each flag is resolved once however often it is listed
+    flagged_ids = list(dict.fromkeys(flagged_ids))
+    return await storage.flagged_docs.resolve_many(flagged_ids, {
+        "ResolvedAt": int(time.time() * 1000),
+        "ResolvedBy": username
+    })
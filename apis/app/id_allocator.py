@@ -0,0 +1,101 @@
+"""
+Numeric IDs leased from a counter a block at a time
+"""
+
+import asyncio
+
+from . import config
+from . import logger
+from .metrics import ID_BLOCKS_LEASED, IDS_LEASED, IDS_ISSUED
+
+# IDs leased per counter update, so each process writes the counter once per block
+ID_BLOCK_SIZE = getattr(config, 'ID_BLOCK_SIZE', 1000)
+# The next block is leased in the background once this share of the current one is left
+ID_PREFETCH = 0.2
+
+# Largest signed 64 bit integer, so IDs fit SQLite keys and most clients' int64
+MAX_ID = 2 ** 63 - 1
+
+class IdAllocator:
+    """
+    Unique numeric IDs for one counter, without I/O for most of them (hi/lo).
+
+    Each process leases a block of block_size IDs with one atomic add to
+    the counter and hands them out locally, so processes never share an
+    ID and the counter is written once per block rather than per record.
+    The next block is leased in the background before the current one
+    runs out. IDs left in a block when the process stops are never used.
+    """
+
+    def __init__(self, name: str, add, block_size: int, limit: int = MAX_ID):
+        # add(name, amount, limit) atomically adds to the counter and returns its new value
+        self.name = name
+        self.add = add
+        self.block_size = block_size
+        self.limit = limit
+        self.low_water = int(block_size * ID_PREFETCH)
+        # The IDs [_next, _end) are leased and not handed out yet
+        self._next = 0
+        self._end = 0
+        self._spare = None
+        self._leasing = None
+        self.blocks = 0
+        self.issued = 0
+
+    @property
+    def remaining(self) -> int:
+        """IDs leased and not handed out yet"""
+        spare = self._spare[1] - self._spare[0] if self._spare else 0
+        return self._end - self._next + spare
+
+    def stats(self) -> dict:
+        """Blocks leased and the share of their IDs handed out"""
+        leased = self.blocks * self.block_size
+        return {
+            "blocks": self.blocks,
+            "leased": leased,
+            "issued": self.issued,
+            "utilization": self.issued / leased if leased else 0.0
+        }
+
+    async def _lease(self):
+        try:
+            value = await self.add(self.name, self.block_size, self.limit)
+            self._spare = (value - self.block_size + 1, value + 1)
+            self.blocks += 1
+            ID_BLOCKS_LEASED.labels(self.name).inc()
+            IDS_LEASED.labels(self.name).inc(self.block_size)
+        finally:
+            self._leasing = None
+
+    def _start_lease(self) -> asyncio.Task:
+        if self._leasing is None:
+            self._leasing = asyncio.ensure_future(self._lease())
+            # A failed prefetch is logged here, callers waiting on it see the error too
+            self._leasing.add_done_callback(self._lease_done)
+        return self._leasing
+
+    def _lease_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logger.warning('Error leasing %s IDs: %s', self.name, task.exception())
+
+    async def take(self, count: int = 1) -> list:
+        """count new IDs, in increasing order within a block"""
+        ids = []
+        while len(ids) < count:
+            if self._next == self._end:
+                if self._spare is None:
+                    # Shielded, so a cancelled caller doesn't cancel the lease others wait on
+                    await asyncio.shield(self._start_lease())
+                    continue
+                self._next, self._end = self._spare
+                self._spare = None
+            taken = min(count - len(ids), self._end - self._next)
+            ids += range(self._next, self._next + taken)
+            self._next += taken
+
+        self.issued += count
+        IDS_ISSUED.labels(self.name).inc(count)
+        if self._spare is None and self._end - self._next <= self.low_water:
+            self._start_lease()
+        return ids
@@ -0,0 +1,143 @@
+"""
+Prometheus metrics
+"""
+
+import os
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, \
+                              CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+HTTP_REQUESTS = Counter(
+    'http_requests_total', 'Requests handled', ['method', 'route', 'status']
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Time to handle a request', ['method', 'route']
+)
+HTTP_IN_PROGRESS = Gauge(
+    'http_requests_in_progress', 'Requests being handled', ['method'],
+    multiprocess_mode='livesum'
+)
+
+DYNAMODB_CALLS = Counter(
+    'dynamodb_calls_total', 'DynamoDB API calls', ['table', 'operation']
+)
+DYNAMODB_CALL_SECONDS = Histogram(
+    'dynamodb_call_duration_seconds', 'Time a DynamoDB call took, retries included',
+    ['table', 'operation'],
+    buckets=(.002, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+)
+DYNAMODB_ERRORS = Counter(
+    'dynamodb_errors_total', 'DynamoDB calls that failed', ['table', 'operation', 'code']
+)
+DYNAMODB_THROTTLES = Counter(
+    'dynamodb_throttles_total', 'DynamoDB calls that failed from throttling',
+    ['table', 'operation']
+)
+DYNAMODB_RETRIES = Counter(
+    'dynamodb_retries_total', 'Attempts botocore retried', ['table', 'operation']
+)
+
+SMTP_SEND_SECONDS = Histogram(
+    'smtp_send_duration_seconds', 'Time to send an email, connecting included'
+)
+SMTP_SEND_FAILURES = Counter(
+    'smtp_send_failures_total', 'Emails the SMTP server failed to take'
+)
+
+ID_BLOCKS_LEASED = Counter(
+    'id_blocks_leased_total', 'Blocks of IDs leased from a counter', ['counter']
+)
+IDS_LEASED = Counter(
+    'ids_leased_total', 'IDs in the blocks leased from a counter', ['counter']
+)
+IDS_ISSUED = Counter(
+    'ids_issued_total', 'IDs handed out from leased blocks', ['counter']
+)
+
+THROTTLE_CODES = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded'
+}
+
+class MetricsMiddleware:
+    """ASGI middleware counting and timing requests by route"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        method = scope['method']
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        in_progress = HTTP_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_progress.dec()
+            # The template, not the path, so labels stay bounded
+            route = scope.get('route')
+            route = route.path if route else 'unmatched'
+            HTTP_REQUEST_SECONDS.labels(method, route).observe(time.perf_counter() - started)
+            HTTP_REQUESTS.labels(method, route, status).inc()
+
+def _before_parameter_build(params: dict, context: dict, **kwargs):
+    # Only the parameter build event sees the call's parameters, so the table
+    # is kept in the request context for the after call events
+    context['metrics_table'] = params.get('TableName') or 'multiple'
+    context['metrics_started'] = time.perf_counter()
+
+def _after_call(parsed: dict, model, context: dict, **kwargs):
+    table, operation = context.get('metrics_table', 'multiple'), model.name
+    DYNAMODB_CALLS.labels(table, operation).inc()
+    started = context.get('metrics_started')
+    if started is not None:
+        DYNAMODB_CALL_SECONDS.labels(table, operation).observe(time.perf_counter() - started)
+
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if retries:
+        DYNAMODB_RETRIES.labels(table, operation).inc(retries)
+
+    code = parsed.get('Error', {}).get('Code')
+    if code:
+        DYNAMODB_ERRORS.labels(table, operation, code).inc()
+        if code in THROTTLE_CODES:
+            DYNAMODB_THROTTLES.labels(table, operation).inc()
+
+def _after_call_error(exception, context: dict, event_name: str = '', **kwargs):
+    # Only the exception and context are passed, the operation is the last part of the event name
+    table, operation = context.get('metrics_table', 'multiple'), event_name.rsplit('.', 1)[-1]
+    DYNAMODB_CALLS.labels(table, operation).inc()
+    DYNAMODB_ERRORS.labels(table, operation, type(exception).__name__).inc()
+
+def instrument_dynamodb(client):
+    """Records the calls made through a botocore DynamoDB client"""
+    events = client.meta.events
+    events.register('before-parameter-build.dynamodb', _before_parameter_build,
+                    unique_id='metrics-before-call')
+    events.register('after-call.dynamodb', _after_call, unique_id='metrics-after-call')
+    events.register('after-call-error.dynamodb', _after_call_error,
+                    unique_id='metrics-after-call-error')
+
+def render() -> tuple:
+    """Returns the metrics in the Prometheus text format and its content type"""
+    # With several workers each process writes its metrics to this directory
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
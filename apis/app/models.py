@@ -2,7 +2,55 @@
 Models for API endpoints
 """
 
-from pydantic import BaseModel
+import re
+from typing import Annotated, List, Literal, Optional
+
+from pydantic import BaseModel, AfterValidator, Field, StringConstraints
+
+# Compiled once at import, the regexes are only run on strings that already
+# passed the length limits checked by pydantic-core
+EMAIL_REGEX = re.compile(r"([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+/-9=?A-Z^-~]+)*|\"([]!#-[^-~ \t]|(\\[\t -~]))+\")@([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+/-9=?A-Z^-~]+)*|\[[\t -Z^-~]*])")
+PASSWORD_REGEX = re.compile(r'^(?=.*[a-z])(?=.*[A-Z])(?=.*[0-9])(?=.*[_!@#$%]).{8,24}$')
+
+# Longest address SMTP allows
+MAX_USERNAME_LENGTH = 254
+MIN_PASSWORD_LENGTH = 8
+MAX_PASSWORD_LENGTH = 24
+
+def _check_username(username: str) -> str:
+    if not EMAIL_REGEX.match(username):
+        raise ValueError('invalid username')
+    return username
+
+def _check_password(password: str) -> str:
+    if not PASSWORD_REGEX.match(password):
+        raise ValueError('invalid password')
+    return password
+
+Username = Annotated[
+    str,
+    StringConstraints(max_length=MAX_USERNAME_LENGTH),
+    AfterValidator(_check_username)
+]
+Password = Annotated[
+    str,
+    StringConstraints(min_length=MIN_PASSWORD_LENGTH, max_length=MAX_PASSWORD_LENGTH),
+    AfterValidator(_check_password)
+]
+
+# Limits of the query log
+MAX_QUERY_LENGTH = 8000
+MAX_QUERY_BATCH = 100
+MAX_QUERY_PAGE = 100
+
+# Limits of the moderation queue
+MAX_DOCUMENT_ID_LENGTH = 1024
+MAX_FLAG_REASON_LENGTH = 1000
+MAX_FLAG_PAGE = 100
+MAX_FLAGS_RESOLVED = 100
+
+# Fields rejected with a 403 rather than a 422 when they fail validation
+CREDENTIAL_FIELDS = {'username', 'password', 'newPassword'}
 
 class LoggedInUser(BaseModel):
     """Return type for User"""
@@ -21,27 +69,57 @@ class ResetPassword(BaseModel):
 
 class UpdatePassword(BaseModel):
     """Class for changing the password"""
-    username: str
-    password: str
-    newPassword: str
+    username: Username
+    password: Password
+    newPassword: Password
 
 class SetNewPassword(BaseModel):
     """Class for changing the password"""
-    username: str
+    username: Username
     accessKey: str
-    password: str
+    password: Password
 
 class NewUser(BaseModel):
     """Data class for register endpoint"""
-    username: str
-    password: str
+    username: Username
+    password: Password
 
 class ExistingUser(BaseModel):
     """Data class for register endpoint"""
-    username: str
-    password: str
+    username: Username
+    password: Password
 
 class AuthenticatingUser(BaseModel):
     """Data class for verifying a session"""
     username: str
     authKey: str
+
+class QueryRecord(BaseModel):
+    """One query a user made and the answer they got"""
+    query: Annotated[str, StringConstraints(min_length=1, max_length=MAX_QUERY_LENGTH)]
+    response: Optional[Annotated[str, StringConstraints(max_length=MAX_QUERY_LENGTH)]] = None
+
+class QueryLog(AuthenticatingUser):
+    """Data class for logging one or more queries"""
+    queries: Annotated[List[QueryRecord], Field(min_length=1, max_length=MAX_QUERY_BATCH)]
+
+class QueryHistory(AuthenticatingUser):
+    """Data class for reading a page of the user's queries"""
+    limit: Annotated[int, Field(ge=1, le=MAX_QUERY_PAGE)] = 20
+    cursor: str = ''
+
+class FlagDocument(AuthenticatingUser):
+    """Data class for flagging a document"""
+    documentId: Annotated[str, StringConstraints(min_length=1, max_length=MAX_DOCUMENT_ID_LENGTH)]
+    reason: Optional[Annotated[str, StringConstraints(max_length=MAX_FLAG_REASON_LENGTH)]] = None
+
+class FlagQueue(AuthenticatingUser):
+    """Data class for reading a page of the moderation queue"""
+    status: Literal['open', 'resolved'] = 'open'
+    limit: Annotated[int, Field(ge=1, le=MAX_FLAG_PAGE)] = 20
+    cursor: str = ''
+
+class ResolveFlags(AuthenticatingUser):
+    """Data class for resolving flags in bulk"""
+    # FlaggedIds are sent as strings, they don't fit in a JavaScript number
+    flaggedIds: Annotated[List[int], Field(min_length=1, max_length=MAX_FLAGS_RESOLVED)]
@@ -0,0 +1,216 @@
+"""
+Durable outbox for emails sent in the background
+"""
+
+import time
+import random
+import asyncio
+import sqlite3
+import threading
+
+from . import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    text TEXT NOT NULL,
+    html TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+"""
+
+class Outbox:
+    """
+    Queue of emails persisted in SQLite and drained by background workers.
+
+    Handlers enqueue and return, workers call deliver(email) from a thread
+    and retry failures with exponential backoff until max_attempts, after
+    which the email is kept as a dead letter. Delivered emails are deleted.
+    A claim is a lease: emails left sending for claim_timeout seconds, by a
+    process that died or a worker that is stuck, are sent again.
+    """
+
+    def __init__(self,
+                 path: str,
+                 deliver,
+                 workers: int = 2,
+                 max_attempts: int = 5,
+                 base_delay: float = 2.0,
+                 max_delay: float = 300.0,
+                 poll_interval: float = 5.0,
+                 claim_timeout: float = 300.0):
+        self.path = path
+        self.deliver = deliver
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self._db = None
+        self._lock = threading.Lock()
+        self._wake = None
+        self._tasks = []
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """Opens the database on first use"""
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(SCHEMA)
+            columns = {row['name'] for row in db.execute('PRAGMA table_info(outbox)')}
+            if 'claimed_at' not in columns:
+                # Outboxes created before claims were leases
+                db.execute('ALTER TABLE outbox ADD COLUMN claimed_at REAL')
+            self._db = db
+        return self._db
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self.db.execute(sql, params)
+
+    def put(self, recipient: str, subject: str, text: str, html: str) -> int:
+        """Persists an email and returns its id"""
+        now = time.time()
+        cursor = self._execute(
+            'INSERT INTO outbox (recipient, subject, text, html, next_attempt_at, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (recipient, subject, text, html, now, now)
+        )
+        return cursor.lastrowid
+
+    async def enqueue(self, recipient: str, subject: str, text: str, html: str) -> int:
+        """Persists an email for the workers to send"""
+        email_id = await asyncio.to_thread(self.put, recipient, subject, text, html)
+        if self._wake:
+            self._wake.set()
+        return email_id
+
+    def claim(self):
+        """Marks the next due email as sending and returns it"""
+        with self._lock:
+            # BEGIN IMMEDIATE keeps workers in other processes from claiming it too
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute(
+                    "SELECT * FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+                    "ORDER BY next_attempt_at LIMIT 1",
+                    (time.time(),)
+                ).fetchone()
+                if row:
+                    self.db.execute(
+                        "UPDATE outbox SET status = 'sending', claimed_at = ? WHERE id = ?",
+                        (time.time(), row['id'])
+                    )
+                self.db.execute('COMMIT')
+            except sqlite3.Error:
+                self.db.execute('ROLLBACK')
+                raise
+        return dict(row) if row else None
+
+    def mark_sent(self, email_id: int):
+        """Removes a delivered email"""
+        self._execute('DELETE FROM outbox WHERE id = ?', (email_id,))
+
+    def mark_failed(self, email: dict, error: Exception):
+        """Schedules a retry or moves the email to the dead letters"""
+        attempts = email['attempts'] + 1
+        if attempts >= self.max_attempts:
+            logger.error('Giving up on email %s to %s: %s', email['id'], email['recipient'], error)
+            status, next_attempt_at = 'dead', time.time()
+        else:
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+            # Jitter so a provider outage doesn't end in a thundering herd
+            status, next_attempt_at = 'pending', time.time() + delay * random.uniform(0.5, 1.0)
+        self._execute(
+            'UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? '
+            'WHERE id = ?',
+            (status, attempts, next_attempt_at, str(error), email['id'])
+        )
+
+    def requeue_stale(self) -> int:
+        """Returns emails claimed more than claim_timeout seconds ago to the queue"""
+        cursor = self._execute(
+            "UPDATE outbox SET status = 'pending' "
+            "WHERE status = 'sending' AND (claimed_at IS NULL OR claimed_at <= ?)",
+            (time.time() - self.claim_timeout,)
+        )
+        return cursor.rowcount
+
+    def requeue_dead(self) -> int:
+        """Gives every dead letter another round of attempts"""
+        cursor = self._execute(
+            "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ? "
+            "WHERE status = 'dead'",
+            (time.time(),)
+        )
+        return cursor.rowcount
+
+    def dead_letters(self) -> list:
+        """Returns the emails that ran out of attempts"""
+        rows = self._execute("SELECT * FROM outbox WHERE status = 'dead' ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+
+    def stats(self) -> dict:
+        """Returns the number of emails in each status"""
+        rows = self._execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+    async def process_one(self) -> bool:
+        """Delivers the next due email, returns False when there is none"""
+        email = await asyncio.to_thread(self.claim)
+        if not email:
+            return False
+        try:
+            await asyncio.to_thread(self.deliver, email)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warning('Error sending email %s to %s: %s', email['id'], email['recipient'], err)
+            await asyncio.to_thread(self.mark_failed, email, err)
+        else:
+            await asyncio.to_thread(self.mark_sent, email['id'])
+        return True
+
+    async def _work(self):
+        while True:
+            # Cleared before draining, so an email enqueued while draining wakes the worker again
+            self._wake.clear()
+            try:
+                while await self.process_one():
+                    pass
+                # Idle, so pick up claims abandoned by other processes
+                await asyncio.to_thread(self.requeue_stale)
+            except Exception as err:  # pylint: disable=broad-except
+                # Such as a locked database, an email left sending is sent again once its claim is stale
+                logger.warning('Error processing the outbox: %s', err)
+                await asyncio.sleep(self.poll_interval)
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        """Starts the workers, resuming emails whose claims went stale"""
+        # Claims still within their lease may belong to another process sending them
+        await asyncio.to_thread(self.requeue_stale)
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stops the workers, unsent emails stay in the outbox"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._wake = None
@@ -0,0 +1,133 @@
+"""
+Query log tools
+"""
+
+import time
+import asyncio
+
+from . import config
+from . import logger
+from .storage import storage
+from .id_allocator import IdAllocator, ID_BLOCK_SIZE
+from .util import encode_cursor, decode_cursor
+
+# Queries are written when this many are buffered, or every interval seconds
+QUERY_LOG_BATCH_SIZE = getattr(config, 'QUERY_LOG_BATCH_SIZE', 100)
+QUERY_LOG_FLUSH_INTERVAL = getattr(config, 'QUERY_LOG_FLUSH_INTERVAL', 1.0)
+# Queries buffered per process before new ones are refused
+QUERY_LOG_MAX_PENDING = getattr(config, 'QUERY_LOG_MAX_PENDING', 10000)
+
+class QueryLogFull(Exception):
+    """Raised when the query buffer can't take more queries"""
+
+class QueryBuffer:
+    """
+    Queries waiting to be written.
+
+    Handlers add queries and return, a background task writes them with
+    put_many once batch_size are buffered or every interval seconds.
+    Queries that fail to write are put back, and once max_pending are
+    buffered new ones are refused so callers can back off. Buffered
+    queries are lost if the process dies.
+    """
+
+    def __init__(self, write_many, batch_size: int, interval: float, max_pending: int):
+        # write_many(items) persists a list of queries
+        self.write_many = write_many
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = []
+        self._wake = None
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def add(self, items: list):
+        """Buffers queries, all of them or none"""
+        if len(self.pending) + len(items) > self.max_pending:
+            raise QueryLogFull()
+        self.pending += items
+        if self._wake and len(self.pending) >= self.batch_size:
+            self._wake.set()
+
+    async def flush(self) -> int:
+        """Writes every buffered query, returns how many were written"""
+        written = 0
+        while self.pending:
+            batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            try:
+                await self.write_many(batch)
+            except BaseException:
+                # Back at the front, the next flush tries them first
+                self.pending = batch + self.pending
+                raise
+            written += len(batch)
+        return written
+
+    async def _flush_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as err:  # pylint: disable=broad-except
+                logger.warning('Error writing %s buffered queries: %s', len(self.pending), err)
+                await asyncio.sleep(self.interval)
+
+    async def start(self):
+        """Starts writing in the background"""
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        """Stops the background writes and writes what is left"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            self._wake = None
+        try:
+            await self.flush()
+        except Exception as err:  # pylint: disable=broad-except
+            logger.error('Dropping %s buffered queries: %s', len(self.pending), err)
+
+query_buffer = QueryBuffer(
+    lambda items: storage.queries.put_many(items),
+    batch_size=QUERY_LOG_BATCH_SIZE,
+    interval=QUERY_LOG_FLUSH_INTERVAL,
+    max_pending=QUERY_LOG_MAX_PENDING
+)
+
+# QueryIds are leased from the QueryId counter a block at a time
+query_ids = IdAllocator("QueryId", lambda *args: storage.counters.add(*args), ID_BLOCK_SIZE)
+
+async def log_queries(username: str, records: list) -> list:
+    """Buffers the user's queries, returns their QueryIds"""
+    created_at = int(time.time() * 1000)
+    items = []
+    for query_id, record in zip(await query_ids.take(len(records)), records):
+        item = {
+            "QueryId": query_id,
+            "UserName": username,
+            "CreatedAt": created_at,
+            "Query": record.query
+        }
+        if record.response is not None:
+            item["Response"] = record.response
+        items.append(item)
+    query_buffer.add(items)
+    return [item["QueryId"] for item in items]
+
+# History pages continue after the last query's position in the UserQueries index
+CURSOR_FIELDS = ("CreatedAt", "QueryId")
+
+async def query_history(username: str, limit: int, cursor: str = '') -> tuple:
+    """A page of the user's queries, newest first, and the cursor of the next page"""
+    after = decode_cursor(cursor, CURSOR_FIELDS) if cursor else None
+    queries, more = await storage.queries.page_for_user(username, limit, after)
+    return queries, encode_cursor(queries[-1], CURSOR_FIELDS) if more and queries else ''
@@ -0,0 +1,261 @@
+"""
+Failed login throttling
+"""
+
+import math
+import time
+import asyncio
+from collections import OrderedDict, deque
+
+from botocore.exceptions import ClientError
+
+from . import config
+from .async_table import AsyncTable
+from .dynamodb_tables import get_rate_limits_table, RATE_LIMITS_TABLE
+
+# Failures within the window that lock a username or client IP out
+LOGIN_WINDOW = getattr(config, 'LOGIN_WINDOW', 60 * 10)
+LOGIN_MAX_FAILURES = getattr(config, 'LOGIN_MAX_FAILURES', 5)
+LOGIN_MAX_FAILURES_PER_IP = getattr(config, 'LOGIN_MAX_FAILURES_PER_IP', 20)
+# Also count failures in DynamoDB so every worker sees them
+LOGIN_SHARED_LIMITS = getattr(config, 'LOGIN_SHARED_LIMITS', False)
+
+class TooManyAttempts(Exception):
+    """Raised when a username or client IP is locked out"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f'Locked out for {retry_after:.0f}s')
+        self.retry_after = retry_after
+
+class FailureLimiter:
+    """
+    Sliding window of failure times per key, kept in memory.
+
+    A key is locked once max_failures happened within the last window
+    seconds, until the oldest of them leaves the window. Only the last
+    max_failures times are kept per key and the least recently failed keys
+    are dropped past maxsize, so memory stays bounded under a flood.
+    """
+
+    def __init__(self, max_failures: int, window: float, maxsize: int = 100000,
+                 clock=time.monotonic):
+        self.max_failures = max_failures
+        self.window = window
+        self.maxsize = maxsize
+        self.clock = clock
+        self._failures = OrderedDict()
+
+    def _retry_after(self, key: str) -> float:
+        failures = self._failures.get(key)
+        if not failures or len(failures) < self.max_failures:
+            return 0
+        return max(0, failures[0] + self.window - self.clock())
+
+    async def retry_after(self, key: str) -> float:
+        """Returns the seconds until the key is unlocked, 0 if it isn't locked"""
+        return self._retry_after(key)
+
+    async def acquire(self, key: str) -> float:
+        """Counts an attempt against the key as a failure, raises TooManyAttempts if it is locked"""
+        # Checked and counted without awaiting, so concurrent attempts see each other
+        retry_after = self._retry_after(key)
+        if retry_after:
+            raise TooManyAttempts(retry_after)
+        failures = self._failures.get(key)
+        if failures is None:
+            failures = self._failures[key] = deque(maxlen=self.max_failures)
+        token = self.clock()
+        failures.append(token)
+        self._failures.move_to_end(key)
+        while len(self._failures) > self.maxsize:
+            self._failures.popitem(last=False)
+        return token
+
+    async def release(self, key: str, token: float, reset: bool = False):
+        """Uncounts an attempt that didn't fail, or with reset forgets every failure of the key"""
+        if reset:
+            await self.reset(key)
+            return
+        try:
+            self._failures.get(key, []).remove(token)
+        except ValueError:
+            # Already reset or pushed out by newer failures
+            pass
+
+    async def reset(self, key: str):
+        """Forgets the failures of the key"""
+        self._failures.pop(key, None)
+
+    def clear(self):
+        """Forgets every failure"""
+        self._failures.clear()
+
+class SharedFailureLimiter:
+    """
+    Sliding window failure counters in DynamoDB, shared by every worker.
+
+    Failures are counted with a conditional ADD on one item per key and
+    fixed window, which expires through the table's ExpiresAt attribute.
+    The previous window's count is weighted by how much of it is still
+    inside the sliding window, so failures at the end of one window and the
+    start of the next can't add up to twice max_failures.
+    """
+
+    def __init__(self, table: AsyncTable, max_failures: int, window: float, clock=time.time):
+        self.table = table
+        self.max_failures = max_failures
+        self.window = window
+        self.clock = clock
+
+    def _windows(self, key: str) -> tuple:
+        """The current and previous window items of the key, and seconds into the current one"""
+        now = self.clock()
+        start = now - now % self.window
+        return f'{key}#{int(start)}', f'{key}#{int(start - self.window)}', now - start
+
+    async def _failures(self, limit_key: str) -> int:
+        response = await self.table.get_item(Key={"LimitKey": limit_key})
+        return int(response.get('Item', {}).get('Failures', 0))
+
+    def _unlocked_in(self, previous: int, current: int, elapsed: float) -> float:
+        """Seconds until previous failures weighted by their overlap, plus current ones, are under the limit"""
+        if current >= self.max_failures:
+            # Locked for the rest of this window, then until enough of it slides out
+            return self.window - elapsed + self.window * (1 - self.max_failures / current)
+        if previous * (1 - elapsed / self.window) + current < self.max_failures:
+            return 0
+        return self.window * (1 - (self.max_failures - current) / previous) - elapsed
+
+    async def retry_after(self, key: str) -> float:
+        """Returns the seconds until the key is unlocked, 0 if it isn't locked"""
+        current_key, previous_key, elapsed = self._windows(key)
+        previous, current = await asyncio.gather(
+            self._failures(previous_key), self._failures(current_key)
+        )
+        return max(0, self._unlocked_in(previous, current, elapsed))
+
+    async def acquire(self, key: str) -> tuple:
+        """
+        Counts an attempt against the key as a failure, raises TooManyAttempts
+        if it is locked. Returns the window item the attempt was counted in,
+        and the previous one if it holds failures too.
+        """
+        current_key, previous_key, elapsed = self._windows(key)
+        previous = await self._failures(previous_key)
+        # The previous window is closed, so only the current count can race
+        allowed = math.ceil(self.max_failures - previous * (1 - elapsed / self.window))
+        if allowed <= 0:
+            raise TooManyAttempts(self._unlocked_in(previous, 0, elapsed))
+        try:
+            await self.table.update_item(
+                Key={"LimitKey": current_key},
+                UpdateExpression="ADD Failures :one SET ExpiresAt = :expires",
+                ConditionExpression="attribute_not_exists(Failures) OR Failures < :allowed",
+                ExpressionAttributeValues={
+                    ":one": 1,
+                    ":allowed": allowed,
+                    # Kept while it is the previous window too
+                    ":expires": int(self.clock() - elapsed + 2 * self.window)
+                }
+            )
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            raise TooManyAttempts(await self.retry_after(key)) from err
+        return current_key, previous_key if previous else None
+
+    async def release(self, key: str, token: tuple, reset: bool = False):
+        """
+        Uncounts an attempt that didn't fail, from the window it was counted
+        in. With reset every failure of the key is forgotten instead, deleting
+        only the window items that held failures when it was counted.
+        """
+        current_key, previous_key = token
+        if reset:
+            await asyncio.gather(*[
+                self.table.delete_item(Key={"LimitKey": limit_key})
+                for limit_key in (current_key, previous_key) if limit_key
+            ])
+            return
+        try:
+            await self.table.update_item(
+                Key={"LimitKey": current_key},
+                UpdateExpression="ADD Failures :minus_one",
+                ConditionExpression="attribute_exists(LimitKey)",
+                ExpressionAttributeValues={":minus_one": -1}
+            )
+        except ClientError as err:
+            # Already reset or expired
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    async def reset(self, key: str):
+        """Forgets the failures of the key"""
+        current_key, previous_key, _ = self._windows(key)
+        await asyncio.gather(
+            self.table.delete_item(Key={"LimitKey": current_key}),
+            self.table.delete_item(Key={"LimitKey": previous_key})
+        )
+
+local_limiters = {
+    "user": FailureLimiter(LOGIN_MAX_FAILURES, LOGIN_WINDOW),
+    "ip": FailureLimiter(LOGIN_MAX_FAILURES_PER_IP, LOGIN_WINDOW)
+}
+shared_limiters = {}
+if LOGIN_SHARED_LIMITS:
+    _table = AsyncTable(lambda: get_rate_limits_table(RATE_LIMITS_TABLE))
+    shared_limiters = {
+        "user": SharedFailureLimiter(_table, LOGIN_MAX_FAILURES, LOGIN_WINDOW),
+        "ip": SharedFailureLimiter(_table, LOGIN_MAX_FAILURES_PER_IP, LOGIN_WINDOW)
+    }
+
+def _keys(limiters: dict, username: str, client_ip: str) -> list:
+    if not limiters:
+        return []
+    keys = [(limiters["user"], f'user:{username}')]
+    if client_ip:
+        keys.append((limiters["ip"], f'ip:{client_ip}'))
+    return keys
+
+async def _acquire(keys: list) -> list:
+    results = await asyncio.gather(*[limiter.acquire(key) for limiter, key in keys],
+                                   return_exceptions=True)
+    reservations = [(limiter, key, token) for (limiter, key), token in zip(keys, results)
+                    if not isinstance(token, BaseException)]
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        await release_login_attempt(reservations)
+        locked = [err.retry_after for err in errors if isinstance(err, TooManyAttempts)]
+        if len(locked) < len(errors):
+            raise next(err for err in errors if not isinstance(err, TooManyAttempts))
+        raise TooManyAttempts(max(locked))
+    return reservations
+
+async def reserve_login_attempt(username: str, client_ip: str = None) -> list:
+    """
+    Counts a login attempt as a failure against the username and client IP
+    before the password is checked, raises TooManyAttempts if either is
+    locked out. Returns the reservations to release if the login succeeds.
+    """
+    # The in-memory limiters answer without a round trip, so they are asked first
+    reservations = await _acquire(_keys(local_limiters, username, client_ip))
+    try:
+        return reservations + await _acquire(_keys(shared_limiters, username, client_ip))
+    except Exception:
+        await release_login_attempt(reservations)
+        raise
+
+async def release_login_attempt(reservations: list, reset: bool = False):
+    """
+    Uncounts a reserved login attempt that didn't fail. With reset, after a
+    successful login, the username's failures are cleared in the same write.
+    """
+    await asyncio.gather(*[
+        limiter.release(key, token, reset=reset and key.startswith('user:'))
+        for limiter, key, token in reservations
+    ])
+
+async def reset_login_failures(username: str):
+    """Clears the failures of a username after a successful login"""
+    keys = _keys(local_limiters, username, None) + _keys(shared_limiters, username, None)
+    await asyncio.gather(*[limiter.reset(key) for limiter, key in keys])
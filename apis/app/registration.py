@@ -2,7 +2,12 @@
 Tokens table tools
 """
 
+import os
 import uuid
+import time
+import functools
+import queue
+import threading
 from datetime import datetime
 
 import ssl
@@ -11,63 +16,213 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 from . import config
-from .dynamodb_tables import get_tokens_table
+from .outbox import Outbox
+from .metrics import SMTP_SEND_SECONDS, SMTP_SEND_FAILURES
+from .expiry import expires_at, is_expired
+from .storage import storage
 
-token_table = get_tokens_table(config.TOKENS_TABLE)
+# Seconds a confirmation or reset link can be used for
+REGISTRATION_LINK_TTL = getattr(config, 'REGISTRATION_LINK_TTL', 60 * 60 * 24 * 7)
+RESET_LINK_TTL = getattr(config, 'RESET_LINK_TTL', 60 * 60)
 
-def validate_access_key(access_key: str) -> str:
+SMTP_HOST = getattr(config, 'SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = getattr(config, 'SMTP_PORT', 465)
+
+async def validate_access_key(access_key: str) -> str:
     """Checks the access key against the DB"""
     if not access_key:
         return ''
-    response = token_table.get_item(Key={"AccessKey": access_key})
-    if "Item" in response:
-        username = response.get('Item', {}).get('UserName')
-        token_table.update_item(
-            Key={"AccessKey": access_key},
-            UpdateExpression="SET Valid = :valid, LastModified = :last_modified",
-            ExpressionAttributeValues={":valid": True, ":last_modified": str(datetime.utcnow())}
-        )
+    token = await storage.tokens.get(access_key)
+    if token and not is_expired(token):
+        username = token.get('UserName')
+        await storage.tokens.update(access_key, {
+            "Valid": True,
+            "LastModified": str(datetime.utcnow())
+        })
 
         return username
     return ''
 
-def get_registration_link(username: str) -> str:
+async def get_registration_link(username: str) -> str:
     """Gets a registration link for the user"""
     if not username:
         return ''
     access_key = str(uuid.uuid4())
-    token_table.put_item(Item={
+    await storage.tokens.put({
         "UserName": username,
         "AccessKey": access_key,
         "Valid": False,
         "Created": str(datetime.utcnow()),
-        "LastModified": str(datetime.utcnow())
+        "LastModified": str(datetime.utcnow()),
+        "ExpiresAt": expires_at(REGISTRATION_LINK_TTL)
     })
     return f'{config.APP_ORIGIN}/confirm_email?accessKey={access_key}'
 
-def get_reset_link(username: str) -> str:
+async def get_reset_link(username: str) -> str:
     """Gets a reset password link"""
     access_key = str(uuid.uuid4())
-    token_table.update_item(
-            Key={"AccessKey": access_key},
-            UpdateExpression="SET Valid = :valid, UserName = :username, LastModified = :last_modified",
-            ExpressionAttributeValues={
-                ":valid": False, ":username": username, ":last_modified": str(datetime.utcnow())
-            }
-        )
+    await storage.tokens.update(access_key, {
+        "Valid": False,
+        "UserName": username,
+        "LastModified": str(datetime.utcnow()),
+        "ExpiresAt": expires_at(RESET_LINK_TTL)
+    })
     return f'{config.APP_ORIGIN}/set_new_password?accessKey={access_key}'
 
-def send_reset_password_email(recipient: str) -> bool:
-    """Sends a password reset email to the recipient"""
+class MailTransport:
+    """Interface for the ways emails can be sent"""
+
+    def send(self, sender: str, recipient: str, message: str):
+        """Sends a message"""
+        raise NotImplementedError
+
+    def close(self):
+        """Releases any open connections"""
+
+class SMTPTransport(MailTransport):
+    """
+    Pool of authenticated SMTP connections.
+
+    Connections are reused across messages and share one SSL context.
+    Idle connections are checked with NOOP before reuse and replaced after
+    max_messages messages or when the server drops them.
+    """
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 username: str,
+                 password: str,
+                 pool_size: int = 2,
+                 max_messages: int = 100,
+                 keepalive: float = 30.0,
+                 timeout: float = 30.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_messages = max_messages
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    @functools.cached_property
+    def context(self) -> ssl.SSLContext:
+        """SSL context shared by every connection, created on first use"""
+        return ssl.create_default_context()
+
+    def _connect(self) -> dict:
+        server = smtplib.SMTP_SSL(self.host, self.port, context=self.context, timeout=self.timeout)
+        server.login(self.username, self.password)
+        return {"server": server, "sent": 0, "last_used": time.monotonic()}
+
+    @staticmethod
+    def _disconnect(connection: dict):
+        try:
+            connection['server'].quit()
+        except (smtplib.SMTPException, OSError):
+            connection['server'].close()
+
+    def _is_alive(self, connection: dict) -> bool:
+        if time.monotonic() - connection['last_used'] < self.keepalive:
+            return True
+        try:
+            return connection['server'].noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _checkout(self) -> dict:
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if self._is_alive(connection):
+                return connection
+            self._disconnect(connection)
+
+    def _checkin(self, connection: dict):
+        connection['sent'] += 1
+        connection['last_used'] = time.monotonic()
+        if connection['sent'] >= self.max_messages:
+            self._disconnect(connection)
+        else:
+            self._idle.put(connection)
+
+    def send(self, sender: str, recipient: str, message: str):
+        """Sends a message, reconnecting once if the connection was dropped"""
+        with self._slots:
+            connection = self._checkout()
+            try:
+                connection['server'].sendmail(sender, recipient, message)
+            except (smtplib.SMTPServerDisconnected, OSError):
+                # The server dropped the connection, try once more on a new one
+                self._disconnect(connection)
+                connection = self._connect()
+                try:
+                    connection['server'].sendmail(sender, recipient, message)
+                except (smtplib.SMTPException, OSError):
+                    self._disconnect(connection)
+                    raise
+            except smtplib.SMTPException:
+                self._disconnect(connection)
+                raise
+            self._checkin(connection)
+
+    def close(self):
+        """Closes every idle connection"""
+        while True:
+            try:
+                self._disconnect(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+transport = SMTPTransport(
+    SMTP_HOST,
+    SMTP_PORT,
+    config.SERVICE_EMAIL,
+    config.EMAIL_PW,
+    pool_size=getattr(config, 'SMTP_POOL_SIZE', getattr(config, 'OUTBOX_WORKERS', 2)),
+    max_messages=getattr(config, 'SMTP_MAX_MESSAGES_PER_CONNECTION', 100)
+)
+
+def deliver_email(email: dict):
+    """Sends an email from the outbox"""
     sender_email = config.SERVICE_EMAIL
-    password = config.EMAIL_PW
 
     message = MIMEMultipart("alternative")
-    message["Subject"] = "Reset password request"
+    message["Subject"] = email['subject']
     message["From"] = sender_email
-    message["To"] = recipient
+    message["To"] = email['recipient']
+
+    # Turn these into plain/html MIMEText objects
+    part1 = MIMEText(email['text'], "plain")
+    part2 = MIMEText(email['html'], "html")
+
+    # Add HTML/plain-text parts to MIMEMultipart message
+    # The email client will try to render the last part first
+    message.attach(part1)
+    message.attach(part2)
+
+    with SMTP_SEND_SECONDS.time(), SMTP_SEND_FAILURES.count_exceptions():
+        transport.send(sender_email, email['recipient'], message.as_string())
 
-    reset_link = get_reset_link(recipient)
+# Emails queued on this node, kept on a volume that outlives the container.
+# The environment wins so a container image can point it at its mount.
+OUTBOX_PATH = os.environ.get('OUTBOX_PATH', getattr(config, 'OUTBOX_PATH', 'outbox.db'))
+
+outbox = Outbox(
+    OUTBOX_PATH,
+    deliver_email,
+    workers=getattr(config, 'OUTBOX_WORKERS', 2),
+    max_attempts=getattr(config, 'OUTBOX_MAX_ATTEMPTS', 5),
+    claim_timeout=getattr(config, 'OUTBOX_CLAIM_TIMEOUT', 300)
+)
+
+async def send_reset_password_email(recipient: str) -> bool:
+    """Queues a password reset email to the recipient"""
+    reset_link = await get_reset_link(recipient)
 
     # Create the plain-text and HTML version of your message
     text = f"""
@@ -87,36 +242,13 @@ def send_reset_password_email(recipient: str) -> bool:
     </html>
     """
 
-    # Turn these into plain/html MIMEText objects
-    part1 = MIMEText(text, "plain")
-    part2 = MIMEText(html, "html")
-
-    # Add HTML/plain-text parts to MIMEMultipart message
-    # The email client will try to render the last part first
-    message.attach(part1)
-    message.attach(part2)
-
-    # Create secure connection with server and send email
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
-        server.login(sender_email, password)
-        server.sendmail(
-            sender_email, recipient, message.as_string()
-        )
+    await outbox.enqueue(recipient, "Reset password request", text, html)
     return True
 
-def send_registration_email(recipient: str) -> bool:
-    """Sends a registration email to the recipient"""
-    sender_email = config.SERVICE_EMAIL
-    password = config.EMAIL_PW
-
-    message = MIMEMultipart("alternative")
-    message["Subject"] = "Please confirm your email address"
-    message["From"] = sender_email
-    message["To"] = recipient
-
+async def send_registration_email(recipient: str) -> bool:
+    """Queues a registration email to the recipient"""
     # this method creates the user record
-    registration_link = get_registration_link(recipient)
+    registration_link = await get_registration_link(recipient)
 
     # Create the plain-text and HTML version of your message
     text = f"""
@@ -136,20 +268,5 @@ def send_registration_email(recipient: str) -> bool:
     </html>
     """
 
-    # Turn these into plain/html MIMEText objects
-    part1 = MIMEText(text, "plain")
-    part2 = MIMEText(html, "html")
-
-    # Add HTML/plain-text parts to MIMEMultipart message
-    # The email client will try to render the last part first
-    message.attach(part1)
-    message.attach(part2)
-
-    # Create secure connection with server and send email
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
-        server.login(sender_email, password)
-        server.sendmail(
-            sender_email, recipient, message.as_string()
-        )
+    await outbox.enqueue(recipient, "Please confirm your email address", text, html)
     return True
@@ -0,0 +1,126 @@
+"""
+Per request DynamoDB accounting
+"""
+
+import time
+import threading
+import contextlib
+from contextvars import ContextVar
+from collections import Counter
+
+from . import logger
+
+_current = ContextVar('request_stats', default=None)
+
+class RequestStats:
+    """DynamoDB calls, time and consumed capacity of one request"""
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.capacity = 0.0
+        self.operations = Counter()
+        # Calls are made from the DynamoDB executor threads
+        self._lock = threading.Lock()
+
+    def record(self, operation: str, seconds: float, capacity: float, attempts: int = 1):
+        """Adds one call, made in attempts round trips"""
+        with self._lock:
+            self.calls += attempts
+            self.seconds += seconds
+            self.capacity += capacity
+            self.operations[operation] += attempts
+
+    def server_timing(self, total: float) -> str:
+        """Formats the stats as a Server-Timing header"""
+        return (
+            f'dynamodb;dur={self.seconds * 1000:.1f};desc="{self.calls} calls", '
+            f'capacity;desc="{self.capacity:g} units", '
+            f'app;dur={total * 1000:.1f}'
+        )
+
+def current_request_stats():
+    """The stats of the request being handled, if any"""
+    return _current.get()
+
+@contextlib.contextmanager
+def track():
+    """Collects the stats of the DynamoDB calls made inside the block"""
+    stats = RequestStats()
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+def _consumed(parsed: dict) -> float:
+    consumed = parsed.get('ConsumedCapacity', [])
+    # Single item operations return one entry, batches and transactions a list
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    return sum(entry.get('CapacityUnits', 0) for entry in consumed)
+
+def _before_parameter_build(params: dict, model, context: dict, **kwargs):
+    if _current.get() is None:
+        return
+    context['stats_started'] = time.perf_counter()
+    if 'ReturnConsumedCapacity' in model.input_shape.members:
+        params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+
+def _attempts(context: dict) -> int:
+    # botocore counts the attempts of a call, retries included, in the request context
+    return context.get('retries', {}).get('attempt', 1)
+
+def _after_call(parsed: dict, model, context: dict, **kwargs):
+    stats = _current.get()
+    started = context.get('stats_started')
+    if stats is None or started is None:
+        return
+    stats.record(model.name, time.perf_counter() - started, _consumed(parsed), _attempts(context))
+
+def _after_call_error(exception, context: dict, event_name: str = '', **kwargs):
+    # Calls that got no response, the operation is the last part of the event name
+    stats = _current.get()
+    started = context.get('stats_started')
+    if stats is None or started is None:
+        return
+    stats.record(event_name.rsplit('.', 1)[-1], time.perf_counter() - started, 0,
+                 _attempts(context))
+
+def instrument_dynamodb(client):
+    """Accounts the calls made through a botocore DynamoDB client to the current request"""
+    events = client.meta.events
+    events.register('before-parameter-build.dynamodb', _before_parameter_build,
+                    unique_id='request-stats-before-parameter-build')
+    events.register('after-call.dynamodb', _after_call, unique_id='request-stats-after-call')
+    events.register('after-call-error.dynamodb', _after_call_error,
+                    unique_id='request-stats-after-call-error')
+
+class RequestStatsMiddleware:
+    """ASGI middleware adding each request's DynamoDB stats to a Server-Timing header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        with track() as stats:
+            async def send_wrapper(message):
+                if message['type'] == 'http.response.start':
+                    header = stats.server_timing(time.perf_counter() - started)
+                    message['headers'] = [
+                        *message.get('headers', []), (b'server-timing', header.encode())
+                    ]
+                await send(message)
+
+            await self.app(scope, receive, send_wrapper)
+
+        if stats.calls:
+            logger.info('%s %s: %s DynamoDB calls (%s), %g capacity units, %.1f ms',
+                        scope['method'], scope['path'], stats.calls,
+                        ', '.join(f'{op} x{count}' for op, count in stats.operations.items()),
+                        stats.capacity, stats.seconds * 1000)
@@ -0,0 +1,162 @@
+"""
+Precomputed user activity rollups
+
+A job reads the Users table once with a parallel segmented scan of only
+the attributes it counts, and saves the counts to a single rollup item
+that the API serves with one read. Run it from cron or a scheduled task,
+or set ROLLUP_INTERVAL to run it in the app, where one worker process
+claims each interval's run through a counter.
+
+    cd apis && python -m app.rollups --segments 8
+"""
+
+import json
+import time
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+from collections import Counter
+
+from . import config
+from . import logger
+from .cache import TTLCache
+from .storage import storage, CounterExhausted
+
+# Parallel scan segments, each read by its own executor thread
+ROLLUP_SEGMENTS = getattr(config, 'ROLLUP_SEGMENTS', 4)
+# Seconds between rollups computed in the app, 0 to leave it to a scheduled job
+ROLLUP_INTERVAL = getattr(config, 'ROLLUP_INTERVAL', 0)
+
+USER_ROLLUP = "users"
+# Counter holding the last interval a worker claimed the rollup of
+ROLLUP_CLAIM = "UserRollupRun"
+# The only attributes the scan reads
+USER_ATTRIBUTES = ["LastLogin", "AuthRole"]
+# Days of last logins kept in the rollup
+ACTIVITY_DAYS = 30
+ACTIVE_WINDOWS = (1, 7, 30)
+
+# Rollups change once per job, so each process reads them at most once a minute
+rollup_cache = TTLCache(maxsize=8, ttl=60, negative_ttl=5)
+
+class UserActivity:
+    """Counts of users, folded in one at a time and merged across segments"""
+
+    def __init__(self, today):
+        self.today = today
+        # LastLogin is str(datetime.utcnow()), so its first 10 characters are the day
+        self.first_day = str(today - timedelta(days=ACTIVITY_DAYS - 1))
+        self.total = 0
+        self.unconfirmed = 0
+        self.roles = Counter()
+        self.last_logins = Counter()
+
+    def add(self, user: dict):
+        """Counts one user"""
+        self.total += 1
+        role = user.get('AuthRole')
+        # Confirming the email address is what gives a user a role
+        if role:
+            self.roles[role] += 1
+        else:
+            self.unconfirmed += 1
+        day = user.get('LastLogin', '')[:10]
+        if day >= self.first_day:
+            self.last_logins[day] += 1
+
+    def merge(self, other: 'UserActivity'):
+        """Adds the counts of another segment"""
+        self.total += other.total
+        self.unconfirmed += other.unconfirmed
+        self.roles.update(other.roles)
+        self.last_logins.update(other.last_logins)
+
+    def summary(self) -> dict:
+        """The counts as a rollup item"""
+        active = {}
+        for days in ACTIVE_WINDOWS:
+            since = str(self.today - timedelta(days=days - 1))
+            active[f'{days}d'] = sum(
+                count for day, count in self.last_logins.items() if day >= since
+            )
+        return {
+            "Total": self.total,
+            "Unconfirmed": self.unconfirmed,
+            "Roles": dict(self.roles),
+            "Active": active,
+            "LastLoginsByDay": dict(sorted(self.last_logins.items()))
+        }
+
+async def _scan_segment(segment: int, segments: int, today) -> UserActivity:
+    activity = UserActivity(today)
+    async for page in storage.users.scan(segment, segments, USER_ATTRIBUTES):
+        for user in page:
+            activity.add(user)
+    return activity
+
+async def compute_user_rollup(segments: int = ROLLUP_SEGMENTS) -> dict:
+    """Counts the users and saves the rollup"""
+    started = time.perf_counter()
+    today = datetime.utcnow().date()
+    activity = UserActivity(today)
+    for segment in await asyncio.gather(*[
+        _scan_segment(segment, segments, today) for segment in range(segments)
+    ]):
+        activity.merge(segment)
+
+    rollup = {
+        "RollupId": USER_ROLLUP,
+        **activity.summary(),
+        "ComputedAt": str(datetime.utcnow()),
+        "DurationMs": int((time.perf_counter() - started) * 1000)
+    }
+    await storage.rollups.put(rollup)
+    rollup_cache.set(USER_ROLLUP, rollup)
+    logger.info('Computed user rollup of %s users in %s ms', rollup["Total"], rollup["DurationMs"])
+    return rollup
+
+async def get_user_rollup() -> dict:
+    """The last user rollup computed, or None if there is none yet"""
+    hit, rollup = rollup_cache.lookup(USER_ROLLUP)
+    if not hit:
+        rollup = await storage.rollups.get(USER_ROLLUP) or None
+        rollup_cache.set(USER_ROLLUP, rollup)
+    return rollup
+
+async def claim_rollup(interval: float) -> bool:
+    """Claims the rollup of the current interval, True for only one worker process"""
+    run = int(time.time() // interval)
+    counter = await storage.counters.get(ROLLUP_CLAIM, consistent=True)
+    claimed = int(counter.get('CounterValue', 0))
+    if claimed >= run:
+        return False
+    try:
+        # The limit makes the add fail unless the counter still holds what was read
+        await storage.counters.add(ROLLUP_CLAIM, run - claimed, run)
+    except CounterExhausted:
+        return False
+    return True
+
+async def rollup_forever(interval: float):
+    """Computes the user rollup every interval seconds in whichever worker claims it first"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await claim_rollup(interval):
+                await compute_user_rollup()
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warning('Error computing the user rollup: %s', err)
+
+def main():
+    """Computes the user rollup once"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--segments', type=int, default=ROLLUP_SEGMENTS)
+    args = parser.parse_args()
+
+    storage.start()
+    rollup = asyncio.run(compute_user_rollup(args.segments))
+    print(json.dumps(rollup, indent=2, default=str))
+
+if __name__ == '__main__':
+    main()
@@ -2,63 +2,163 @@
 Sessions table tools
 """
 
+import time
 import uuid
 from datetime import datetime
 
 from . import config
-from .user import get_user, set_user_auth
-from .dynamodb_tables import get_sessions_table
+from . import logger
+from .user import get_user, set_user_auth, last_logins
+from .storage import storage, RotationConflict, SessionMissing
+from .unit_of_work import current_unit_of_work
+from .cache import TTLCache
+from .expiry import expires_at, is_expired
+from .session_tokens import issue_token, read_token, verify_token, revocations
 
-sessions_table = get_sessions_table(config.SESSIONS_TABLE)
+# 'table' keeps a row per session in the Sessions table, 'signed' issues
+# HMAC-signed tokens that are verified without reading the Sessions table,
+# only the cached revocations.
+SESSION_MODE = getattr(config, 'SESSION_MODE', 'table')
+
+# Seconds a session lasts, expired rows are deleted by the table's TTL
+SESSION_TTL = getattr(config, 'SESSION_TTL', 60 * 60 * 24)
+
+# How many times a session rotation is retried when it races another one
+ROTATION_ATTEMPTS = 3
+
+# Session lookups are cached per process. Changes made by this process are
+# applied to the cache immediately, other processes see them within the TTL.
+session_cache = TTLCache(
+    maxsize=getattr(config, 'SESSION_CACHE_SIZE', 10000),
+    ttl=getattr(config, 'SESSION_CACHE_TTL', 30),
+    negative_ttl=getattr(config, 'SESSION_CACHE_NEGATIVE_TTL', 5)
+)
+
+async def new_signed_session(username: str):
+    """Issue a signed session token, revoking the previous one"""
+    user = await get_user(username)
+    claims = read_token(user.get('AuthKey', ''))
+    if claims:
+        await revocations.revoke(claims)
+
+    session_key = issue_token(username, user.get('AuthRole', ''))
+    await set_user_auth(username, session_key)
+
+    return session_key
 
 async def new_session(username: str):
     """Create a new session"""
-    session_key = get_user(username).get('AuthKey')
-    if session_key:
-        # check if the session is in use
-        response = sessions_table.get_item(
-            Key={"SessionKey": session_key}
-        ).get('Item', {})
-
-        if response.get('Active'):
-            sessions_table.update_item(
-                Key={"SessionKey": session_key},
-                UpdateExpression="SET Active = :active, LastModified = :last_modified",
-                ExpressionAttributeValues={":active": False, ":last_modified": str(datetime.utcnow())},
-            )
-    
+    if SESSION_MODE == 'signed':
+        return await new_signed_session(username)
+
+    # The previous key comes from the request's unit of work when the
+    # caller has already read the user, so rotating costs a single write
+    previous_key = (await get_user(username)).get('AuthKey')
+    unit_of_work = current_unit_of_work()
+    staged = unit_of_work.take_pending(username) if unit_of_work else {}
+
     session_key = str(uuid.uuid4())
-    sessions_table.put_item(Item={
+    now = str(datetime.utcnow())
+    session = {
         "SessionKey": session_key,
         "UserName": username,
         "Active": True,
-        "Created": str(datetime.utcnow()),
-        "LastModified": str(datetime.utcnow())
-    })
+        "Created": now,
+        "LastModified": now,
+        "CreatedAt": int(time.time()),
+        "ExpiresAt": expires_at(SESSION_TTL)
+    }
+    # The rotation sets LastLogin, so a buffered one doesn't need a write of its own
+    last_logins.take(username)
+    user_attrs = {
+        **staged,
+        "LastLogin": now,
+        "AuthKey": session_key,
+        "Valid": True
+    }
 
-    await set_user_auth(username, session_key)
+    # Sessions this process already retired or deleted don't need retiring again
+    retire = session_cache.lookup(previous_key) != (True, None) if previous_key else True
+    for attempt in range(ROTATION_ATTEMPTS):
+        try:
+            await storage.rotate_session(username, previous_key, session, user_attrs, retire)
+            break
+        except SessionMissing:
+            if attempt == ROTATION_ATTEMPTS - 1:
+                raise
+            # The previous session row is gone, there is nothing to retire
+            logger.warning('Session %s missing while rotating for %s', previous_key, username)
+            retire = False
+        except RotationConflict:
+            if attempt == ROTATION_ATTEMPTS - 1:
+                raise
+            # Another request rotated the session first, start from its key
+            previous_key = (await storage.users.get(username, consistent=True)).get('AuthKey')
+            retire = True
+
+    if previous_key:
+        session_cache.set(previous_key, None)
+    session_cache.set(session_key, username)
+    if unit_of_work:
+        unit_of_work.apply(username, user_attrs)
 
     return session_key
 
-def validate_session_key(session_key: str):
+async def validate_session_key(session_key: str):
     """Verify the session key is active"""
-    response = sessions_table.get_item(
-        Key={"SessionKey": session_key}
-    ).get('Item', {})
+    if SESSION_MODE == 'signed':
+        claims = await verify_token(session_key)
+        return claims['sub'] if claims else None
 
-    if response.get('Active'):
-        return response.get('UserName')
-    return None
+    hit, username = session_cache.lookup(session_key)
+    if hit:
+        return username
+
+    response = await storage.sessions.get(session_key)
 
-def invalidate_session(session_key: str):
+    active = response.get('Active') and not is_expired(response)
+    username = response.get('UserName') if active else None
+    session_cache.set(session_key, username)
+    return username
+
+async def invalidate_session(session_key: str):
     """Set the session key to inactive"""
-    response = sessions_table.get_item(
-        Key={"SessionKey": session_key}
-    ).get('Item', {})
+    if SESSION_MODE == 'signed':
+        claims = read_token(session_key)
+        if claims:
+            await revocations.revoke(claims)
+        return
+
+    response = await storage.sessions.get(session_key)
 
     if response.get('Active'):
-        sessions_table.update_item(
-            Key={"SessionKey": session_key},
-            UpdateExpression="SET Active = :active, LastModified = :last_modified",
-            ExpressionAttributeValues={":active": False, ":last_modified": str(datetime.utcnow())}
-        )
+        await storage.sessions.update(session_key, {
+            "Active": False,
+            "LastModified": str(datetime.utcnow())
+        })
+    session_cache.set(session_key, None)
+
+async def list_user_sessions(username: str) -> list:
+    """Lists the user's active sessions, newest first"""
+    return await storage.sessions.list_for_user(username)
+
+async def count_user_sessions(username: str) -> int:
+    """Counts the user's active sessions"""
+    return await storage.sessions.count_for_user(username)
+
+async def revoke_user_sessions(username: str) -> int:
+    """Invalidate every session of the user, e.g. after a password change"""
+    if SESSION_MODE == 'signed':
+        await revocations.revoke_user(username)
+        return 0
+
+    session_keys = [session['SessionKey'] for session in await list_user_sessions(username)]
+    # The index is eventually consistent, so the current session is always included
+    current_key = (await get_user(username)).get('AuthKey')
+    if current_key and current_key not in session_keys:
+        session_keys.append(current_key)
+
+    await storage.sessions.delete_many(session_keys)
+    for session_key in session_keys:
+        session_cache.set(session_key, None)
+    return len(session_keys)
@@ -0,0 +1,131 @@
+"""
+Signed session tokens
+"""
+
+import hmac
+import json
+import time
+import uuid
+import base64
+import asyncio
+import hashlib
+
+from . import config
+from .cache import TTLCache
+from .storage import storage
+
+TOKEN_TTL = getattr(config, 'SESSION_TOKEN_TTL', 60 * 60 * 24)
+
+# Shortest SESSION_SECRET accepted, 32 characters of a random key is 128+ bits
+MIN_SECRET_LENGTH = 32
+
+# Revocation lookups are cached per process, revocations made by other
+# processes apply within the TTL
+REVOCATION_CACHE_SIZE = getattr(config, 'REVOCATION_CACHE_SIZE', 10000)
+REVOCATION_CACHE_TTL = getattr(config, 'REVOCATION_CACHE_TTL', 5)
+
+def _encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def _decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def _sign(payload: str) -> str:
+    secret = config.SESSION_SECRET.encode()
+    return _encode(hmac.new(secret, payload.encode(), hashlib.sha256).digest())
+
+def check_secret():
+    """Raises ValueError unless SESSION_SECRET is long enough to sign tokens with"""
+    secret = getattr(config, 'SESSION_SECRET', None)
+    if not isinstance(secret, str) or len(secret) < MIN_SECRET_LENGTH:
+        raise ValueError(f'SESSION_SECRET must be at least {MIN_SECRET_LENGTH} characters '
+                         'in signed session mode')
+
+class RevocationList:
+    """
+    Tokens revoked before they expire, shared by every process.
+
+    Single tokens are kept by id and whole users by a cut-off time, each an
+    item in the revocations repository that expires once every token it
+    could match has expired. Lookups are cached per process, so this
+    process's revocations apply at once and other processes' within
+    cache_ttl seconds.
+    """
+
+    def __init__(self, ttl: float = TOKEN_TTL, cache: TTLCache = None):
+        self.ttl = ttl
+        if cache is None:
+            cache = TTLCache(maxsize=REVOCATION_CACHE_SIZE, ttl=REVOCATION_CACHE_TTL)
+        self.cache = cache
+
+    async def _get(self, key: str) -> dict:
+        hit, item = self.cache.lookup(key)
+        if not hit:
+            item = await storage.revocations.get(key)
+            self.cache.set(key, item)
+        return item
+
+    async def _put(self, item: dict):
+        await storage.revocations.put(item)
+        self.cache.set(item["RevocationKey"], item)
+
+    async def revoke(self, claims: dict):
+        """Revokes a single token"""
+        await self._put({"RevocationKey": f'token:{claims["jti"]}', "ExpiresAt": claims['exp']})
+
+    async def revoke_user(self, username: str):
+        """Revokes every token issued to the user until now"""
+        now = time.time()
+        await self._put({
+            "RevocationKey": f'user:{username}',
+            # Microseconds, as DynamoDB doesn't take floats
+            "RevokedAt": int(now * 1e6),
+            "ExpiresAt": int(now + self.ttl) + 1
+        })
+
+    async def is_revoked(self, claims: dict) -> bool:
+        """Checks the claims of a token against the list"""
+        token, user = await asyncio.gather(
+            self._get(f'token:{claims["jti"]}'), self._get(f'user:{claims["sub"]}')
+        )
+        return bool(token) or claims['iat'] * 1e6 < user.get('RevokedAt', 0)
+
+    def clear(self):
+        """Drops every cached lookup"""
+        self.cache.clear()
+
+revocations = RevocationList()
+
+def issue_token(username: str, role: str, ttl: float = TOKEN_TTL) -> str:
+    """Issues a signed token for the user"""
+    now = time.time()
+    claims = {
+        "sub": username,
+        "role": role,
+        "iat": now,
+        "exp": int(now + ttl),
+        "jti": uuid.uuid4().hex
+    }
+    payload = _encode(json.dumps(claims, separators=(',', ':')).encode())
+    return f'{payload}.{_sign(payload)}'
+
+def read_token(token: str):
+    """Returns the claims of a correctly signed token, expired or not"""
+    try:
+        payload, signature = token.split('.')
+    except (AttributeError, ValueError):
+        return None
+    if not hmac.compare_digest(signature.encode(), _sign(payload).encode()):
+        return None
+    try:
+        claims = json.loads(_decode(payload))
+    except ValueError:
+        return None
+    return claims if isinstance(claims, dict) else None
+
+async def verify_token(token: str):
+    """Returns the claims of a signed, unexpired and unrevoked token"""
+    claims = read_token(token)
+    if not claims or claims['exp'] <= time.time() or await revocations.is_revoked(claims):
+        return None
+    return claims
@@ -0,0 +1,109 @@
+"""
+App startup and shutdown
+"""
+
+import time
+import asyncio
+import contextlib
+
+from . import config
+from . import logger
+
+# Connections opened to DynamoDB before the worker takes traffic, 0 to skip
+PREWARM_CONNECTIONS = getattr(config, 'DYNAMODB_PREWARM_CONNECTIONS', 4)
+# Seconds between calls that keep the warm connections open, 0 to skip
+KEEPALIVE_INTERVAL = getattr(config, 'DYNAMODB_KEEPALIVE_INTERVAL', 60)
+
+async def prewarm_connections(count: int):
+    """Opens count pooled HTTPS connections to DynamoDB"""
+    # pylint: disable=import-outside-toplevel
+    from .async_table import run_blocking
+    from .dynamodb_tables import get_resource
+
+    client = get_resource().meta.client
+    # Concurrent calls can't share a connection, so each one opens its own
+    await asyncio.gather(*[run_blocking(client.describe_endpoints) for _ in range(count)])
+
+async def keep_connections_alive(count: int, interval: float):
+    """Uses the warm connections periodically so they aren't closed as idle"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await prewarm_connections(count)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warning('Error keeping DynamoDB connections alive: %s', err)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Initializes the app before it accepts requests and cleans up after"""
+    # pylint: disable=import-outside-toplevel
+    from .async_table import run_blocking
+    from .expiry import SWEEP_INTERVAL, sweep_expired, sweep_forever
+    from .rollups import ROLLUP_INTERVAL, rollup_forever
+    from .queries import query_buffer
+    from .storage import storage, STORAGE_BACKEND
+    from .rate_limit import shared_limiters
+    from .registration import outbox, transport
+    from .user import password_hasher, last_logins
+    from .session import SESSION_MODE
+    from .session_tokens import check_secret
+
+    report = {}
+    started = time.perf_counter()
+
+    def phase(name: str, since: float) -> float:
+        now = time.perf_counter()
+        report[name] = round((now - since) * 1000, 1)
+        return now
+
+    # Fail before taking traffic rather than on the first login
+    if SESSION_MODE == 'signed':
+        check_secret()
+
+    await run_blocking(storage.start)
+    mark = phase('tables_ms', started)
+
+    keepalive = None
+    if PREWARM_CONNECTIONS and (STORAGE_BACKEND == 'dynamodb' or shared_limiters):
+        await prewarm_connections(PREWARM_CONNECTIONS)
+        if KEEPALIVE_INTERVAL:
+            keepalive = asyncio.create_task(
+                keep_connections_alive(PREWARM_CONNECTIONS, KEEPALIVE_INTERVAL)
+            )
+    mark = phase('prewarm_ms', mark)
+
+    await outbox.start()
+    mark = phase('outbox_ms', mark)
+
+    await last_logins.start()
+    await query_buffer.start()
+
+    sweeper = None
+    if SWEEP_INTERVAL:
+        sweeps = {"tokens and sessions": storage.sweep_expired}
+        if shared_limiters:
+            table = shared_limiters["user"].table
+            sweeps["rate limits"] = lambda: run_blocking(sweep_expired, table.table)
+        sweeper = asyncio.create_task(sweep_forever(sweeps, SWEEP_INTERVAL))
+
+    rollup = None
+    if ROLLUP_INTERVAL:
+        rollup = asyncio.create_task(rollup_forever(ROLLUP_INTERVAL))
+
+    phase('total_ms', started)
+    app.state.startup_report = report
+    logger.info('Startup report: %s', report)
+
+    yield
+
+    for task in (keepalive, sweeper, rollup):
+        if task:
+            task.cancel()
+    # Unsent emails are kept in the outbox for the next start
+    await outbox.stop()
+    transport.close()
+    password_hasher.shutdown()
+    # Buffered LastLogin updates and queries are written before the storage closes
+    await last_logins.stop()
+    await query_buffer.stop()
+    storage.close()
@@ -0,0 +1,167 @@
+"""
+Storage backends
+"""
+
+from . import config
+
+# 'dynamodb', 'sqlite' for a single node, or 'memory' for tests and demos
+STORAGE_BACKEND = getattr(config, 'STORAGE_BACKEND', 'dynamodb')
+SQLITE_PATH = getattr(config, 'SQLITE_PATH', 'auth.db')
+
+class RotationConflict(Exception):
+    """Raised when the user's session changed since it was read"""
+
+class SessionMissing(Exception):
+    """Raised when the session being retired doesn't exist"""
+
+class CounterExhausted(Exception):
+    """Raised when adding to a counter would take it past its limit"""
+
+class Repository:
+    """Items of one kind, keyed by a single attribute"""
+
+    async def get(self, key, consistent: bool = False) -> dict:
+        """Returns the item, or an empty dict if there is none"""
+        raise NotImplementedError
+
+    async def put(self, item: dict):
+        """Writes the whole item, replacing any existing one"""
+        raise NotImplementedError
+
+    async def update(self, key, attrs: dict):
+        """Sets the attributes on the item, creating it if it doesn't exist"""
+        raise NotImplementedError
+
+    def scan(self, segment: int = 0, total_segments: int = 1, attributes: list = None):
+        """
+        Async iterator over pages of the items in one of total_segments
+        disjoint segments, so segments can be read in parallel. Only the
+        given attributes are read, if any.
+        """
+        raise NotImplementedError
+
+class SessionRepository(Repository):
+    """Sessions, which can also be looked up by user"""
+
+    async def list_for_user(self, username: str) -> list:
+        """Lists the user's active, unexpired sessions, newest first"""
+        raise NotImplementedError
+
+    async def count_for_user(self, username: str) -> int:
+        """Counts the user's active, unexpired sessions"""
+        raise NotImplementedError
+
+    async def delete_many(self, keys: list):
+        """Deletes the sessions with the given keys"""
+        raise NotImplementedError
+
+class QueryRepository(Repository):
+    """Queries, which are also written in batches and read back by user"""
+
+    async def put_many(self, items: list):
+        """Writes the items in as few requests as the backend allows"""
+        raise NotImplementedError
+
+    async def page_for_user(self, username: str, limit: int, after: dict = None) -> tuple:
+        """
+        Returns up to limit of the user's queries, newest first, and whether
+        there are more. after is the CreatedAt and QueryId of the last query
+        of the previous page.
+        """
+        raise NotImplementedError
+
+class FlagRepository(Repository):
+    """Flagged documents, one item per document however often it is flagged"""
+
+    async def flag(self, flagged_id: int, attrs: dict) -> dict:
+        """
+        Atomically sets attrs on the flag and adds one to its FlagCount,
+        creating it if it doesn't exist. FirstFlaggedAt is set from
+        LastFlaggedAt the first time, and flagging a resolved document
+        removes ResolvedAt and ResolvedBy. Returns the updated item.
+        """
+        raise NotImplementedError
+
+    async def page_by_status(self, status: str, limit: int, after: dict = None) -> tuple:
+        """
+        Returns up to limit flags with the status, most recently flagged
+        first, and whether there are more. after is the LastFlaggedAt and
+        FlaggedId of the last flag of the previous page.
+        """
+        raise NotImplementedError
+
+    async def resolve_many(self, flagged_ids: list, attrs: dict) -> list:
+        """
+        Sets Status to resolved and attrs on the flags that are open,
+        returns the FlaggedIds that were resolved.
+        """
+        raise NotImplementedError
+
+class CounterRepository(Repository):
+    """Named counters, keyed by CounterName"""
+
+    async def add(self, name: str, amount: int, limit: int) -> int:
+        """
+        Atomically adds amount to the counter, which starts at 0, and returns
+        its new value. Raises CounterExhausted instead if that is past limit.
+        """
+        raise NotImplementedError
+
+class Storage:
+    """
+    A backend's repositories for users, tokens, sessions, queries, flagged
+    docs, rollups, counters and revoked session tokens, and the operations
+    that span more than one of them.
+    """
+
+    users: Repository
+    tokens: Repository
+    sessions: SessionRepository
+    queries: QueryRepository
+    flagged_docs: FlagRepository
+    rollups: Repository
+    counters: CounterRepository
+    revocations: Repository
+
+    # Exceptions a failed read or write can raise, for handlers to catch
+    errors: tuple = ()
+
+    async def rotate_session(self,
+                             username: str,
+                             previous_key: str,
+                             session: dict,
+                             user_attrs: dict,
+                             retire: bool = True):
+        """
+        Atomically retires the previous session, writes the new one and sets
+        user_attrs on the user, provided the user's AuthKey is still
+        previous_key. Raises RotationConflict if it isn't and SessionMissing
+        if retire is set and the previous session doesn't exist.
+        """
+        raise NotImplementedError
+
+    def start(self):
+        """Creates the tables or schema the backend needs"""
+
+    async def sweep_expired(self) -> int:
+        """Deletes expired tokens, sessions and revocations, returns how many were deleted"""
+        return 0
+
+    def close(self):
+        """Releases connections"""
+
+def create_storage(backend: str = STORAGE_BACKEND) -> Storage:
+    """Builds the configured backend"""
+    # pylint: disable=import-outside-toplevel
+    if backend == 'dynamodb':
+        from .storage_dynamodb import DynamoDBStorage
+        return DynamoDBStorage()
+    if backend == 'sqlite':
+        from .storage_sqlite import SQLiteStorage
+        return SQLiteStorage(SQLITE_PATH)
+    if backend == 'memory':
+        from .storage_memory import MemoryStorage
+        return MemoryStorage()
+    raise ValueError(f'Unknown storage backend {backend}')
+
+storage = create_storage()
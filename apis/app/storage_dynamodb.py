@@ -0,0 +1,274 @@
+"""
+DynamoDB storage backend
+"""
+
+import time
+import asyncio
+
+from botocore.exceptions import ClientError
+
+from . import config
+from .expiry import sweep_expired
+from .storage import Storage, Repository, SessionRepository, QueryRepository, FlagRepository, \
+                     CounterRepository, RotationConflict, SessionMissing, CounterExhausted
+from .unit_of_work import update_expression
+from .async_table import AsyncTable, run_blocking, transact_item, transact_write
+from .dynamodb_tables import ensure_all_tables, get_users_table, get_tokens_table, \
+                             get_sessions_table, get_queries_table, get_flagged_docs_table, \
+                             get_rollups_table, get_counters_table, get_revocations_table, \
+                             USER_SESSIONS_INDEX, USER_QUERIES_INDEX, FLAG_STATUS_INDEX
+
+class DynamoDBRepository(Repository):
+    """Items in a DynamoDB table"""
+
+    def __init__(self, table: AsyncTable, key: str):
+        self.table = table
+        self.key = key
+
+    async def get(self, key, consistent: bool = False) -> dict:
+        response = await self.table.get_item(Key={self.key: key}, ConsistentRead=consistent)
+        return response.get('Item', {})
+
+    async def put(self, item: dict):
+        await self.table.put_item(Item=item)
+
+    async def update(self, key, attrs: dict):
+        await self.table.update_item(Key={self.key: key}, **update_expression(attrs))
+
+    async def scan(self, segment: int = 0, total_segments: int = 1, attributes: list = None):
+        scan = {"Segment": segment, "TotalSegments": total_segments}
+        if attributes:
+            names = {f'#p{i}': attr for i, attr in enumerate(attributes)}
+            scan["ProjectionExpression"] = ', '.join(names)
+            scan["ExpressionAttributeNames"] = names
+        while True:
+            response = await self.table.scan(**scan)
+            yield response.get('Items', [])
+            if 'LastEvaluatedKey' not in response:
+                return
+            scan["ExclusiveStartKey"] = response['LastEvaluatedKey']
+
+class DynamoDBSessionRepository(DynamoDBRepository, SessionRepository):
+    """Sessions, looked up by user through the UserSessions index"""
+
+    @staticmethod
+    def _user_query(username: str) -> dict:
+        return {
+            "IndexName": USER_SESSIONS_INDEX,
+            "KeyConditionExpression": "UserName = :username",
+            "FilterExpression": "Active = :active AND "
+                                "(attribute_not_exists(ExpiresAt) OR ExpiresAt > :now)",
+            "ExpressionAttributeValues": {
+                ":username": username,
+                ":active": True,
+                ":now": int(time.time())
+            }
+        }
+
+    async def list_for_user(self, username: str) -> list:
+        query = {**self._user_query(username), "ScanIndexForward": False}
+        sessions = []
+        while True:
+            response = await self.table.query(**query)
+            sessions += response.get('Items', [])
+            if 'LastEvaluatedKey' not in response:
+                return sessions
+            query["ExclusiveStartKey"] = response['LastEvaluatedKey']
+
+    async def count_for_user(self, username: str) -> int:
+        query = {**self._user_query(username), "Select": "COUNT"}
+        count = 0
+        while True:
+            response = await self.table.query(**query)
+            count += response.get('Count', 0)
+            if 'LastEvaluatedKey' not in response:
+                return count
+            query["ExclusiveStartKey"] = response['LastEvaluatedKey']
+
+    async def delete_many(self, keys: list):
+        # Deleted rather than marked inactive, BatchWriteItem can't update items
+        await self.table.batch_delete([{self.key: key} for key in keys])
+
+class DynamoDBQueryRepository(DynamoDBRepository, QueryRepository):
+    """Queries, looked up by user through the UserQueries index"""
+
+    async def put_many(self, items: list):
+        # batch_writer sends 25 puts per BatchWriteItem and resends unprocessed ones
+        await self.table.batch_put(items)
+
+    async def page_for_user(self, username: str, limit: int, after: dict = None) -> tuple:
+        query = {
+            "IndexName": USER_QUERIES_INDEX,
+            "KeyConditionExpression": "UserName = :username",
+            "ExpressionAttributeValues": {":username": username},
+            "ScanIndexForward": False,
+            "Limit": limit
+        }
+        if after:
+            query["ExclusiveStartKey"] = {"UserName": username, **after}
+        response = await self.table.query(**query)
+        return response.get('Items', []), 'LastEvaluatedKey' in response
+
+class DynamoDBFlagRepository(DynamoDBRepository, FlagRepository):
+    """Flags, listed by status through the FlagsByStatus index"""
+
+    async def flag(self, flagged_id: int, attrs: dict) -> dict:
+        # One update_item, so concurrent flags of a hot document all count
+        update = update_expression(attrs)
+        update["UpdateExpression"] += (
+            ", FirstFlaggedAt = if_not_exists(FirstFlaggedAt, :first) "
+            "ADD FlagCount :one REMOVE ResolvedAt, ResolvedBy"
+        )
+        update["ExpressionAttributeValues"].update({":first": attrs["LastFlaggedAt"], ":one": 1})
+        response = await self.table.update_item(
+            Key={self.key: flagged_id}, ReturnValues="ALL_NEW", **update
+        )
+        return response["Attributes"]
+
+    async def page_by_status(self, status: str, limit: int, after: dict = None) -> tuple:
+        query = {
+            "IndexName": FLAG_STATUS_INDEX,
+            "KeyConditionExpression": "#status = :status",
+            "ExpressionAttributeNames": {"#status": "Status"},
+            "ExpressionAttributeValues": {":status": status},
+            "ScanIndexForward": False,
+            "Limit": limit
+        }
+        if after:
+            query["ExclusiveStartKey"] = {"Status": status, **after}
+        response = await self.table.query(**query)
+        return response.get('Items', []), 'LastEvaluatedKey' in response
+
+    async def _resolve(self, flagged_id: int, attrs: dict) -> bool:
+        update = update_expression({"Status": "resolved", **attrs})
+        update["ExpressionAttributeNames"]["#status"] = "Status"
+        update["ExpressionAttributeValues"][":open"] = "open"
+        try:
+            await self.table.update_item(
+                Key={self.key: flagged_id}, ConditionExpression="#status = :open", **update
+            )
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+        return True
+
+    async def resolve_many(self, flagged_ids: list, attrs: dict) -> list:
+        # BatchWriteItem can't update, so the conditional updates run concurrently
+        resolved = await asyncio.gather(*[
+            self._resolve(flagged_id, attrs) for flagged_id in flagged_ids
+        ])
+        return [flagged_id for flagged_id, done in zip(flagged_ids, resolved) if done]
+
+class DynamoDBCounterRepository(DynamoDBRepository, CounterRepository):
+    """Counters, each an item added to atomically"""
+
+    async def add(self, name: str, amount: int, limit: int) -> int:
+        try:
+            response = await self.table.update_item(
+                Key={self.key: name},
+                UpdateExpression="ADD #value :amount",
+                ConditionExpression="attribute_not_exists(#value) OR #value <= :max",
+                ExpressionAttributeNames={"#value": "CounterValue"},
+                ExpressionAttributeValues={":amount": amount, ":max": limit - amount},
+                ReturnValues="UPDATED_NEW"
+            )
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            raise CounterExhausted(name) from err
+        return int(response["Attributes"]["CounterValue"])
+
+class DynamoDBStorage(Storage):
+    """Tables named in config, created on first use"""
+
+    errors = (ClientError,)
+
+    def __init__(self):
+        self.users = DynamoDBRepository(
+            AsyncTable(lambda: get_users_table(config.USERS_TABLE)), "UserName"
+        )
+        self.tokens = DynamoDBRepository(
+            AsyncTable(lambda: get_tokens_table(config.TOKENS_TABLE)), "AccessKey"
+        )
+        self.sessions = DynamoDBSessionRepository(
+            AsyncTable(lambda: get_sessions_table(config.SESSIONS_TABLE)), "SessionKey"
+        )
+        self.queries = DynamoDBQueryRepository(
+            AsyncTable(lambda: get_queries_table(config.QUERIES_TABLE)), "QueryId"
+        )
+        self.flagged_docs = DynamoDBFlagRepository(
+            AsyncTable(lambda: get_flagged_docs_table(config.FLAGGED_DOCS_TABLE)), "FlaggedId"
+        )
+        self.rollups = DynamoDBRepository(AsyncTable(get_rollups_table), "RollupId")
+        self.counters = DynamoDBCounterRepository(AsyncTable(get_counters_table), "CounterName")
+        self.revocations = DynamoDBRepository(AsyncTable(get_revocations_table), "RevocationKey")
+
+    def rotation_items(self,
+                       username: str,
+                       previous_key: str,
+                       session: dict,
+                       user_attrs: dict,
+                       retire: bool = True) -> list:
+        """Builds the writes that retire the previous session and start a new one"""
+        items = []
+        if previous_key and retire:
+            items.append(transact_item(
+                'Update', self.sessions.table,
+                Key={"SessionKey": previous_key},
+                UpdateExpression="SET Active = :active, LastModified = :last_modified",
+                ConditionExpression="attribute_exists(SessionKey)",
+                ExpressionAttributeValues={
+                    ":active": False, ":last_modified": session["LastModified"]
+                }
+            ))
+
+        items.append(transact_item('Put', self.sessions.table, Item=session))
+
+        # Only rotate from the session the caller saw, so concurrent logins can't
+        # both retire the same session and leave one of theirs orphaned
+        user_update = update_expression(user_attrs)
+        if previous_key:
+            condition = "AuthKey = :previous_key"
+            user_update["ExpressionAttributeValues"][":previous_key"] = previous_key
+        else:
+            condition = "attribute_not_exists(AuthKey)"
+        items.append(transact_item(
+            'Update', self.users.table,
+            Key={"UserName": username},
+            ConditionExpression=condition,
+            **user_update
+        ))
+        return items
+
+    async def rotate_session(self,
+                             username: str,
+                             previous_key: str,
+                             session: dict,
+                             user_attrs: dict,
+                             retire: bool = True):
+        items = self.rotation_items(username, previous_key, session, user_attrs, retire)
+        try:
+            await transact_write(items)
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = [reason.get('Code') for reason in err.response.get('CancellationReasons', [])]
+            reasons = reasons or [None]
+            if previous_key and retire and reasons[0] == 'ConditionalCheckFailed' \
+               and reasons[-1] != 'ConditionalCheckFailed':
+                raise SessionMissing() from err
+            raise RotationConflict() from err
+
+    def start(self):
+        ensure_all_tables()
+
+    def _sweep_expired(self) -> int:
+        repositories = [self.tokens, self.sessions]
+        # The table is only created in signed mode
+        if getattr(config, 'SESSION_MODE', 'table') == 'signed':
+            repositories.append(self.revocations)
+        return sum(sweep_expired(repository.table.table) for repository in repositories)
+
+    async def sweep_expired(self) -> int:
+        return await run_blocking(self._sweep_expired)
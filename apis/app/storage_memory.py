@@ -0,0 +1,161 @@
+"""
+In-memory storage backend
+"""
+
+import copy
+import time
+
+from .storage import Storage, Repository, SessionRepository, QueryRepository, FlagRepository, \
+                     CounterRepository, RotationConflict, SessionMissing, CounterExhausted
+
+def _unexpired(item: dict, now: float) -> bool:
+    return 'ExpiresAt' not in item or item['ExpiresAt'] > now
+
+class MemoryRepository(Repository):
+    """Items in a dict, copied in and out so callers can't change them in place"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.items = {}
+
+    async def get(self, key, consistent: bool = False) -> dict:
+        return copy.deepcopy(self.items.get(key, {}))
+
+    async def put(self, item: dict):
+        self.items[item[self.key]] = copy.deepcopy(item)
+
+    async def update(self, key, attrs: dict):
+        self.items.setdefault(key, {self.key: key}).update(copy.deepcopy(attrs))
+
+    async def scan(self, segment: int = 0, total_segments: int = 1, attributes: list = None):
+        items = list(self.items.values())[segment::total_segments]
+        if attributes:
+            items = [{attr: item[attr] for attr in attributes if attr in item} for item in items]
+        yield copy.deepcopy(items)
+
+class MemorySessionRepository(MemoryRepository, SessionRepository):
+    """Sessions, looked up by user by scanning them all"""
+
+    def _active(self, username: str) -> list:
+        now = time.time()
+        return [session for session in self.items.values()
+                if session.get('UserName') == username and session.get('Active')
+                and _unexpired(session, now)]
+
+    async def list_for_user(self, username: str) -> list:
+        sessions = sorted(self._active(username), key=lambda session: session.get('CreatedAt', 0),
+                          reverse=True)
+        return copy.deepcopy(sessions)
+
+    async def count_for_user(self, username: str) -> int:
+        return len(self._active(username))
+
+    async def delete_many(self, keys: list):
+        for key in keys:
+            self.items.pop(key, None)
+
+class MemoryQueryRepository(MemoryRepository, QueryRepository):
+    """Queries, looked up by user by scanning them all"""
+
+    async def put_many(self, items: list):
+        for item in items:
+            await self.put(item)
+
+    async def page_for_user(self, username: str, limit: int, after: dict = None) -> tuple:
+        position = (after["CreatedAt"], after["QueryId"]) if after else None
+        queries = sorted(
+            (query for query in self.items.values() if query.get('UserName') == username
+             and (position is None or (query['CreatedAt'], query['QueryId']) < position)),
+            key=lambda query: (query['CreatedAt'], query['QueryId']),
+            reverse=True
+        )
+        return copy.deepcopy(queries[:limit]), len(queries) > limit
+
+class MemoryFlagRepository(MemoryRepository, FlagRepository):
+    """Flags, listed by status by scanning them all"""
+
+    async def flag(self, flagged_id: int, attrs: dict) -> dict:
+        item = self.items.setdefault(flagged_id, {
+            self.key: flagged_id, "FlagCount": 0, "FirstFlaggedAt": attrs["LastFlaggedAt"]
+        })
+        item.pop("ResolvedAt", None)
+        item.pop("ResolvedBy", None)
+        item.update(copy.deepcopy(attrs))
+        item["FlagCount"] += 1
+        return copy.deepcopy(item)
+
+    async def page_by_status(self, status: str, limit: int, after: dict = None) -> tuple:
+        position = (after["LastFlaggedAt"], after["FlaggedId"]) if after else None
+        flags = sorted(
+            (flag for flag in self.items.values() if flag.get('Status') == status
+             and (position is None or (flag['LastFlaggedAt'], flag['FlaggedId']) < position)),
+            key=lambda flag: (flag['LastFlaggedAt'], flag['FlaggedId']),
+            reverse=True
+        )
+        return copy.deepcopy(flags[:limit]), len(flags) > limit
+
+    async def resolve_many(self, flagged_ids: list, attrs: dict) -> list:
+        resolved = []
+        for flagged_id in flagged_ids:
+            flag = self.items.get(flagged_id)
+            if flag and flag.get('Status') == 'open':
+                flag.update(copy.deepcopy(attrs), Status="resolved")
+                resolved.append(flagged_id)
+        return resolved
+
+class MemoryCounterRepository(MemoryRepository, CounterRepository):
+    """Counters in a dict"""
+
+    async def add(self, name: str, amount: int, limit: int) -> int:
+        counter = self.items.setdefault(name, {self.key: name, "CounterValue": 0})
+        if counter["CounterValue"] + amount > limit:
+            raise CounterExhausted(name)
+        counter["CounterValue"] += amount
+        return counter["CounterValue"]
+
+class MemoryStorage(Storage):
+    """
+    Process local storage for tests and demos. Nothing is persisted, and
+    each worker process has its own data.
+    """
+
+    def __init__(self):
+        self.users = MemoryRepository("UserName")
+        self.tokens = MemoryRepository("AccessKey")
+        self.sessions = MemorySessionRepository("SessionKey")
+        self.queries = MemoryQueryRepository("QueryId")
+        self.flagged_docs = MemoryFlagRepository("FlaggedId")
+        self.rollups = MemoryRepository("RollupId")
+        self.counters = MemoryCounterRepository("CounterName")
+        self.revocations = MemoryRepository("RevocationKey")
+
+    async def rotate_session(self,
+                             username: str,
+                             previous_key: str,
+                             session: dict,
+                             user_attrs: dict,
+                             retire: bool = True):
+        # Nothing here awaits, so no other task can interleave
+        user = self.users.items.get(username, {})
+        if user.get('AuthKey') != previous_key:
+            raise RotationConflict()
+        if previous_key and retire:
+            previous = self.sessions.items.get(previous_key)
+            if previous is None:
+                raise SessionMissing()
+            previous.update(Active=False, LastModified=session["LastModified"])
+        self.sessions.items[session["SessionKey"]] = copy.deepcopy(session)
+        self.users.items.setdefault(username, {"UserName": username}).update(
+            copy.deepcopy(user_attrs)
+        )
+
+    async def sweep_expired(self) -> int:
+        # On the event loop like every other change to the dicts, so they can't change mid-sweep
+        now = time.time()
+        deleted = 0
+        for repository in (self.tokens, self.sessions, self.revocations):
+            expired = [key for key, item in repository.items.items() if not _unexpired(item, now)]
+            for key in expired:
+                del repository.items[key]
+            deleted += len(expired)
+        return deleted
@@ -0,0 +1,444 @@
+"""
+SQLite storage backend
+"""
+
+import json
+import time
+import sqlite3
+import threading
+from decimal import Decimal
+
+from . import logger
+from .storage import Storage, Repository, SessionRepository, QueryRepository, FlagRepository, \
+                     CounterRepository, RotationConflict, SessionMissing, CounterExhausted
+from .async_table import run_blocking
+
+# Items are stored as JSON, with the attributes the backend filters or sorts
+# on copied into indexed columns
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    key TEXT PRIMARY KEY,
+    item TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tokens (
+    key TEXT PRIMARY KEY,
+    item TEXT NOT NULL,
+    expires_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    key TEXT PRIMARY KEY,
+    item TEXT NOT NULL,
+    user_name TEXT,
+    created_at INTEGER,
+    active INTEGER,
+    expires_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS queries (
+    key INTEGER PRIMARY KEY,
+    item TEXT NOT NULL,
+    user_name TEXT,
+    created_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS flagged_docs (
+    key INTEGER PRIMARY KEY,
+    item TEXT NOT NULL,
+    status TEXT,
+    last_flagged_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    key TEXT PRIMARY KEY,
+    item TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    key TEXT PRIMARY KEY,
+    item TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS revocations (
+    key TEXT PRIMARY KEY,
+    item TEXT NOT NULL,
+    expires_at INTEGER
+);
+"""
+
+# Created after any columns added since a database was created
+INDEXES = """
+CREATE INDEX IF NOT EXISTS tokens_expiry ON tokens (expires_at);
+CREATE INDEX IF NOT EXISTS sessions_by_user ON sessions (user_name, created_at);
+CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expires_at);
+CREATE INDEX IF NOT EXISTS queries_by_user ON queries (user_name, created_at, key);
+CREATE INDEX IF NOT EXISTS flags_by_status ON flagged_docs (status, last_flagged_at, key);
+CREATE INDEX IF NOT EXISTS revocations_expiry ON revocations (expires_at);
+"""
+
+# Rows read per call when scanning
+SCAN_PAGE_SIZE = 1000
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def _dumps(item: dict) -> str:
+    return json.dumps(item, separators=(',', ':'), default=_default)
+
+class SQLiteTable:
+    """One table of items, with columns mirroring some item attributes"""
+
+    def __init__(self, name: str, key: str, columns: dict = None):
+        # columns maps column names to the item attributes they mirror
+        self.name = name
+        self.key = key
+        self.columns = {"key": key, **(columns or {})}
+        names = ', '.join([*self.columns, 'item'])
+        placeholders = ', '.join('?' * (len(self.columns) + 1))
+        # Constant statements, so sqlite3's statement cache prepares each once per connection
+        self.select_sql = f'SELECT item FROM {name} WHERE key = ?'
+        self.upsert_sql = f'INSERT OR REPLACE INTO {name} ({names}) VALUES ({placeholders})'
+        self.delete_sql = f'DELETE FROM {name} WHERE key = ?'
+        self.scan_sql = (
+            f'SELECT rowid, item FROM {name} WHERE rowid > ? AND rowid % ? = ? '
+            f'ORDER BY rowid LIMIT {SCAN_PAGE_SIZE}'
+        )
+
+    def row(self, item: dict) -> tuple:
+        """The column values of an item"""
+        values = []
+        for attr in self.columns.values():
+            value = item.get(attr)
+            values.append(_default(value) if isinstance(value, Decimal) else value)
+        return (*values, _dumps(item))
+
+    def read(self, db: sqlite3.Connection, key) -> dict:
+        """Reads an item"""
+        row = db.execute(self.select_sql, (key,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def write(self, db: sqlite3.Connection, item: dict):
+        """Writes an item"""
+        db.execute(self.upsert_sql, self.row(item))
+
+    def add_missing_columns(self, db: sqlite3.Connection):
+        """Adds columns mirrored since the table was created, filled from the items"""
+        existing = {row[1] for row in db.execute(f'PRAGMA table_info({self.name})')}
+        for column, attr in self.columns.items():
+            if column not in existing:
+                logger.info('Adding column %s to %s', column, self.name)
+                db.execute(f'ALTER TABLE {self.name} ADD COLUMN {column}')
+                db.execute(f"UPDATE {self.name} SET {column} = json_extract(item, '$.{attr}')")
+
+    def scan_page(self, db: sqlite3.Connection, after: int, segment: int, total_segments: int) -> list:
+        """Reads the (rowid, item) rows of a segment after a rowid"""
+        return db.execute(self.scan_sql, (after, total_segments, segment)).fetchall()
+
+class SQLiteRepository(Repository):
+    """Items in a table of the database"""
+
+    def __init__(self, storage: 'SQLiteStorage', table: SQLiteTable):
+        self.storage = storage
+        self.table = table
+
+    def _update(self, key, attrs: dict):
+        with self.storage.transaction() as db:
+            item = self.table.read(db, key) or {self.table.key: key}
+            self.table.write(db, {**item, **attrs})
+
+    async def get(self, key, consistent: bool = False) -> dict:
+        # Reads are always consistent
+        return await run_blocking(self.storage.call, self.table.read, key)
+
+    async def put(self, item: dict):
+        await run_blocking(self.storage.call, self.table.write, item)
+
+    async def update(self, key, attrs: dict):
+        await run_blocking(self._update, key, attrs)
+
+    async def scan(self, segment: int = 0, total_segments: int = 1, attributes: list = None):
+        # Segments split the rows by rowid, pages continue after the last one read
+        after = 0
+        while True:
+            rows = await run_blocking(
+                self.storage.call, self.table.scan_page, after, segment, total_segments
+            )
+            items = [json.loads(item) for _, item in rows]
+            if attributes:
+                items = [{attr: item[attr] for attr in attributes if attr in item} for item in items]
+            yield items
+            if len(rows) < SCAN_PAGE_SIZE:
+                return
+            after = rows[-1][0]
+
+class SQLiteSessionRepository(SQLiteRepository, SessionRepository):
+    """Sessions, looked up by user through the sessions_by_user index"""
+
+    ACTIVE_SQL = (
+        'FROM sessions WHERE user_name = ? AND active = 1 '
+        'AND (expires_at IS NULL OR expires_at > ?)'
+    )
+
+    def _list(self, db: sqlite3.Connection, username: str) -> list:
+        rows = db.execute(
+            f'SELECT item {self.ACTIVE_SQL} ORDER BY created_at DESC', (username, time.time())
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _count(self, db: sqlite3.Connection, username: str) -> int:
+        return db.execute(f'SELECT COUNT(*) {self.ACTIVE_SQL}', (username, time.time())).fetchone()[0]
+
+    def _delete_many(self, keys: list):
+        with self.storage.transaction() as db:
+            db.executemany(self.table.delete_sql, [(key,) for key in keys])
+
+    async def list_for_user(self, username: str) -> list:
+        return await run_blocking(self.storage.call, self._list, username)
+
+    async def count_for_user(self, username: str) -> int:
+        return await run_blocking(self.storage.call, self._count, username)
+
+    async def delete_many(self, keys: list):
+        await run_blocking(self._delete_many, keys)
+
+class SQLiteQueryRepository(SQLiteRepository, QueryRepository):
+    """Queries, looked up by user through the queries_by_user index"""
+
+    FIRST_PAGE_SQL = (
+        'SELECT item FROM queries WHERE user_name = ? '
+        'ORDER BY created_at DESC, key DESC LIMIT ?'
+    )
+    NEXT_PAGE_SQL = (
+        'SELECT item FROM queries WHERE user_name = ? AND (created_at, key) < (?, ?) '
+        'ORDER BY created_at DESC, key DESC LIMIT ?'
+    )
+
+    def _put_many(self, items: list):
+        with self.storage.transaction() as db:
+            db.executemany(self.table.upsert_sql, [self.table.row(item) for item in items])
+
+    def _page(self, db: sqlite3.Connection, username: str, limit: int, after: dict) -> tuple:
+        # One extra row tells whether there is another page
+        if after:
+            rows = db.execute(self.NEXT_PAGE_SQL, (
+                username, after["CreatedAt"], after["QueryId"], limit + 1
+            )).fetchall()
+        else:
+            rows = db.execute(self.FIRST_PAGE_SQL, (username, limit + 1)).fetchall()
+        return [json.loads(row[0]) for row in rows[:limit]], len(rows) > limit
+
+    async def put_many(self, items: list):
+        await run_blocking(self._put_many, items)
+
+    async def page_for_user(self, username: str, limit: int, after: dict = None) -> tuple:
+        return await run_blocking(self.storage.call, self._page, username, limit, after)
+
+class SQLiteFlagRepository(SQLiteRepository, FlagRepository):
+    """Flags, listed by status through the flags_by_status index"""
+
+    FIRST_PAGE_SQL = (
+        'SELECT item FROM flagged_docs WHERE status = ? '
+        'ORDER BY last_flagged_at DESC, key DESC LIMIT ?'
+    )
+    NEXT_PAGE_SQL = (
+        'SELECT item FROM flagged_docs WHERE status = ? AND (last_flagged_at, key) < (?, ?) '
+        'ORDER BY last_flagged_at DESC, key DESC LIMIT ?'
+    )
+
+    def _flag(self, flagged_id: int, attrs: dict) -> dict:
+        with self.storage.transaction() as db:
+            item = self.table.read(db, flagged_id) or {
+                self.table.key: flagged_id, "FlagCount": 0, "FirstFlaggedAt": attrs["LastFlaggedAt"]
+            }
+            item.pop("ResolvedAt", None)
+            item.pop("ResolvedBy", None)
+            item = {**item, **attrs, "FlagCount": item["FlagCount"] + 1}
+            self.table.write(db, item)
+        return item
+
+    def _page(self, db: sqlite3.Connection, status: str, limit: int, after: dict) -> tuple:
+        # One extra row tells whether there is another page
+        if after:
+            rows = db.execute(self.NEXT_PAGE_SQL, (
+                status, after["LastFlaggedAt"], after["FlaggedId"], limit + 1
+            )).fetchall()
+        else:
+            rows = db.execute(self.FIRST_PAGE_SQL, (status, limit + 1)).fetchall()
+        return [json.loads(row[0]) for row in rows[:limit]], len(rows) > limit
+
+    def _resolve_many(self, flagged_ids: list, attrs: dict) -> list:
+        resolved = []
+        with self.storage.transaction() as db:
+            for flagged_id in flagged_ids:
+                flag = self.table.read(db, flagged_id)
+                if flag.get('Status') == 'open':
+                    self.table.write(db, {**flag, **attrs, "Status": "resolved"})
+                    resolved.append(flagged_id)
+        return resolved
+
+    async def flag(self, flagged_id: int, attrs: dict) -> dict:
+        return await run_blocking(self._flag, flagged_id, attrs)
+
+    async def page_by_status(self, status: str, limit: int, after: dict = None) -> tuple:
+        return await run_blocking(self.storage.call, self._page, status, limit, after)
+
+    async def resolve_many(self, flagged_ids: list, attrs: dict) -> list:
+        return await run_blocking(self._resolve_many, flagged_ids, attrs)
+
+class SQLiteCounterRepository(SQLiteRepository, CounterRepository):
+    """Counters, each a row added to in a write transaction"""
+
+    def _add(self, name: str, amount: int, limit: int) -> int:
+        with self.storage.transaction() as db:
+            counter = self.table.read(db, name) or {self.table.key: name, "CounterValue": 0}
+            if counter["CounterValue"] + amount > limit:
+                raise CounterExhausted(name)
+            counter["CounterValue"] += amount
+            self.table.write(db, counter)
+        return counter["CounterValue"]
+
+    async def add(self, name: str, amount: int, limit: int) -> int:
+        return await run_blocking(self._add, name, amount, limit)
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on error"""
+
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+
+    def __enter__(self) -> sqlite3.Connection:
+        # IMMEDIATE takes the write lock up front, so read-modify-write is atomic
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            try:
+                self.db.execute('COMMIT')
+                return
+            except sqlite3.Error:
+                self._rollback()
+                raise
+        self._rollback()
+
+    def _rollback(self):
+        # A failed COMMIT can leave the transaction open, and every later
+        # BEGIN on this connection would fail
+        if self.db.in_transaction:
+            self.db.execute('ROLLBACK')
+
+class SQLiteStorage(Storage):
+    """
+    Embedded database for single node installs.
+
+    Each thread has its own connection, as sqlite3 connections can't be
+    shared between threads. The database is in WAL mode so reads don't wait
+    for writes, and calls run on the same executor as DynamoDB calls.
+    """
+
+    errors = (sqlite3.Error,)
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.tables = {
+            "users": SQLiteTable("users", "UserName"),
+            "tokens": SQLiteTable("tokens", "AccessKey", {"expires_at": "ExpiresAt"}),
+            "sessions": SQLiteTable("sessions", "SessionKey", {
+                "user_name": "UserName",
+                "created_at": "CreatedAt",
+                "active": "Active",
+                "expires_at": "ExpiresAt"
+            }),
+            "queries": SQLiteTable("queries", "QueryId", {
+                "user_name": "UserName",
+                "created_at": "CreatedAt"
+            }),
+            "flagged_docs": SQLiteTable("flagged_docs", "FlaggedId", {
+                "status": "Status",
+                "last_flagged_at": "LastFlaggedAt"
+            }),
+            "rollups": SQLiteTable("rollups", "RollupId"),
+            "counters": SQLiteTable("counters", "CounterName"),
+            "revocations": SQLiteTable("revocations", "RevocationKey", {"expires_at": "ExpiresAt"}),
+        }
+        self.users = SQLiteRepository(self, self.tables["users"])
+        self.tokens = SQLiteRepository(self, self.tables["tokens"])
+        self.sessions = SQLiteSessionRepository(self, self.tables["sessions"])
+        self.queries = SQLiteQueryRepository(self, self.tables["queries"])
+        self.flagged_docs = SQLiteFlagRepository(self, self.tables["flagged_docs"])
+        self.rollups = SQLiteRepository(self, self.tables["rollups"])
+        self.counters = SQLiteCounterRepository(self, self.tables["counters"])
+        self.revocations = SQLiteRepository(self, self.tables["revocations"])
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """This thread's connection, opened on first use"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('PRAGMA busy_timeout=5000')
+            db.executescript(SCHEMA)
+            with _Transaction(db):
+                for table in self.tables.values():
+                    table.add_missing_columns(db)
+            db.executescript(INDEXES)
+            self._local.db = db
+            with self._lock:
+                self._connections.append(db)
+        return db
+
+    def call(self, func, *args):
+        """Calls func(connection, *args) with this thread's connection"""
+        return func(self.db, *args)
+
+    def transaction(self) -> _Transaction:
+        """A write transaction on this thread's connection"""
+        return _Transaction(self.db)
+
+    def _rotate_session(self, username, previous_key, session, user_attrs, retire):
+        with self.transaction() as db:
+            user = self.tables["users"].read(db, username)
+            if user.get('AuthKey') != previous_key:
+                raise RotationConflict()
+            sessions = self.tables["sessions"]
+            if previous_key and retire:
+                previous = sessions.read(db, previous_key)
+                if not previous:
+                    raise SessionMissing()
+                sessions.write(db, {
+                    **previous, "Active": False, "LastModified": session["LastModified"]
+                })
+            sessions.write(db, session)
+            self.tables["users"].write(db, {"UserName": username, **user, **user_attrs})
+
+    async def rotate_session(self,
+                             username: str,
+                             previous_key: str,
+                             session: dict,
+                             user_attrs: dict,
+                             retire: bool = True):
+        await run_blocking(self._rotate_session, username, previous_key, session, user_attrs, retire)
+
+    def start(self):
+        logger.info('Using SQLite storage at %s', self.path)
+        # Opening a connection creates the schema
+        self.call(lambda db: None)
+
+    def _sweep_expired(self) -> int:
+        now = int(time.time())
+        with self.transaction() as db:
+            return sum(
+                db.execute(f'DELETE FROM {name} WHERE expires_at <= ?', (now,)).rowcount
+                for name in ("tokens", "sessions", "revocations")
+            )
+
+    async def sweep_expired(self) -> int:
+        return await run_blocking(self._sweep_expired)
+
+    def close(self):
+        with self._lock:
+            for db in self._connections:
+                db.close()
+            self._connections = []
+        self._local = threading.local()
@@ -0,0 +1,89 @@
+"""
+Request-scoped unit of work for user records
+"""
+
+import asyncio
+import contextvars
+
+_current = contextvars.ContextVar('user_unit_of_work', default=None)
+
+def current_unit_of_work():
+    """Returns the unit of work for the current request, if there is one"""
+    return _current.get()
+
+def update_expression(attrs: dict) -> dict:
+    """Builds update_item arguments that SET each attribute in attrs"""
+    names = {}
+    values = {}
+    assignments = []
+    for i, (attr, value) in enumerate(attrs.items()):
+        names[f'#a{i}'] = attr
+        values[f':a{i}'] = value
+        assignments.append(f'#a{i} = :a{i}')
+
+    return {
+        "UpdateExpression": "SET " + ", ".join(assignments),
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": values
+    }
+
+class UserUnitOfWork:
+    """
+    Identity map of the user records read during a request.
+
+    Each user is loaded at most once, updates are applied to the local copy
+    as soon as they are staged and written with one update_item per user
+    when the unit of work exits cleanly.
+    """
+
+    def __init__(self, write):
+        # write(username, attrs) persists the staged attributes for one user
+        self.write = write
+        self.users = {}
+        self.pending = {}
+        self._token = None
+
+    async def __aenter__(self):
+        self._token = _current.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        _current.reset(self._token)
+        if exc_type is None:
+            await self.flush()
+        else:
+            # Abandon the writes of a request that failed
+            self.pending.clear()
+
+    def get(self, username: str):
+        """Returns a copy of the loaded record or None if it hasn't been loaded"""
+        if username not in self.users:
+            return None
+        return dict(self.users[username])
+
+    def load(self, username: str, item: dict):
+        """Adds a record read from the table to the identity map"""
+        # Updates staged before the first read still apply to the local copy
+        self.users[username] = {**item, **self.pending.get(username, {})}
+
+    def stage(self, username: str, attrs: dict):
+        """Records an update to be flushed and applies it to the local copy"""
+        self.pending.setdefault(username, {}).update(attrs)
+        if username in self.users:
+            self.users[username].update(attrs)
+
+    def take_pending(self, username: str) -> dict:
+        """Removes and returns the staged updates for a user so the caller can write them"""
+        return self.pending.pop(username, {})
+
+    def apply(self, username: str, attrs: dict):
+        """Applies attributes the caller has already written to the local copy"""
+        if username in self.users:
+            self.users[username].update(attrs)
+
+    async def flush(self):
+        """Writes all staged updates, one request per user"""
+        pending, self.pending = self.pending, {}
+        await asyncio.gather(*[
+            self.write(username, attrs) for username, attrs in pending.items() if attrs
+        ])
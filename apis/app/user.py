@@ -1,86 +1,247 @@
 """
 User table tools
 """
-import re
+import os
+import hmac
+import base64
+import asyncio
 import hashlib
+import functools
+import multiprocessing
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
-from botocore.exceptions import ClientError
-
-from . import logger
 from . import config
-from .util import http_response
-from .dynamodb_tables import get_users_table
-
-user_table = get_users_table(config.USERS_TABLE)
+from .models import EMAIL_REGEX, PASSWORD_REGEX
+from .storage import storage
+from .unit_of_work import UserUnitOfWork, current_unit_of_work
+from .write_behind import WriteBehindBuffer
 
 def is_valid_password(password: str) -> bool:
     """Checks the format of the password"""
-    pw_regex = r'^(?=.*[a-z])(?=.*[A-Z])(?=.*[0-9])(?=.*[_!@#$%]).{8,24}$'
-    return bool(re.match(pw_regex, password))
+    return bool(PASSWORD_REGEX.match(password))
 
 def is_valid_user(username: str) -> bool:
     """Checks the format of the username"""
-    email_regex = r"([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+/-9=?A-Z^-~]+)*|\"([]!#-[^-~ \t]|(\\[\t -~]))+\")@([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+/-9=?A-Z^-~]+)*|\[[\t -Z^-~]*])"
-    return bool(re.match(email_regex, username))
+    return bool(EMAIL_REGEX.match(username))
+
+class HashingOverloaded(Exception):
+    """Raised when too many passwords are waiting to be hashed"""
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # Runs in the worker processes, so it must stay a module level function
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * r * n, dklen=32
+    )
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+def _verify_legacy(password: str, user_hash: str) -> bool:
+    pw_hash = hashlib.sha3_256(password.encode()).hexdigest()
+    return hmac.compare_digest(pw_hash.encode(), user_hash.encode())
+
+class PasswordHasher:
+    """
+    Salted scrypt password hashing.
+
+    Hashes are stored as scrypt$n$r$p$salt$hash so the cost can be raised
+    without breaking existing hashes. Hashing runs in a process pool so it
+    doesn't block the event loop, and new work is refused once max_pending
+    hashes are queued. Unsalted SHA3 hashes from before are still verified
+    and reported as needing a rehash.
+    """
+
+    def __init__(self, n: int, r: int, p: int, workers: int, max_pending: int):
+        self.n = n
+        self.r = r
+        self.p = p
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._pool = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        """Starts the worker processes on first use"""
+        if self._pool is None:
+            # Forked workers would inherit the event loop, threads and connections
+            # of the server, forkserver and spawn start them from a clean process
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self._pool
+
+    def shutdown(self):
+        """Stops the worker processes"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def _run(self, password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        if self.pending >= self.max_pending:
+            raise HashingOverloaded()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pool, _scrypt, password, salt, n, r, p)
+        finally:
+            self.pending -= 1
+
+    def _encode(self, salt: bytes, digest: bytes, n: int, r: int, p: int) -> str:
+        return f'scrypt${n}${r}${p}${_b64(salt)}${_b64(digest)}'
+
+    def hash(self, password: str) -> str:
+        """Hashes a password in this process"""
+        salt = os.urandom(16)
+        digest = _scrypt(password, salt, self.n, self.r, self.p)
+        return self._encode(salt, digest, self.n, self.r, self.p)
+
+    async def hash_async(self, password: str) -> str:
+        """Hashes a password in the process pool"""
+        salt = os.urandom(16)
+        digest = await self._run(password, salt, self.n, self.r, self.p)
+        return self._encode(salt, digest, self.n, self.r, self.p)
+
+    def needs_rehash(self, user_hash: str) -> bool:
+        """Checks whether a hash is legacy or uses other cost settings"""
+        return not user_hash.startswith(f'scrypt${self.n}${self.r}${self.p}$')
+
+    @staticmethod
+    def _parse(user_hash: str):
+        try:
+            _, n, r, p, salt, digest = user_hash.split('$')
+            return base64.b64decode(salt), base64.b64decode(digest), int(n), int(r), int(p)
+        except ValueError:
+            return None
+
+    def verify(self, password: str, user_hash: str) -> bool:
+        """Compares a password against a hash in this process"""
+        if not user_hash:
+            return False
+        if not user_hash.startswith('scrypt$'):
+            return _verify_legacy(password, user_hash)
+        parsed = self._parse(user_hash)
+        if not parsed:
+            return False
+        salt, digest, n, r, p = parsed
+        return hmac.compare_digest(_scrypt(password, salt, n, r, p), digest)
+
+    async def verify_async(self, password: str, user_hash: str) -> bool:
+        """Compares a password against a hash in the process pool"""
+        if not user_hash:
+            return False
+        if not user_hash.startswith('scrypt$'):
+            return _verify_legacy(password, user_hash)
+        parsed = self._parse(user_hash)
+        if not parsed:
+            return False
+        salt, digest, n, r, p = parsed
+        return hmac.compare_digest(await self._run(password, salt, n, r, p), digest)
+
+password_hasher = PasswordHasher(
+    n=getattr(config, 'PASSWORD_SCRYPT_N', 2 ** 14),
+    r=getattr(config, 'PASSWORD_SCRYPT_R', 8),
+    p=getattr(config, 'PASSWORD_SCRYPT_P', 1),
+    workers=getattr(config, 'PASSWORD_HASH_WORKERS', os.cpu_count()),
+    max_pending=getattr(config, 'PASSWORD_HASH_MAX_PENDING', 64)
+)
 
 def compare_to_hash(password: str, user_hash: str):
     """Compares a str against a hash"""
-    pw_hash = hashlib.sha3_256(password.encode()).hexdigest()
-    return pw_hash == user_hash
+    return password_hasher.verify(password, user_hash)
+
+async def verify_password(password: str, user_hash: str) -> bool:
+    """Compares a password against a hash without blocking the event loop"""
+    return await password_hasher.verify_async(password, user_hash)
+
+async def hash_password(password: str) -> str:
+    """Hashes a password without blocking the event loop"""
+    return await password_hasher.hash_async(password)
 
-def validate_auth_key(username: str):
+async def rehash_password(username: str, password: str, user_hash: str):
+    """Upgrades a legacy or outdated hash after the password was verified"""
+    if password_hasher.needs_rehash(user_hash):
+        await update_user(username, {"Password": await hash_password(password)})
+
+async def validate_auth_key(username: str):
     """Verify the user's auth key"""
-    db_auth_key = get_user(username).get('AuthKey')
+    db_auth_key = (await get_user(username)).get('AuthKey')
     return db_auth_key
 
-def create_new_user(username: dict, password: str):
+async def create_new_user(username: dict, password: str):
     """Create a new user record"""
-    pw_hash = hashlib.sha3_256(password.encode()).hexdigest()
-    user_table.put_item(Item={"UserName": username, "Password": pw_hash})
+    pw_hash = await hash_password(password)
+    item = {"UserName": username, "Password": pw_hash}
+    await storage.users.put(item)
+
+    unit_of_work = current_unit_of_work()
+    if unit_of_work:
+        unit_of_work.load(username, item)
 
-def get_user(username: str) -> dict:
+async def get_user(username: str) -> dict:
     """Gets the user record"""
-    response = user_table.get_item(Key={"UserName": username})
-    return response.get('Item', {})
-
-def update_timestamp(username: str):
-    """Updates the LastLogin timestamp"""
-    try:
-        return user_table.update_item(
-            Key={"UserName": username},
-            UpdateExpression="SET LastLogin = :last_login",
-            ExpressionAttributeValues={":last_login": str(datetime.utcnow())}
-        )
-    except ClientError as err:
-        logger.warning('Error updating user %s: %s', username, err)
-        return http_response(500, {"message": 'Server Error'})
+    unit_of_work = current_unit_of_work()
+    if unit_of_work:
+        user = unit_of_work.get(username)
+        if user is not None:
+            return user
+
+    user = await storage.users.get(username)
+
+    if unit_of_work:
+        unit_of_work.load(username, user)
+    return user
+
+async def write_user(username: str, attrs: dict):
+    """Writes attributes to the user record, with any buffered LastLogin"""
+    return await storage.users.update(username, {**last_logins.take(username), **attrs})
+
+async def update_user(username: str, attrs: dict):
+    """Updates the user record, deferring the write while in a unit of work"""
+    unit_of_work = current_unit_of_work()
+    if unit_of_work:
+        unit_of_work.stage(username, attrs)
+        return None
+    return await write_user(username, attrs)
+
+def user_unit_of_work(handler):
+    """Runs an API handler in a unit of work that loads each user once"""
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        async with UserUnitOfWork(write_user):
+            return await handler(*args, **kwargs)
+    return wrapper
+
+async def _write_last_login(username: str, attrs: dict):
+    """Writes flushed LastLogin values, leaving any recorded since the flush started pending"""
+    return await storage.users.update(username, attrs)
+
+# LastLogin updates are buffered and written in the background, or with the
+# next write to the user, so they don't cost logins a write of their own
+last_logins = WriteBehindBuffer(
+    _write_last_login,
+    interval=getattr(config, 'LAST_LOGIN_FLUSH_INTERVAL', 10),
+    batch_size=getattr(config, 'LAST_LOGIN_FLUSH_BATCH_SIZE', 25)
+)
+
+async def update_timestamp(username: str):
+    """Records the LastLogin timestamp, to be written later"""
+    last_logins.record(username, {"LastLogin": str(datetime.utcnow())})
 
 async def set_user_auth(username: str, auth_key: str):
     """Sets the authKey for the user"""
-    return user_table.update_item(
-        Key={"UserName": username},
-        UpdateExpression="SET LastLogin = :last_login, AuthKey = :auth_key, Valid = :valid",
-        ExpressionAttributeValues={
-            ":last_login": str(datetime.utcnow()),
-            ":auth_key": auth_key,
-            ":valid": True
-        }
-    )
+    return await update_user(username, {
+        "LastLogin": str(datetime.utcnow()),
+        "AuthKey": auth_key,
+        "Valid": True
+    })
 
 async def set_user_role(username: str, role: str):
     """Sets the role for the user"""
-    return user_table.update_item(
-        Key={"UserName": username},
-        UpdateExpression="SET AuthRole = :role",
-        ExpressionAttributeValues={":role": role}
-    )
+    return await update_user(username, {"AuthRole": role})
 
 async def update_user_password(username: str, new_password: str):
     """Update the user's password"""
-    pw_hash = hashlib.sha3_256(new_password.encode()).hexdigest()
-    return user_table.update_item(
-        Key={"UserName": username},
-        UpdateExpression="SET Password = :password",
-        ExpressionAttributeValues={ ":password": pw_hash }
-    )
+    pw_hash = await hash_password(new_password)
+    return await update_user(username, {"Password": pw_hash})
@@ -2,22 +2,76 @@
 API Utilities
 """
 
+import json
+import base64
+import binascii
+from decimal import Decimal
+
+import orjson
 from fastapi import HTTPException
+from starlette.responses import Response
 from . import config
 
+# True keeps the Lambda-style statusCode and headers fields in every body,
+# for clients written against the API before they were dropped
+RESPONSE_ENVELOPE = getattr(config, 'RESPONSE_ENVELOPE', False)
+
+# Built once, every response shares them
+ENVELOPE_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": config.APP_ORIGIN
+}
+JSON_CONTENT_TYPE = (b"content-type", b"application/json")
+
+def _default(value):
+    # DynamoDB returns numbers as Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+class APIResponse(Response):
+    """
+    JSON response serialized once with orjson. Handlers return it directly,
+    so FastAPI neither validates the body against the response model nor
+    encodes it again.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_default)
+
+    def init_headers(self, headers=None):
+        if headers is not None:
+            super().init_headers(headers)
+            return
+        self.raw_headers = [
+            (b"content-length", str(len(self.body)).encode("latin-1")),
+            JSON_CONTENT_TYPE
+        ]
+
 # Utilities
 def http_response(status_code: int, body: any=None):
     """Generates a standard HTTP response"""
     if status_code >= 400:
         raise HTTPException(status_code=status_code, detail=body.get('message'))
 
-    response = {
-        **body,
-        "statusCode": status_code,
-        "headers": {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": config.APP_ORIGIN
-        }
-    }
+    if RESPONSE_ENVELOPE:
+        body = {**body, "statusCode": status_code, "headers": ENVELOPE_HEADERS}
+
+    return APIResponse(body, status_code)
+
+def encode_cursor(item: dict, fields: tuple) -> str:
+    """An opaque cursor of the page after an item, from its numeric sort and key fields"""
+    position = [int(item[field]) for field in fields]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
 
-    return response
+def decode_cursor(cursor: str, fields: tuple) -> dict:
+    """The position a cursor points after, raises ValueError if it isn't one"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(position, list) or len(position) != len(fields):
+            raise ValueError('wrong number of fields')
+        return {field: int(value) for field, value in zip(fields, position)}
+    except (binascii.Error, TypeError, ValueError) as err:
+        raise ValueError('invalid cursor') from err
@@ -0,0 +1,75 @@
+"""
+Write-behind buffer for updates that don't need to be durable right away
+"""
+
+import asyncio
+
+from . import logger
+
+class WriteBehindBuffer:
+    """
+    Coalesces attribute updates per key in memory and writes them in the
+    background.
+
+    Repeated updates to a key before a flush become one write with the
+    latest values. Callers already writing a key can take its pending
+    attributes and fold them into their own write. Flushes run every
+    interval seconds and when the buffer is stopped, writing batch_size
+    keys concurrently, and failed writes are kept for the next flush.
+    Pending updates are lost if the process dies.
+    """
+
+    def __init__(self, write, interval: float = 10.0, batch_size: int = 25):
+        # write(key, attrs) persists the attributes of one key
+        self.write = write
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = {}
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def record(self, key: str, attrs: dict):
+        """Buffers attributes for a key, replacing any pending values"""
+        self.pending.setdefault(key, {}).update(attrs)
+
+    def take(self, key: str) -> dict:
+        """Removes and returns the pending attributes of a key so the caller can write them"""
+        return self.pending.pop(key, {})
+
+    async def flush(self) -> int:
+        """Writes every pending update, returns how many keys were written"""
+        pending, self.pending = self.pending, {}
+        items = list(pending.items())
+        written = 0
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            results = await asyncio.gather(
+                *[self.write(key, attrs) for key, attrs in batch], return_exceptions=True
+            )
+            for (key, attrs), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.warning('Error writing buffered update for %s: %s', key, result)
+                    # Values recorded since the flush started are newer
+                    self.pending[key] = {**attrs, **self.pending.get(key, {})}
+                else:
+                    written += 1
+        return written
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def start(self):
+        """Starts flushing in the background"""
+        self._task = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        """Stops the background flushes and writes what is left"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
@@ -0,0 +1,243 @@
+"""
+Endpoint benchmark
+
+Runs the app in process against a local DynamoDB and a stub mail
+transport, drives the account lifecycle endpoints at a fixed concurrency
+and reports latency percentiles, requests/sec and DynamoDB calls per
+request. Results are written as JSON so runs can be compared.
+
+    cd apis && python -m benchmarks.endpoints --users 200 --concurrency 16
+    cd apis && python -m benchmarks.endpoints --endpoint-url http://localhost:8000
+    cd apis && python -m benchmarks.endpoints --compare results/endpoints-abc123.json
+
+Without --endpoint-url DynamoDB is mocked in process with moto, which
+measures the app's own overhead. Pointing it at DynamoDB Local or a moto
+server adds realistic round trips.
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+
+import httpx
+
+from app import config
+from app.registration import MailTransport
+
+PASSWORD = 'BenchP@ssw0rd'
+NEW_PASSWORD = 'BenchP@ssw0rd2'
+
+class StubTransport(MailTransport):
+    """Mail transport that accepts every message without a network round trip"""
+
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, sender: str, recipient: str, message: str):
+        """Counts the message"""
+        self.sent += 1
+
+class CallCounter:
+    """Counts DynamoDB API calls made by botocore"""
+
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, **kwargs):
+        with self._lock:
+            self.calls += 1
+
+def percentile(latencies: list, pct: int) -> float:
+    """Latency at a percentile, in milliseconds"""
+    if len(latencies) < 2:
+        return round(latencies[0] * 1000, 2) if latencies else 0.0
+    return round(statistics.quantiles(latencies, n=100)[pct - 1] * 1000, 2)
+
+async def drive(client: httpx.AsyncClient, path: str, bodies: list, concurrency: int,
+                counter: CallCounter) -> tuple:
+    """Posts every body to the path, concurrency at a time"""
+    latencies = []
+    responses = [None] * len(bodies)
+    errors = 0
+    queue = asyncio.Queue()
+    for item in enumerate(bodies):
+        queue.put_nowait(item)
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            i, body = queue.get_nowait()
+            started = time.perf_counter()
+            response = await client.post(path, json=body)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+            responses[i] = response
+
+    calls = counter.calls
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    stats = {
+        "requests": len(bodies),
+        "errors": errors,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "requests_per_sec": round(len(bodies) / elapsed, 1),
+        "dynamodb_calls_per_request": round((counter.calls - calls) / len(bodies), 2)
+    }
+    return stats, responses
+
+async def run(users: int, concurrency: int) -> dict:
+    """Registers, confirms, logs in, changes the password of and logs out users"""
+    # pylint: disable=import-outside-toplevel
+    from app import registration
+    from app.api import app
+    from app.outbox import Outbox
+    from app.dynamodb_tables import get_resource
+
+    registration.transport = StubTransport()
+    outbox_dir = tempfile.mkdtemp()
+    registration.outbox = Outbox(
+        os.path.join(outbox_dir, 'outbox.db'), registration.deliver_email, poll_interval=0.1
+    )
+
+    counter = CallCounter()
+    get_resource().meta.client.meta.events.register('before-call.dynamodb', counter)
+
+    run_id = int(time.time())
+    usernames = [f'bench{run_id}.{i}@test.com' for i in range(users)]
+    results = {}
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            results['register'], _ = await drive(client, '/register', [
+                {"username": username, "password": PASSWORD} for username in usernames
+            ], concurrency, counter)
+
+            # Access keys are read back from the table, which isn't timed
+            tokens = get_resource().Table(config.TOKENS_TABLE).scan()['Items']
+            keys = {item['UserName']: item['AccessKey'] for item in tokens}
+            results['confirm_email'], _ = await drive(client, '/confirm_email', [
+                {"accessKey": keys.get(username, '')} for username in usernames
+            ], concurrency, counter)
+
+            results['login'], _ = await drive(client, '/login', [
+                {"username": username, "password": PASSWORD} for username in usernames
+            ], concurrency, counter)
+
+            results['update_password'], responses = await drive(client, '/update_password', [
+                {"username": username, "password": PASSWORD, "newPassword": NEW_PASSWORD}
+                for username in usernames
+            ], concurrency, counter)
+
+            session_keys = [
+                response.json().get('sessionKey', '') if response.status_code == 200 else ''
+                for response in responses
+            ]
+            results['logout'], _ = await drive(client, '/logout', [
+                {"username": username, "authKey": session_key}
+                for username, session_key in zip(usernames, session_keys)
+            ], concurrency, counter)
+
+    return results
+
+def start_moto():
+    """Mocks DynamoDB in process"""
+    # pylint: disable=import-outside-toplevel
+    from moto import mock_aws
+    from moto.core.botocore_stubber import BotocoreStubber
+
+    # moto's in-process backend isn't thread safe, so calls from the executor
+    # threads are served one at a time. Use --endpoint-url to measure concurrency.
+    lock = threading.Lock()
+    process_request = BotocoreStubber.process_request
+
+    def serialized(self, request):
+        with lock:
+            return process_request(self, request)
+
+    BotocoreStubber.process_request = serialized
+    mock_aws().start()
+
+def git_commit() -> str:
+    """The commit being benchmarked"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(results: dict, baseline: dict):
+    """Prints the change from a previous run"""
+    print(f'\nChange from {baseline["commit"]}:')
+    for endpoint, stats in results['endpoints'].items():
+        before = baseline['endpoints'].get(endpoint)
+        if not before:
+            continue
+        changes = []
+        for metric in ('p50_ms', 'p99_ms', 'requests_per_sec', 'dynamodb_calls_per_request'):
+            if before[metric]:
+                changes.append(f'{metric} {(stats[metric] / before[metric] - 1) * 100:+.1f}%')
+        print(f'{endpoint:<18}' + ', '.join(changes))
+
+def main():
+    """Runs the benchmark and writes the results"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--endpoint-url', help='DynamoDB Local or moto server URL')
+    parser.add_argument('--output', help='JSON file, defaults to results/endpoints-<commit>.json')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    if args.endpoint_url:
+        config.DYNAMODB_ENDPOINT_URL = args.endpoint_url
+    else:
+        start_moto()
+
+    endpoints = asyncio.run(run(args.users, args.concurrency))
+    results = {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "dynamodb": args.endpoint_url or 'moto',
+        "endpoints": endpoints
+    }
+
+    print(f'{"endpoint":<18}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"req/s":>9}'
+          f'{"ddb/req":>9}{"errors":>8}')
+    for endpoint, stats in endpoints.items():
+        print(f'{endpoint:<18}{stats["p50_ms"]:>9}{stats["p95_ms"]:>9}{stats["p99_ms"]:>9}'
+              f'{stats["requests_per_sec"]:>9}{stats["dynamodb_calls_per_request"]:>9}'
+              f'{stats["errors"]:>8}')
+
+    output = args.output or os.path.join(
+        os.path.dirname(__file__), 'results', f'endpoints-{results["commit"]}.json'
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print(f'\nResults written to {output}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            compare(results, json.load(file))
+
+if __name__ == '__main__':
+    main()
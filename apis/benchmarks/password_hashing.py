@@ -0,0 +1,61 @@
+"""
+Password hashing benchmark
+
+Measures logins per second at the configured scrypt cost, hashing in this
+process and through the process pool used by the API.
+
+    cd apis && python -m benchmarks.password_hashing [--logins 200] [--n 16384]
+"""
+
+import os
+import time
+import asyncio
+import argparse
+
+from app.user import PasswordHasher, password_hasher
+
+def run_inline(hasher: PasswordHasher, pw_hash: str, logins: int) -> float:
+    """Verifies logins one at a time in this process"""
+    started = time.perf_counter()
+    for _ in range(logins):
+        hasher.verify('P@ssw0rd', pw_hash)
+    return logins / (time.perf_counter() - started)
+
+async def run_pool(hasher: PasswordHasher, pw_hash: str, logins: int) -> float:
+    """Verifies logins concurrently in the process pool"""
+    # Start the workers before timing
+    await hasher.verify_async('P@ssw0rd', pw_hash)
+    started = time.perf_counter()
+    pending = set()
+    for _ in range(logins):
+        if len(pending) >= hasher.max_pending:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        pending.add(asyncio.ensure_future(hasher.verify_async('P@ssw0rd', pw_hash)))
+    await asyncio.gather(*pending)
+    return logins / (time.perf_counter() - started)
+
+def main():
+    """Prints logins/sec inline, through the pool and per worker"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--n', type=int, default=password_hasher.n)
+    parser.add_argument('--r', type=int, default=password_hasher.r)
+    parser.add_argument('--p', type=int, default=password_hasher.p)
+    parser.add_argument('--workers', type=int, default=password_hasher.workers or os.cpu_count())
+    args = parser.parse_args()
+
+    hasher = PasswordHasher(args.n, args.r, args.p, args.workers, password_hasher.max_pending)
+    pw_hash = hasher.hash('P@ssw0rd')
+    try:
+        inline = run_inline(hasher, pw_hash, args.logins)
+        pooled = asyncio.run(run_pool(hasher, pw_hash, args.logins))
+    finally:
+        hasher.shutdown()
+
+    print(f'scrypt n={args.n} r={args.r} p={args.p}, {args.logins} logins')
+    print(f'inline:             {inline:8.1f} logins/sec ({1000 / inline:.1f} ms each)')
+    print(f'pool of {args.workers:3d} workers: {pooled:8.1f} logins/sec')
+    print(f'per worker:         {pooled / args.workers:8.1f} logins/sec')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Response serialization benchmark
+
+Compares the response path handlers used to take, a dict with the
+statusCode/headers envelope that FastAPI validated against the response
+model and encoded again with the json module, against APIResponse, which
+serializes the body once with orjson.
+
+    cd apis && python -m benchmarks.responses [--runs 20000]
+"""
+
+import json
+import time
+import asyncio
+import argparse
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.models import LoggedInUser
+from app.util import APIResponse, ENVELOPE_HEADERS
+
+LOGGED_IN = {
+    "username": "user@test.com",
+    "role": "viewer",
+    "authKey": "2f1c0a5e-8d4b-4a43-9c1e-5b7f3d2a9e10",
+    "sessionKey": "7b9e2d14-3c6a-4f8e-a1d2-0e5c9b4f7a36",
+    "message": "Login success"
+}
+HISTORY = {
+    "queries": [{
+        "queryId": str(1000 + i),
+        "query": f"How do I reset my password? ({i})",
+        "response": "Use the link on the login page to get a reset email." * 4,
+        "createdAt": 1700000000000 + i
+    } for i in range(20)],
+    "cursor": "WzE3MDAwMDAwMDAwMDAsIDEwMDBd"
+}
+
+# Endpoint shapes: the response model FastAPI validated against, if any, and a body
+PAYLOADS = {
+    'login': (LoggedInUser, LOGGED_IN),
+    'query history': (None, HISTORY),
+}
+
+async def envelope_path(field, body: dict) -> JSONResponse:
+    """A dict with the envelope, validated, encoded and dumped by FastAPI"""
+    content = {**body, "statusCode": 200, "headers": dict(ENVELOPE_HEADERS)}
+    content = await serialize_response(field=field, response_content=content)
+    return JSONResponse(content)
+
+async def direct_path(field, body: dict) -> APIResponse:
+    """An APIResponse returned by the handler"""
+    return APIResponse(body, 200)
+
+async def per_response(path, field, body: dict, runs: int) -> float:
+    """Microseconds per response"""
+    started = time.perf_counter()
+    for _ in range(runs):
+        await path(field, body)
+    return (time.perf_counter() - started) / runs * 1e6
+
+async def run(runs: int):
+    """Prints microseconds and bytes per response for each payload and path"""
+    print(f'{"payload":<16}{"envelope µs":>13}{"direct µs":>11}{"speedup":>9}'
+          f'{"envelope B":>12}{"direct B":>10}')
+    for name, (model, body) in PAYLOADS.items():
+        field = model and create_response_field(name=f'Response_{name}', type_=model,
+                                                mode='serialization')
+        old = await envelope_path(field, body)
+        new = await direct_path(field, body)
+        # Same data, less the envelope and any fields the response model dropped
+        old_body = json.loads(old.body)
+        assert {key: value for key, value in json.loads(new.body).items() if key in old_body} == \
+               {key: value for key, value in old_body.items() if key in body}
+
+        envelope = await per_response(envelope_path, field, body, runs)
+        direct = await per_response(direct_path, field, body, runs)
+        print(f'{name:<16}{envelope:>13.1f}{direct:>11.1f}{envelope / direct:>8.1f}x'
+              f'{len(old.body):>12}{len(new.body):>10}')
+
+def main():
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(run(args.runs))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Credential validation benchmark
+
+Compares checking credentials in the handler after parsing, as the API
+used to, against rejecting them while the request model is parsed.
+
+    cd apis && python -m benchmarks.validation [--runs 2000]
+"""
+
+import json
+import timeit
+import argparse
+
+from pydantic import BaseModel, ValidationError
+
+from app.models import NewUser
+from app.user import is_valid_user, is_valid_password
+
+class UncheckedUser(BaseModel):
+    """NewUser before the credential checks moved into the model"""
+    username: str
+    password: str
+
+PAYLOADS = {
+    'valid': {"username": "user@test.com", "password": "ValidP@ssw0rd"},
+    'bad username': {"username": "TestUser", "password": "ValidP@ssw0rd"},
+    'long username': {"username": "a" * 100000, "password": "ValidP@ssw0rd"},
+    'long local part': {"username": "a." * 50000 + "@test.com", "password": "ValidP@ssw0rd"},
+    'long quoted part': {"username": '"' + "a" * 100000, "password": "ValidP@ssw0rd"},
+    'long password': {"username": "user@test.com", "password": "aA1_" * 25000},
+}
+
+def handler_path(body: bytes) -> bool:
+    """Parse, then validate in the handler"""
+    user = UncheckedUser.model_validate_json(body)
+    return is_valid_user(user.username) and is_valid_password(user.password)
+
+def model_path(body: bytes) -> bool:
+    """Validate while parsing"""
+    try:
+        NewUser.model_validate_json(body)
+    except ValidationError:
+        return False
+    return True
+
+def main():
+    """Prints microseconds per request for each payload and path"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f'{"payload":<18}{"handler µs":>12}{"model µs":>12}{"speedup":>10}')
+    for name, payload in PAYLOADS.items():
+        body = json.dumps(payload).encode()
+        assert handler_path(body) == model_path(body)
+        handler = timeit.timeit(lambda: handler_path(body), number=args.runs) / args.runs * 1e6
+        model = timeit.timeit(lambda: model_path(body), number=args.runs) / args.runs * 1e6
+        print(f'{name:<18}{handler:>12.1f}{model:>12.1f}{handler / model:>9.1f}x')
+
+if __name__ == '__main__':
+    main()
@@ -2,33 +2,78 @@
 Test api methods
 """
 
+import json
+import asyncio
+import uuid
+
 import pytest
 
+from pydantic import ValidationError
 from fastapi.exceptions import HTTPException
+from fastapi.testclient import TestClient
+from app import api
 from app import config
-from app.api import confirm_email, \
+from app import registration
+from app import rate_limit
+from app.outbox import Outbox
+from app.rate_limit import FailureLimiter, TooManyAttempts
+from app.session import validate_session_key
+from app.api import app, \
+                confirm_email, \
                 reset_password, \
                 register, \
                 set_new_password, \
                 update_password, \
-                login
+                login, \
+                logout_all, \
+                save_queries, \
+                get_query_history, \
+                flag_doc, \
+                get_flag_queue, \
+                resolve
 
 from app.models import EmailConfirmation, \
                 ResetPassword, \
                 UpdatePassword, \
                 NewUser, \
                 ExistingUser, \
-                SetNewPassword
+                SetNewPassword, \
+                AuthenticatingUser, \
+                QueryLog, \
+                QueryHistory, \
+                FlagDocument, \
+                FlagQueue, \
+                ResolveFlags
 
-from app.dynamodb_tables import get_users_table, get_tokens_table
+from app.dynamodb_tables import get_users_table, get_tokens_table, get_sessions_table
 
 from app.util import http_response
+from app.queries import query_buffer, query_ids
 
 users_table = get_users_table(config.USERS_TABLE)
 tokens_table = get_tokens_table(config.TOKENS_TABLE)
+sessions_table = get_sessions_table(config.SESSIONS_TABLE)
+
+def body(response, status_code: int = 200) -> dict:
+    """The JSON body of a handler's response, checking its status"""
+    assert response.status_code == status_code
+    return json.loads(response.body)
+
+@pytest.fixture(autouse=True)
+def outbox(mocker, tmp_path):
+    """Queue emails in a temporary outbox"""
+    mocker.patch.object(registration, 'outbox', Outbox(str(tmp_path / 'outbox.db'), None))
+
+@pytest.fixture(autouse=True)
+def limiters(mocker):
+    """Count failed logins in fresh limiters"""
+    mocker.patch.object(rate_limit, 'local_limiters', {
+        "user": FailureLimiter(2, 600),
+        "ip": FailureLimiter(10, 600)
+    })
 
 @pytest.mark.asyncio
-async def test_confirm_email(mocker):
+async def test_confirm_email(mocker, max_round_trips):
     """Test confirm_email"""
     mocker.patch('uuid.uuid4', return_value='uuid1234')
 
@@ -55,30 +100,34 @@ async def test_confirm_email(mocker):
 
     # create db entry for test user to test sucess
     event = EmailConfirmation(accessKey="abc123")
-    assert await confirm_email(event) == http_response(200, {
+    with max_round_trips(5):
+        result = await confirm_email(event)
+    assert body(result) == {
         "username": "user@test.com",
         "role": "viewer",
         "authKey": "uuid1234",
         "sessionKey": "uuid1234",
         "message": "Email confirmed"
         
-    })
+    }
 
     tokens_table.delete_item(Key={"AccessKey": "abc123"})
     users_table.delete_item(Key={"UserName": "user@test.com"})
 
 @pytest.mark.asyncio
-async def test_reset_password(mocker):
+async def test_reset_password(mocker, max_round_trips):
     """Test reset password"""
     mocker.patch('uuid.uuid4', return_value='uuid1234')
     mocker.patch('smtplib.SMTP_SSL')
     # @todo, this test should fail
     event = ResetPassword(username="testuser@gmail.com")
-    assert await reset_password(event) == http_response(200, { "message": "Password reset email sent." })
+    with max_round_trips(1):
+        result = await reset_password(event)
+    assert body(result) == {"message": "Password reset email sent."}
     tokens_table.delete_item(Key={"AccessKey": "uuid1234"})
 
 @pytest.mark.asyncio
-async def test_set_new_password(mocker):
+async def test_set_new_password(mocker, max_round_trips):
     """Test set_new_password"""
     mocker.patch('uuid.uuid4', return_value='uuid1234')
     tokens_table.put_item(Item={
@@ -101,18 +150,20 @@ async def test_set_new_password(mocker):
         accessKey="abc123"
     )
 
-    assert await set_new_password(event) == http_response(200, {
+    with max_round_trips(6):
+        result = await set_new_password(event)
+    assert body(result) == {
         "username": "user@test.com",
         "role": "viewer",
         "authKey": "abc12345",
         "sessionKey": "uuid1234",
         "message": "New password set."
-    })
+    }
     tokens_table.delete_item(Key={"AccessKey": "abc123"})
     users_table.delete_item(Key={"UserName": "user@test.com"})
 
 @pytest.mark.asyncio
-async def test_update_password(mocker):
+async def test_update_password(mocker, max_round_trips):
     """Test update_password"""
     mocker.patch('uuid.uuid4', return_value='uuid1234')
     tokens_table.put_item(Item={
@@ -135,17 +186,19 @@ async def test_update_password(mocker):
         newPassword="NewP@ssw0rd"
     )
 
-    assert await update_password(event) == http_response(200, {
+    with max_round_trips(4):
+        result = await update_password(event)
+    assert body(result) == {
         "username": "user@test.com",
         "role": "viewer",
         "authKey": "abc12345",
         "sessionKey": "uuid1234",
-        "message": "Password updated."})
+        "message": "Password updated."}
     tokens_table.delete_item(Key={"AccessKey": "abc123"})
     users_table.delete_item(Key={"UserName": "user@test.com"})
 
 @pytest.mark.asyncio
-async def test_register(mocker):
+async def test_register(mocker, max_round_trips):
     """Test register"""
     mocker.patch('uuid.uuid4', return_value='uuid1234')
     mocker.patch('smtplib.SMTP_SSL')
@@ -155,12 +208,14 @@ async def test_register(mocker):
         username="user@test.com",
         password="ValidP@ssw0rd"
     )
-    assert await register(event) == http_response(201, { "message": "Registration success" })
+    with max_round_trips(3):
+        result = await register(event)
+    assert body(result, 201) == {"message": "Registration success"}
     users_table.delete_item(Key={"UserName": "user@test.com"})
     tokens_table.delete_item(Key={"AccessKey": "uuid1234"})
 
 @pytest.mark.asyncio
-async def test_login(mocker):
+async def test_login(mocker, max_round_trips):
     """Test login"""
     mocker.patch('uuid.uuid4', return_value='uuid1234')
     tokens_table.put_item(Item={
@@ -182,13 +237,197 @@ async def test_login(mocker):
         password="ValidP@ssw0rd",
         authKey="abc12345"
     )
-    assert await login(event) == http_response(200, {
+    with max_round_trips(2):
+        result = await login(event)
+    assert body(result) == {
         "username": "user@test.com",
         "role": "viewer",
         "authKey": "abc12345",
         "sessionKey": "uuid1234",
         "message": "Login success"
-    })
+    }
+    # The legacy SHA3 hash is upgraded on a successful login
+    pw_hash = users_table.get_item(Key={"UserName": "user@test.com"})['Item']['Password']
+    assert pw_hash.startswith('scrypt$')
 
     tokens_table.delete_item(Key={"AccessKey": "abc123"})
     users_table.delete_item(Key={"UserName": "user@test.com"})
+
+def test_invalid_credentials():
+    """Test malformed credentials are rejected while parsing the request"""
+    for username, password in [
+        ("TestUser", "ValidP@ssw0rd"),
+        ("user@test.com", "thiswontwork"),
+        ("user@test.com", "ValidP@ssw0rd" * 2),
+        ("a" * 300 + "@test.com", "ValidP@ssw0rd"),
+    ]:
+        with pytest.raises(ValidationError):
+            NewUser(username=username, password=password)
+
+    with pytest.raises(ValidationError):
+        UpdatePassword(username="user@test.com", password="OldP@ssw0rd", newPassword="short")
+
+    client = TestClient(app)
+    response = client.post('/login', json={"username": "TestUser", "password": "ValidP@ssw0rd"})
+    assert response.status_code == 403
+    assert response.json() == {"detail": "Forbidden"}
+
+    # Other validation errors keep FastAPI's 422
+    response = client.post('/login', json={"username": "user@test.com"})
+    assert response.status_code == 422
+
+def test_login_lockout():
+    """Test failed logins lock the user out before the password is checked"""
+    users_table.put_item(Item={
+        "UserName": "locked@test.com",
+        "Password": "8d3f8e0d344be93893a5ca049c2ce630471c5f7557156487bfd7e98fb82f1e44",
+        "AuthKey": "abc12345"
+    })
+    client = TestClient(app)
+    body = {"username": "locked@test.com", "password": "WrongP@ssw0rd"}
+    assert client.post('/login', json=body).status_code == 401
+    assert client.post('/login', json=body).status_code == 401
+
+    # Even the right password is refused until the lockout ends
+    response = client.post('/login', json={**body, "password": "ValidP@ssw0rd"})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+
+    users_table.delete_item(Key={"UserName": "locked@test.com"})
+
+@pytest.mark.asyncio
+async def test_concurrent_login_lockout(mocker):
+    """Test concurrent bad logins can't all get past the lockout while the first is verified"""
+    users_table.put_item(Item={
+        "UserName": "burst@test.com",
+        "Password": "8d3f8e0d344be93893a5ca049c2ce630471c5f7557156487bfd7e98fb82f1e44",
+        "AuthKey": "abc12345"
+    })
+    verify = mocker.spy(api, 'verify_password')
+    event = ExistingUser(username="burst@test.com", password="WrongP@ssw0rd")
+
+    results = await asyncio.gather(*[login(event) for _ in range(20)], return_exceptions=True)
+
+    # The user limiter allows 2 failures
+    assert verify.call_count <= 2
+    assert sum(isinstance(result, TooManyAttempts) for result in results) >= 18
+
+    users_table.delete_item(Key={"UserName": "burst@test.com"})
+
+@pytest.mark.asyncio
+async def test_logout_all():
+    """Test logout_all revokes every session of the user"""
+    users_table.put_item(Item={"UserName": "everywhere@test.com", "AuthKey": "session2"})
+    for i in range(3):
+        sessions_table.put_item(Item={
+            "SessionKey": f"session{i}",
+            "UserName": "everywhere@test.com",
+            "Active": True,
+            "CreatedAt": i
+        })
+
+    with pytest.raises(HTTPException) as err:
+        await logout_all(AuthenticatingUser(username="other@test.com", authKey="session2"))
+    assert err.value.status_code == 401
+
+    event = AuthenticatingUser(username="everywhere@test.com", authKey="session2")
+    assert body(await logout_all(event))["sessions"] == 3
+    for i in range(3):
+        assert not sessions_table.get_item(Key={"SessionKey": f"session{i}"}).get('Item')
+
+    users_table.delete_item(Key={"UserName": "everywhere@test.com"})
+
+@pytest.mark.asyncio
+async def test_queries(max_round_trips):
+    """Test logged queries are buffered without a round trip and read back a page at a time"""
+    sessions_table.put_item(Item={"SessionKey": "asker1234", "UserName": "asker@test.com",
+                                  "Active": True})
+    await validate_session_key("asker1234")
+
+    with pytest.raises(HTTPException) as err:
+        await save_queries(QueryLog(username="other@test.com", authKey="asker1234",
+                                    queries=[{"query": "g?"}]))
+    assert err.value.status_code == 401
+
+    # Once a block of QueryIds is leased, logging queries makes no round trips
+    await query_ids.take()
+    with max_round_trips(0):
+        response = body(await save_queries(QueryLog(
+            username="asker@test.com", authKey="asker1234",
+            queries=[{"query": f"q{i}", "response": f"a{i}"} for i in range(5)]
+        )), 202)
+    assert len(response["queryIds"]) == 5
+    assert await query_buffer.flush() == 5
+
+    seen = []
+    cursor = ''
+    while True:
+        page = body(await get_query_history(QueryHistory(
+            username="asker@test.com", authKey="asker1234", limit=2, cursor=cursor
+        )))
+        seen += page["queries"]
+        cursor = page["cursor"]
+        if not cursor:
+            break
+    assert sorted(query["queryId"] for query in seen) == sorted(response["queryIds"])
+    assert {query["query"] for query in seen} == {f"q{i}" for i in range(5)}
+
+    with pytest.raises(HTTPException) as err:
+        await get_query_history(QueryHistory(username="asker@test.com", authKey="asker1234",
+                                             cursor="not a cursor"))
+    assert err.value.status_code == 400
+
+    sessions_table.delete_item(Key={"SessionKey": "asker1234"})
+
+def test_queries_backpressure(mocker):
+    """Test queries are refused with a 503 while the buffer is full"""
+    mocker.patch('app.api.validate_session_key', return_value="asker@test.com")
+    mocker.patch.object(query_buffer, 'max_pending', 0)
+    client = TestClient(app)
+
+    response = client.post('/queries', json={
+        "username": "asker@test.com", "authKey": "asker1234", "queries": [{"query": "q"}]
+    })
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+@pytest.mark.asyncio
+async def test_flags():
+    """Test repeated flags of a document are merged and moderators resolve them in bulk"""
+    users_table.put_item(Item={"UserName": "reader@test.com", "AuthRole": "viewer"})
+    users_table.put_item(Item={"UserName": "mod@test.com", "AuthRole": "moderator"})
+    for key, username in (("reader1234", "reader@test.com"), ("mod1234", "mod@test.com")):
+        sessions_table.put_item(Item={"SessionKey": key, "UserName": username, "Active": True})
+    document = "doc-" + str(uuid.uuid4())
+
+    first = body(await flag_doc(FlagDocument(username="reader@test.com", authKey="reader1234",
+                                             documentId=document)))
+    again = body(await flag_doc(FlagDocument(username="reader@test.com", authKey="reader1234",
+                                             documentId=document, reason="spam")))
+    assert again["flaggedId"] == first["flaggedId"]
+    assert again["flagCount"] == 2
+    assert again["reason"] == "spam"
+
+    with pytest.raises(HTTPException) as err:
+        await get_flag_queue(FlagQueue(username="reader@test.com", authKey="reader1234"))
+    assert err.value.status_code == 403
+
+    queue = body(await get_flag_queue(FlagQueue(username="mod@test.com", authKey="mod1234",
+                                                limit=100)))
+    assert again["flaggedId"] in [flag["flaggedId"] for flag in queue["flags"]]
+
+    response = body(await resolve(ResolveFlags(username="mod@test.com", authKey="mod1234",
+                                               flaggedIds=[again["flaggedId"]] * 2)))
+    assert response["resolved"] == [again["flaggedId"]]
+    queue = body(await get_flag_queue(FlagQueue(username="mod@test.com", authKey="mod1234",
+                                                status="resolved", limit=100)))
+    assert again["flaggedId"] in [flag["flaggedId"] for flag in queue["flags"]]
+
+    with pytest.raises(HTTPException) as err:
+        await get_flag_queue(FlagQueue(username="mod@test.com", authKey="mod1234", cursor="bad"))
+    assert err.value.status_code == 400
+
+    for username in ("reader@test.com", "mod@test.com"):
+        users_table.delete_item(Key={"UserName": username})
+    for key in ("reader1234", "mod1234"):
+        sessions_table.delete_item(Key={"SessionKey": key})
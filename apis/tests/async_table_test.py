@@ -0,0 +1,51 @@
+"""
+Test async_table
+"""
+
+import time
+import threading
+import asyncio
+
+import pytest
+
+from app import config
+from app.async_table import AsyncTable, run_blocking
+from app.dynamodb_tables import get_users_table
+
+@pytest.mark.asyncio
+async def test_run_blocking():
+    """Test run_blocking overlaps blocking calls"""
+    start = time.perf_counter()
+    results = await asyncio.gather(*[run_blocking(time.sleep, 0.1) for _ in range(5)])
+    assert results == [None] * 5
+    assert time.perf_counter() - start < 0.4
+
+@pytest.mark.asyncio
+async def test_async_table():
+    """Test AsyncTable"""
+    table = AsyncTable(get_users_table(config.USERS_TABLE))
+    assert table.name == config.USERS_TABLE
+
+    await table.put_item(Item={"UserName": "user@test.com", "AuthRole": "viewer"})
+    response = await table.get_item(Key={"UserName": "user@test.com"})
+    assert response.get('Item') == {"UserName": "user@test.com", "AuthRole": "viewer"}
+
+    await table.delete_item(Key={"UserName": "user@test.com"})
+    response = await table.get_item(Key={"UserName": "user@test.com"})
+    assert response.get('Item') is None
+
+@pytest.mark.asyncio
+async def test_async_table_resolved_off_the_loop():
+    """Test a table set up on first use isn't set up on the event loop"""
+    threads = []
+
+    def factory():
+        threads.append(threading.current_thread())
+        return get_users_table(config.USERS_TABLE)
+
+    table = AsyncTable(factory)
+    await asyncio.gather(*[table.get_item(Key={"UserName": "user@test.com"}) for _ in range(3)])
+
+    # Once, by whichever call came first
+    assert len(threads) == 1
+    assert threads[0] is not threading.main_thread()
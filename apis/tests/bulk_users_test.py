@@ -0,0 +1,157 @@
+"""
+Test bulk user import and export
+"""
+
+import json
+
+import pytest
+
+from app import bulk_users
+from app.bulk_users import import_users, export_users, write_batch, AdaptiveRate, \
+                           Checkpoint, BulkError
+from app.dynamodb_tables import get_users_table
+
+def empty(table):
+    """Deletes every item, the table itself stays known to dynamodb_tables"""
+    with table.batch_writer() as batch:
+        for item in table.scan(ProjectionExpression='UserName')['Items']:
+            batch.delete_item(Key=item)
+
+@pytest.fixture
+def table():
+    """An empty users table"""
+    table = get_users_table("BulkTest")
+    yield table
+    empty(table)
+
+def user(i: int) -> dict:
+    """A user record"""
+    return {"UserName": f"user{i}@test.com", "Password": f"scrypt$hash{i}", "AuthRole": "viewer",
+            "Valid": True}
+
+def write_jsonl(path, records: list):
+    """Writes records as JSONL"""
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+
+def test_import_jsonl(table, tmp_path):
+    """Test users are imported, invalid records skipped and duplicates written once"""
+    path = tmp_path / 'users.jsonl'
+    write_jsonl(path, [user(i) for i in range(60)] + [{"UserName": "bad"}, user(3)])
+
+    stats = import_users(str(path), "BulkTest", workers=1, checkpoint_path=str(tmp_path / 'cp'))
+
+    assert stats["rejected"] == 1
+    items = table.scan()['Items']
+    assert len(items) == 60
+    assert {"UserName": "user7@test.com", "Password": "scrypt$hash7", "AuthRole": "viewer",
+            "Valid": True} in items
+    # A finished run leaves no checkpoint
+    assert not (tmp_path / 'cp').exists()
+
+def test_import_ends_with_invalid_record(table, tmp_path, mocker):
+    """Test a batch of only rejected records is counted without a write"""
+    path = tmp_path / 'users.jsonl'
+    write_jsonl(path, [user(i) for i in range(25)] + [{"UserName": "bad"}])
+    save = mocker.spy(Checkpoint, 'save')
+
+    stats = import_users(str(path), "BulkTest", workers=2, checkpoint_path=str(tmp_path / 'cp'))
+
+    assert stats["written"] == 25
+    assert stats["rejected"] == 1
+    assert len(table.scan()['Items']) == 25
+    # The checkpoint moved past the rejected record too
+    state = save.call_args.args[1]
+    assert (state["record"], state["written"], state["rejected"]) == (26, 25, 1)
+
+def test_import_resumes(table, tmp_path):
+    """Test an import continues after the records its checkpoint covers"""
+    path = tmp_path / 'users.jsonl'
+    write_jsonl(path, [user(i) for i in range(30)])
+    Checkpoint(str(tmp_path / 'cp')).save({
+        "input": str(path), "record": 25, "written": 25, "rejected": 0
+    })
+
+    stats = import_users(str(path), "BulkTest", workers=1, checkpoint_path=str(tmp_path / 'cp'))
+
+    assert stats["written"] == 5
+    assert {item['UserName'] for item in table.scan()['Items']} == {
+        f"user{i}@test.com" for i in range(25, 30)
+    }
+
+def test_import_checkpoint_for_another_file(table, tmp_path):
+    """Test a checkpoint isn't applied to a different input"""
+    path = tmp_path / 'users.jsonl'
+    write_jsonl(path, [user(0)])
+    Checkpoint(str(tmp_path / 'cp')).save({"input": "/other.jsonl", "record": 1})
+
+    with pytest.raises(BulkError):
+        import_users(str(path), "BulkTest", checkpoint_path=str(tmp_path / 'cp'))
+
+def test_write_batch_retries_unprocessed_items(mocker):
+    """Test unprocessed items are written again and slow the rate down"""
+    items = [user(i) for i in range(3)]
+    unprocessed = [{"PutRequest": {"Item": items[2]}}]
+    client = mocker.Mock()
+    client.batch_write_item.side_effect = [
+        {"UnprocessedItems": {"BulkTest": unprocessed}},
+        {"UnprocessedItems": {}}
+    ]
+    rate = AdaptiveRate(1000)
+
+    assert write_batch(client, "BulkTest", items, rate, base_delay=0) == 1
+    retried = client.batch_write_item.call_args_list[1].kwargs['RequestItems']['BulkTest']
+    assert retried == unprocessed
+    # Halved by the throttle, then raised one step
+    assert rate.rate == 600
+
+    client.batch_write_item.side_effect = None
+    client.batch_write_item.return_value = {"UnprocessedItems": {"BulkTest": unprocessed}}
+    with pytest.raises(BulkError):
+        write_batch(client, "BulkTest", items, rate, max_attempts=2, base_delay=0)
+
+@pytest.mark.parametrize('name', ['users.jsonl', 'users.csv'])
+def test_export_round_trip(table, tmp_path, name):
+    """Test a segmented export can be imported back"""
+    for i in range(40):
+        table.put_item(Item=user(i))
+    path = tmp_path / name
+
+    assert export_users(str(path), "BulkTest", segments=3, page_size=7) == 40
+
+    import_table = get_users_table("BulkImportTest")
+    import_users(str(path), "BulkImportTest", workers=1)
+    assert sorted(import_table.scan()['Items'], key=lambda item: item['UserName']) == \
+           sorted(table.scan()['Items'], key=lambda item: item['UserName'])
+    empty(import_table)
+
+class FlakyTable:
+    """Table whose second scan fails"""
+
+    def __init__(self, table):
+        self.table = table
+        self.calls = 0
+
+    def scan(self, **kwargs):
+        """Scans the table, failing the second time"""
+        self.calls += 1
+        if self.calls == 2:
+            raise RuntimeError('connection reset')
+        return self.table.scan(**kwargs)
+
+def test_export_resumes(table, tmp_path, mocker):
+    """Test a failed export continues after the pages it already wrote"""
+    for i in range(20):
+        table.put_item(Item=user(i))
+    mocker.patch.object(bulk_users, 'get_resource').return_value.Table.return_value = \
+        FlakyTable(table)
+    path = tmp_path / 'users.jsonl'
+    checkpoint = str(tmp_path / 'cp')
+
+    with pytest.raises(BulkError):
+        export_users(str(path), "BulkTest", segments=1, page_size=5, checkpoint_path=checkpoint)
+    assert Checkpoint(checkpoint).load()["exported"] == 5
+
+    assert export_users(str(path), "BulkTest", segments=1, page_size=5,
+                        checkpoint_path=checkpoint) == 15
+    usernames = [json.loads(line)['UserName'] for line in path.read_text().splitlines()]
+    assert sorted(usernames) == sorted(f"user{i}@test.com" for i in range(20))
@@ -0,0 +1,64 @@
+"""
+Test cache
+"""
+
+from app.cache import TTLCache
+
+class FakeClock:
+    """Clock that only moves when told to"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_ttl_cache():
+    """Test hits, misses and expiry"""
+    clock = FakeClock()
+    cache = TTLCache(maxsize=10, ttl=30, negative_ttl=5, clock=clock)
+
+    assert cache.lookup("a") == (False, None)
+    cache.set("a", "user@test.com")
+    cache.set("b", None)
+    assert cache.lookup("a") == (True, "user@test.com")
+    assert cache.lookup("b") == (True, None)
+
+    # Negative entries expire first
+    clock.now = 10
+    assert cache.lookup("a") == (True, "user@test.com")
+    assert cache.lookup("b") == (False, None)
+
+    clock.now = 31
+    assert cache.lookup("a") == (False, None)
+
+    assert cache.stats() == {
+        "size": 0,
+        "hits": 3,
+        "misses": 3,
+        "evictions": 0,
+        "expirations": 2
+    }
+
+def test_ttl_cache_evicts_least_recently_used():
+    """Test the cache stays bounded"""
+    cache = TTLCache(maxsize=2, ttl=30)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.lookup("a")
+    cache.set("c", 3)
+
+    assert len(cache) == 2
+    assert cache.lookup("b") == (False, None)
+    assert cache.lookup("a") == (True, 1)
+    assert cache.lookup("c") == (True, 3)
+    assert cache.evictions == 1
+
+def test_ttl_cache_invalidate():
+    """Test invalidate and clear"""
+    cache = TTLCache(maxsize=10, ttl=30)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.invalidate("a")
+    assert cache.lookup("a") == (False, None)
+    cache.clear()
+    assert len(cache) == 0
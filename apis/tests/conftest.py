@@ -0,0 +1,20 @@
+"""
+Shared test fixtures
+"""
+
+import contextlib
+
+import pytest
+
+from app.request_stats import track
+
+@pytest.fixture
+def max_round_trips():
+    """Fails the test if the block makes more DynamoDB calls than its budget"""
+    @contextlib.contextmanager
+    def check(budget: int):
+        with track() as stats:
+            yield stats
+        assert stats.calls <= budget, \
+            f'{stats.calls} DynamoDB round trips over a budget of {budget}: {dict(stats.operations)}'
+    return check
@@ -5,8 +5,26 @@ Test dynamodb_tables
 from datetime import datetime
 from decimal import Decimal
 
+import pytest
+from botocore.exceptions import ClientError
+
+from app import dynamodb_tables
 from app.dynamodb_tables import get_users_table, get_tokens_table, get_sessions_table
 from app.dynamodb_tables import get_queries_table, get_flagged_docs_table
+from app.dynamodb_tables import get_resource, ensure_tables
+
+@pytest.fixture
+def api_calls():
+    """Records the DynamoDB operations called"""
+    calls = []
+
+    def record(event_name, **kwargs):
+        calls.append(event_name.split('.')[-1])
+
+    events = get_resource().meta.client.meta.events
+    events.register('before-call.dynamodb', record)
+    yield calls
+    events.unregister('before-call.dynamodb', record)
 
 def test_get_users_table():
     """get_users_table"""
@@ -119,3 +137,96 @@ def test_get_flagged_docs_table():
     }
 
     table.delete_item(Key={"FlaggedId": 1234})
+
+def test_ensure_tables(mocker, api_calls):
+    """Test tables are listed once per process and only missing ones are created"""
+    mocker.patch.object(dynamodb_tables, '_existing_tables', None)
+
+    tables = ensure_tables({"Users": "users", "RegistryTest": "sessions"})
+    assert set(tables) == {"Users", "RegistryTest"}
+    assert api_calls.count('ListTables') == 1
+    assert api_calls.count('CreateTable') == 1
+
+    get_users_table("Users")
+    get_sessions_table("RegistryTest")
+    assert api_calls.count('ListTables') == 1
+    assert api_calls.count('CreateTable') == 1
+
+    key_schema = get_resource().Table("RegistryTest").key_schema
+    assert key_schema == [{"AttributeName": "SessionKey", "KeyType": "HASH"}]
+
+    # Sessions expire through TTL, which is only turned on once
+    ttl = get_resource().meta.client.describe_time_to_live(TableName="RegistryTest")
+    assert ttl['TimeToLiveDescription'] == {
+        "TimeToLiveStatus": "ENABLED",
+        "AttributeName": "ExpiresAt"
+    }
+    assert api_calls.count('UpdateTimeToLive') == 1
+
+    get_resource().Table("RegistryTest").delete()
+
+def test_ensure_tables_assume_exist(mocker, api_calls):
+    """Test no control plane calls are made when tables are assumed to exist"""
+    mocker.patch.object(dynamodb_tables, '_existing_tables', None)
+    mocker.patch.object(dynamodb_tables, 'ASSUME_TABLES_EXIST', True)
+
+    assert get_users_table("Users").name == "Users"
+    assert not api_calls
+
+def test_ensure_tables_adds_indexes(mocker, api_calls):
+    """Test indexes are added to tables created before they were defined"""
+    mocker.patch.object(dynamodb_tables, '_existing_tables', None)
+    schema = dict(dynamodb_tables.TABLE_SCHEMAS["sessions"])
+    del schema["GlobalSecondaryIndexes"]
+    schema["AttributeDefinitions"] = schema["AttributeDefinitions"][:1]
+    get_resource().meta.client.create_table(TableName="OldSessions", **schema)
+
+    ensure_tables({"OldSessions": "sessions"})
+    assert api_calls.count('UpdateTable') == 1
+    indexes = get_resource().Table("OldSessions").global_secondary_indexes
+    assert [index['IndexName'] for index in indexes] == [dynamodb_tables.USER_SESSIONS_INDEX]
+
+    ensure_tables({"OldSessions": "sessions"})
+    assert api_calls.count('UpdateTable') == 1
+
+    get_resource().Table("OldSessions").delete()
+
+def test_ensure_tables_waits_for_busy_tables(mocker):
+    """Test index creation waits for the table to be ACTIVE and retries while it is busy"""
+    mocker.patch.object(dynamodb_tables, '_existing_tables', None)
+    mocker.patch.object(dynamodb_tables, 'INDEX_WAIT_DELAY', 0)
+    schema = dict(dynamodb_tables.TABLE_SCHEMAS["sessions"])
+    del schema["GlobalSecondaryIndexes"]
+    schema["AttributeDefinitions"] = schema["AttributeDefinitions"][:1]
+    client = get_resource().meta.client
+    client.create_table(TableName="BusySessions", **schema)
+
+    # Another index is still building at first, then the update races another process
+    describe_table, update_table = client.describe_table, client.update_table
+    statuses = ['UPDATING']
+
+    def describe(**kwargs):
+        table = describe_table(**kwargs)
+        if statuses:
+            table['Table']['TableStatus'] = statuses.pop()
+        return table
+
+    errors = [ClientError({"Error": {"Code": "ResourceInUseException"}}, 'UpdateTable')]
+
+    def update(**kwargs):
+        if errors:
+            raise errors.pop()
+        return update_table(**kwargs)
+
+    describe_spy = mocker.patch.object(client, 'describe_table', side_effect=describe)
+    update_spy = mocker.patch.object(client, 'update_table', side_effect=update)
+
+    ensure_tables({"BusySessions": "sessions"})
+    assert update_spy.call_count == 2
+    # UPDATING once, then ACTIVE before each of the two updates and after the last
+    assert describe_spy.call_count == 4
+    indexes = get_resource().Table("BusySessions").global_secondary_indexes
+    assert [index['IndexName'] for index in indexes] == [dynamodb_tables.USER_SESSIONS_INDEX]
+
+    mocker.stopall()
+    get_resource().Table("BusySessions").delete()
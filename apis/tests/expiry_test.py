@@ -0,0 +1,27 @@
+"""
+Test expiry
+"""
+
+import time
+
+from app.expiry import expires_at, is_expired, sweep_expired
+from app.dynamodb_tables import get_sessions_table
+
+def test_is_expired():
+    """Test items expire at their ExpiresAt, items without one never do"""
+    assert not is_expired({"ExpiresAt": expires_at(60)})
+    assert is_expired({"ExpiresAt": int(time.time()) - 1})
+    assert not is_expired({"Active": True})
+
+def test_sweep_expired():
+    """Test only expired items are deleted"""
+    table = get_sessions_table("SweepTest")
+    table.put_item(Item={"SessionKey": "expired", "ExpiresAt": int(time.time()) - 1})
+    table.put_item(Item={"SessionKey": "current", "ExpiresAt": expires_at(60)})
+    table.put_item(Item={"SessionKey": "legacy"})
+
+    assert sweep_expired(table) == 1
+    keys = {item['SessionKey'] for item in table.scan()['Items']}
+    assert keys == {"current", "legacy"}
+
+    table.delete()
@@ -0,0 +1,11 @@
+"""
+Test the moderation queue
+"""
+
+from app.flags import flagged_id
+
+def test_flagged_id():
+    """Test a document always gets the same FlaggedId and it fits a signed 64 bit number"""
+    assert flagged_id("doc-1") == flagged_id("doc-1")
+    assert flagged_id("doc-1") != flagged_id("doc-2")
+    assert all(0 <= flagged_id(f"doc-{i}") < 2 ** 63 for i in range(1000))
@@ -0,0 +1,81 @@
+"""
+Test the block-leased ID allocator
+"""
+
+import asyncio
+
+import pytest
+
+from app.id_allocator import IdAllocator
+from app.storage import CounterExhausted
+from app.storage_memory import MemoryStorage
+
+@pytest.fixture
+def add():
+    """An in-memory counter's add, recording each call"""
+    counters = MemoryStorage().counters
+    calls = []
+
+    async def add(*args):
+        calls.append(args)
+        # Yield like a round trip would, so other tasks run meanwhile
+        await asyncio.sleep(0)
+        return await counters.add(*args)
+
+    add.calls = calls
+    return add
+
+@pytest.mark.asyncio
+async def test_ids_come_from_blocks(add):
+    """Test IDs are handed out a block at a time with one counter update per block"""
+    allocator = IdAllocator("Test", add, block_size=10)
+
+    assert await allocator.take(4) == [1, 2, 3, 4]
+    assert await allocator.take(3) == [5, 6, 7]
+    assert len(add.calls) == 1
+
+    # Across the end of a block
+    assert await allocator.take(6) == [8, 9, 10, 11, 12, 13]
+    assert len(add.calls) == 2
+    assert allocator.stats() == {"blocks": 2, "leased": 20, "issued": 13, "utilization": 0.65}
+
+@pytest.mark.asyncio
+async def test_processes_get_disjoint_blocks(add):
+    """Test allocators sharing a counter never hand out the same ID"""
+    allocators = [IdAllocator("Test", add, block_size=7) for _ in range(3)]
+
+    ids = []
+    for _ in range(10):
+        for allocator in allocators:
+            ids += await allocator.take(3)
+
+    assert len(set(ids)) == len(ids) == 90
+
+@pytest.mark.asyncio
+async def test_concurrent_takes_share_a_lease(add):
+    """Test callers waiting on an empty allocator share one lease"""
+    allocator = IdAllocator("Test", add, block_size=100)
+
+    results = await asyncio.gather(*[allocator.take(2) for _ in range(10)])
+
+    assert sorted(i for ids in results for i in ids) == list(range(1, 21))
+    assert len(add.calls) == 1
+
+@pytest.mark.asyncio
+async def test_next_block_is_leased_ahead(add):
+    """Test the next block is leased before the current one runs out"""
+    allocator = IdAllocator("Test", add, block_size=10)
+
+    await allocator.take(8)
+    await asyncio.sleep(0.01)
+    assert len(add.calls) == 2
+    assert allocator.remaining == 12
+
+@pytest.mark.asyncio
+async def test_counter_limit(add):
+    """Test an allocator stops when its counter would pass the limit"""
+    allocator = IdAllocator("Test", add, block_size=10, limit=15)
+
+    assert len(await allocator.take(10)) == 10
+    with pytest.raises(CounterExhausted):
+        await allocator.take(1)
@@ -0,0 +1,90 @@
+"""
+Test metrics
+"""
+
+import smtplib
+
+import boto3
+import pytest
+from botocore.config import Config
+from botocore.exceptions import EndpointConnectionError
+from prometheus_client import REGISTRY
+from fastapi.testclient import TestClient
+
+from app import registration
+from app.api import app
+from app.registration import deliver_email
+from app import metrics
+from app.dynamodb_tables import get_users_table
+
+def sample(name: str, **labels) -> float:
+    """Current value of a metric, 0 if it wasn't recorded yet"""
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+def test_route_metrics():
+    """Test requests are counted and timed by route template"""
+    before = sample('http_requests_total', method='GET', route='/', status='200')
+    missing = sample('http_requests_total', method='GET', route='unmatched', status='404')
+
+    client = TestClient(app)
+    assert client.get('/').status_code == 200
+    assert client.get('/nowhere').status_code == 404
+
+    assert sample('http_requests_total', method='GET', route='/', status='200') == before + 1
+    assert sample('http_requests_total', method='GET', route='unmatched', status='404') == missing + 1
+    assert sample('http_request_duration_seconds_count', method='GET', route='/') >= 1
+    assert sample('http_requests_in_progress', method='GET') == 0
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert 'http_requests_total{method="GET",route="/",status="200"}' in response.text
+
+def test_dynamodb_metrics():
+    """Test DynamoDB calls are counted by table and operation"""
+    table = get_users_table("Users")
+    calls = sample('dynamodb_calls_total', table='Users', operation='GetItem')
+    errors = sample('dynamodb_errors_total', table='Users', operation='GetItem',
+                    code='ValidationException')
+
+    table.get_item(Key={"UserName": "user@test.com"})
+    with pytest.raises(Exception):
+        table.get_item(Key={"Wrong": "key"})
+
+    assert sample('dynamodb_calls_total', table='Users', operation='GetItem') == calls + 2
+    assert sample('dynamodb_errors_total', table='Users', operation='GetItem',
+                  code='ValidationException') == errors + 1
+    assert sample('dynamodb_call_duration_seconds_count', table='Users', operation='GetItem') >= 2
+
+def test_dynamodb_connection_errors():
+    """Test a call that never got a response is counted and its exception raised as is"""
+    client = boto3.client('dynamodb', region_name='us-east-1',
+                          config=Config(retries={"max_attempts": 1}))
+    metrics.instrument_dynamodb(client)
+
+    def refuse(request, **kwargs):
+        raise EndpointConnectionError(endpoint_url=request.url)
+
+    client.meta.events.register_first('before-send.dynamodb', refuse)
+    errors = sample('dynamodb_errors_total', table='Users', operation='GetItem',
+                    code='EndpointConnectionError')
+
+    with pytest.raises(EndpointConnectionError):
+        client.get_item(TableName='Users', Key={"UserName": {"S": "user@test.com"}})
+
+    assert sample('dynamodb_errors_total', table='Users', operation='GetItem',
+                  code='EndpointConnectionError') == errors + 1
+
+def test_smtp_metrics(mocker):
+    """Test sends are timed and failures counted"""
+    transport = mocker.patch.object(registration, 'transport')
+    email = {"recipient": "user@test.com", "subject": "Hi", "text": "Hi", "html": "<p>Hi</p>"}
+    sends = sample('smtp_send_duration_seconds_count')
+    failures = sample('smtp_send_failures_total')
+
+    deliver_email(email)
+    transport.send.side_effect = smtplib.SMTPException('rejected')
+    with pytest.raises(smtplib.SMTPException):
+        deliver_email(email)
+
+    assert sample('smtp_send_duration_seconds_count') == sends + 2
+    assert sample('smtp_send_failures_total') == failures + 1
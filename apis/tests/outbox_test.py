@@ -0,0 +1,135 @@
+"""
+Test outbox
+"""
+
+import asyncio
+import sqlite3
+
+import pytest
+
+from app.outbox import Outbox
+
+class FlakyDelivery:
+    """Fails a number of times before delivering"""
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.sent = []
+
+    def __call__(self, email: dict):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('SMTP unavailable')
+        self.sent.append(email['recipient'])
+
+@pytest.mark.asyncio
+async def test_outbox_delivers(tmp_path):
+    """Test queued emails are delivered by the workers"""
+    deliver = FlakyDelivery()
+    outbox = Outbox(str(tmp_path / 'outbox.db'), deliver)
+    await outbox.start()
+
+    await outbox.enqueue("user@test.com", "Subject", "text", "<p>html</p>")
+    for _ in range(100):
+        if deliver.sent:
+            break
+        await asyncio.sleep(0.01)
+    await outbox.stop()
+
+    assert deliver.sent == ["user@test.com"]
+    assert outbox.stats() == {}
+
+@pytest.mark.asyncio
+async def test_outbox_retries_and_dead_letters(tmp_path):
+    """Test failures are retried with backoff and dead lettered at the limit"""
+    deliver = FlakyDelivery(failures=3)
+    outbox = Outbox(str(tmp_path / 'outbox.db'), deliver, max_attempts=2, base_delay=0)
+
+    await outbox.enqueue("user@test.com", "Subject", "text", "<p>html</p>")
+    assert await outbox.process_one() is True
+    assert outbox.stats() == {"pending": 1}
+    assert await outbox.process_one() is True
+    assert outbox.stats() == {"dead": 1}
+    assert await outbox.process_one() is False
+
+    dead = outbox.dead_letters()
+    assert dead[0]['attempts'] == 2
+    assert dead[0]['last_error'] == 'SMTP unavailable'
+
+    assert outbox.requeue_dead() == 1
+    assert await outbox.process_one() is True
+    assert await outbox.process_one() is True
+    assert deliver.sent == ["user@test.com"]
+
+@pytest.mark.asyncio
+async def test_outbox_survives_restarts(tmp_path):
+    """Test emails queued or left sending before a restart are sent after it"""
+    path = str(tmp_path / 'outbox.db')
+    outbox = Outbox(path, None)
+    await outbox.enqueue("first@test.com", "Subject", "text", "<p>html</p>")
+    await outbox.enqueue("second@test.com", "Subject", "text", "<p>html</p>")
+    # Claimed but never finished
+    assert outbox.claim()['recipient'] == "first@test.com"
+
+    # A claim within its lease may be another process sending it
+    deliver = FlakyDelivery()
+    restarted = Outbox(path, deliver)
+    await restarted.start()
+    await restarted.stop()
+    assert restarted.stats() == {"pending": 1, "sending": 1}
+
+    restarted.claim_timeout = 0
+    await restarted.start()
+    await restarted.stop()
+    assert restarted.stats() == {"pending": 2}
+
+    while await restarted.process_one():
+        pass
+    assert sorted(deliver.sent) == ["first@test.com", "second@test.com"]
+
+@pytest.mark.asyncio
+async def test_outbox_workers_survive_errors(tmp_path, mocker):
+    """Test a worker keeps going after the outbox database fails"""
+    deliver = FlakyDelivery()
+    outbox = Outbox(str(tmp_path / 'outbox.db'), deliver, workers=1, poll_interval=0.01)
+    claim, failures = outbox.claim, [sqlite3.OperationalError('database is locked')]
+
+    def flaky_claim():
+        if failures:
+            raise failures.pop()
+        return claim()
+
+    mocker.patch.object(outbox, 'claim', side_effect=flaky_claim)
+    await outbox.enqueue("user@test.com", "Subject", "text", "<p>html</p>")
+    await outbox.start()
+
+    for _ in range(100):
+        if deliver.sent:
+            break
+        await asyncio.sleep(0.01)
+    await outbox.stop()
+
+    assert deliver.sent == ["user@test.com"]
+
+@pytest.mark.asyncio
+async def test_outbox_wakes_for_emails_enqueued_while_draining(tmp_path, mocker):
+    """Test an email enqueued as a worker finds the outbox empty is sent without waiting a poll"""
+    deliver = FlakyDelivery()
+    outbox = Outbox(str(tmp_path / 'outbox.db'), deliver, workers=1, poll_interval=60)
+    process_one, raced = outbox.process_one, []
+
+    async def racing_process_one():
+        processed = await process_one()
+        if not processed and not raced:
+            # Enqueued after the outbox was found empty, before the worker waits
+            raced.append(await outbox.enqueue("user@test.com", "Subject", "text", "<p>html</p>"))
+        return processed
+
+    mocker.patch.object(outbox, 'process_one', side_effect=racing_process_one)
+    await outbox.start()
+    for _ in range(100):
+        if deliver.sent:
+            break
+        await asyncio.sleep(0.01)
+    await outbox.stop()
+
+    assert deliver.sent == ["user@test.com"]
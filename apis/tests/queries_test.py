@@ -0,0 +1,66 @@
+"""
+Test the query log
+"""
+
+import asyncio
+
+import pytest
+
+from app.queries import QueryBuffer, QueryLogFull
+
+@pytest.mark.asyncio
+async def test_buffer_flushes_in_batches():
+    """Test queries are written batch_size at a time"""
+    batches = []
+
+    async def write_many(items):
+        batches.append(items)
+
+    buffer = QueryBuffer(write_many, batch_size=2, interval=60, max_pending=10)
+    buffer.add([1, 2, 3])
+    assert not batches
+
+    assert await buffer.flush() == 3
+    assert batches == [[1, 2], [3]]
+
+@pytest.mark.asyncio
+async def test_buffer_backpressure():
+    """Test a batch that doesn't fit is refused whole"""
+    async def write_many(items):
+        pass
+
+    buffer = QueryBuffer(write_many, batch_size=2, interval=60, max_pending=3)
+    buffer.add([1, 2])
+    with pytest.raises(QueryLogFull):
+        buffer.add([3, 4])
+    assert buffer.pending == [1, 2]
+
+@pytest.mark.asyncio
+async def test_failed_writes_are_kept():
+    """Test queries that fail to write stay first in line"""
+    async def write_many(items):
+        raise RuntimeError('throttled')
+
+    buffer = QueryBuffer(write_many, batch_size=2, interval=60, max_pending=10)
+    buffer.add([1, 2, 3])
+    with pytest.raises(RuntimeError):
+        await buffer.flush()
+    assert buffer.pending == [1, 2, 3]
+
+@pytest.mark.asyncio
+async def test_background_writes():
+    """Test a full batch is written right away and the rest at stop"""
+    batches = []
+
+    async def write_many(items):
+        batches.append(items)
+
+    buffer = QueryBuffer(write_many, batch_size=2, interval=60, max_pending=10)
+    await buffer.start()
+    buffer.add([1, 2])
+    await asyncio.sleep(0.01)
+    assert batches == [[1, 2]]
+
+    buffer.add([3])
+    await buffer.stop()
+    assert batches == [[1, 2], [3]]
@@ -0,0 +1,189 @@
+"""
+Test failed login throttling
+"""
+
+import asyncio
+
+import pytest
+
+from app import rate_limit
+from app.async_table import AsyncTable
+from app.dynamodb_tables import get_rate_limits_table
+from app.rate_limit import FailureLimiter, \
+                        SharedFailureLimiter, \
+                        TooManyAttempts, \
+                        reserve_login_attempt, \
+                        release_login_attempt, \
+                        reset_login_failures
+
+class FakeClock:
+    """Clock that only moves when told to"""
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture(autouse=True)
+def limiters(mocker):
+    """Fresh in-memory limiters on a fake clock"""
+    clock = FakeClock()
+    mocker.patch.object(rate_limit, 'local_limiters', {
+        "user": FailureLimiter(3, 600, clock=clock),
+        "ip": FailureLimiter(5, 600, clock=clock)
+    })
+    mocker.patch.object(rate_limit, 'shared_limiters', {})
+    return clock
+
+@pytest.mark.asyncio
+async def test_failure_limiter():
+    """Test the sliding window"""
+    clock = FakeClock()
+    limiter = FailureLimiter(3, 600, maxsize=2, clock=clock)
+
+    for now in (0, 100, 200):
+        clock.now = now
+        assert await limiter.retry_after("user:a") == 0
+        await limiter.acquire("user:a")
+    assert await limiter.retry_after("user:a") == 400
+    with pytest.raises(TooManyAttempts):
+        await limiter.acquire("user:a")
+
+    # Unlocked once the first failure leaves the window, then locked again
+    clock.now = 600
+    assert await limiter.retry_after("user:a") == 0
+    token = await limiter.acquire("user:a")
+    assert await limiter.retry_after("user:a") == 100
+
+    # An attempt that didn't fail is uncounted
+    await limiter.release("user:a", token)
+    assert await limiter.retry_after("user:a") == 0
+
+    await limiter.reset("user:a")
+    assert await limiter.retry_after("user:a") == 0
+    await limiter.release("user:a", token)
+
+    # The least recently failed keys are dropped
+    for key in ("user:b", "user:c", "user:d"):
+        await limiter.acquire(key)
+    assert len(limiter._failures) == 2  # pylint: disable=protected-access
+
+@pytest.mark.asyncio
+async def test_login_lockout(limiters):
+    """Test usernames and client IPs are locked out separately"""
+    for _ in range(3):
+        await reserve_login_attempt("user@test.com", "10.0.0.1")
+
+    with pytest.raises(TooManyAttempts) as err:
+        await reserve_login_attempt("user@test.com", "10.0.0.2")
+    assert err.value.retry_after == 600
+
+    # Another user from the same client is still allowed, until the IP limit
+    await reserve_login_attempt("other@test.com", "10.0.0.1")
+    await reserve_login_attempt("other@test.com", "10.0.0.1")
+    with pytest.raises(TooManyAttempts):
+        await reserve_login_attempt("third@test.com", "10.0.0.1")
+    # A refused attempt isn't counted against the user
+    assert await rate_limit.local_limiters["user"].retry_after("user:third@test.com") == 0
+
+    limiters.now = 601
+    attempt = await reserve_login_attempt("user@test.com", "10.0.0.1")
+    await release_login_attempt(attempt)
+
+    await reserve_login_attempt("user@test.com")
+    await reset_login_failures("user@test.com")
+    await reserve_login_attempt("user@test.com")
+
+@pytest.mark.asyncio
+async def test_shared_failure_limiter():
+    """Test counting failures in DynamoDB"""
+    clock = FakeClock(1000)
+    table = AsyncTable(get_rate_limits_table("RateLimits"))
+    limiter = SharedFailureLimiter(table, 2, 600, clock=clock)
+
+    await limiter.acquire("user:a")
+    assert await limiter.retry_after("user:a") == 0
+    token = await limiter.acquire("user:a")
+    assert await limiter.retry_after("user:a") == 200
+    with pytest.raises(TooManyAttempts) as err:
+        await limiter.acquire("user:a")
+    assert err.value.retry_after == 200
+
+    item = (await table.get_item(Key={"LimitKey": "user:a#600"}))['Item']
+    assert item['Failures'] == 2
+    assert item['ExpiresAt'] == 1800
+
+    await limiter.release("user:a", token)
+    assert await limiter.retry_after("user:a") == 0
+
+    await limiter.reset("user:a")
+    assert await limiter.retry_after("user:a") == 0
+    # Releasing after a reset doesn't leave a negative count behind
+    await limiter.release("user:a", token)
+    assert 'Item' not in await table.get_item(Key={"LimitKey": "user:a#600"})
+
+@pytest.mark.asyncio
+async def test_shared_failure_limiter_window_boundary():
+    """Test failures just before a window ends still count just after it"""
+    clock = FakeClock(1190)
+    table = AsyncTable(get_rate_limits_table("RateLimits"))
+    limiter = SharedFailureLimiter(table, 4, 600, clock=clock)
+
+    for _ in range(4):
+        await limiter.acquire("user:b")
+
+    # A fixed window would allow another 4 right away
+    clock.now = 1200
+    with pytest.raises(TooManyAttempts):
+        await limiter.acquire("user:b")
+
+    # A sixth of the way in, 3.33 of the previous 4 still count
+    clock.now = 1300
+    await limiter.acquire("user:b")
+    with pytest.raises(TooManyAttempts) as err:
+        await limiter.acquire("user:b")
+    # Until only 3 of them do
+    assert err.value.retry_after == 50
+
+    # In the next window the one failure at 1300 counts in full at first
+    clock.now = 1800
+    for _ in range(3):
+        await limiter.acquire("user:b")
+    with pytest.raises(TooManyAttempts):
+        await limiter.acquire("user:b")
+
+@pytest.mark.asyncio
+async def test_concurrent_attempts():
+    """Test concurrent attempts can't get past the lockout together"""
+    results = await asyncio.gather(*[
+        reserve_login_attempt("user@test.com", "10.0.0.1") for _ in range(20)
+    ], return_exceptions=True)
+    assert sum(not isinstance(result, TooManyAttempts) for result in results) == 3
+
+@pytest.mark.asyncio
+async def test_successful_login_with_shared_limits(mocker):
+    """Test a successful login releases and resets the username in one write per window with failures"""
+    clock = FakeClock(1000)
+    table = AsyncTable(get_rate_limits_table("RateLimits"))
+    mocker.patch.object(rate_limit, 'shared_limiters', {
+        "user": SharedFailureLimiter(table, 3, 600, clock=clock),
+        "ip": SharedFailureLimiter(table, 5, 600, clock=clock)
+    })
+    writes = [mocker.spy(table, name) for name in ('update_item', 'delete_item')]
+
+    attempt = await reserve_login_attempt("user@test.com", "10.0.0.1")
+    await release_login_attempt(attempt, reset=True)
+
+    # Two counted attempts, the IP uncounted and the username deleted
+    assert [spy.call_count for spy in writes] == [3, 1]
+    assert 'Item' not in await table.get_item(Key={"LimitKey": "user:user@test.com#600"})
+    ip_item = (await table.get_item(Key={"LimitKey": "ip:10.0.0.1#600"}))['Item']
+    assert ip_item['Failures'] == 0
+
+    # Failures from the previous window are reset too
+    await reserve_login_attempt("user@test.com", "10.0.0.1")
+    clock.now = 1300
+    attempt = await reserve_login_attempt("user@test.com", "10.0.0.1")
+    await release_login_attempt(attempt, reset=True)
+    assert writes[1].call_count == 3
+    assert await rate_limit.shared_limiters["user"].retry_after("user:user@test.com") == 0
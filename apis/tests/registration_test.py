@@ -1,59 +1,151 @@
 """Test registration"""
 
+import time
+import smtplib
+
+import pytest
+
 from app import config
+from app import registration
+from app.outbox import Outbox
 from app.registration import validate_access_key, \
                          get_registration_link, \
                          get_reset_link, \
                          send_registration_email, \
-                         send_reset_password_email
+                         send_reset_password_email, \
+                         deliver_email, \
+                         SMTPTransport
 
 from app.dynamodb_tables import get_tokens_table
 
 tokens_table = get_tokens_table(config.TOKENS_TABLE)
 
-def test_validate_access_key():
+@pytest.fixture(autouse=True)
+def transport(mocker):
+    """Send through a fresh connection pool"""
+    test_transport = SMTPTransport("smtp.test.com", 465, "registration@test.com", "secret")
+    mocker.patch.object(registration, 'transport', test_transport)
+    return test_transport
+
+@pytest.fixture(autouse=True)
+def outbox(mocker, tmp_path):
+    """Queue emails in a temporary outbox"""
+    test_outbox = Outbox(str(tmp_path / 'outbox.db'), deliver_email)
+    mocker.patch.object(registration, 'outbox', test_outbox)
+    return test_outbox
+
+@pytest.mark.asyncio
+async def test_validate_access_key():
     """Test validate_access_key"""
     tokens_table.put_item(Item={
         "UserName": "user@test.com",
         "AccessKey": "abc123",
         "Valid": True
     })
-    assert validate_access_key("abc123") == "user@test.com"
+    assert (await validate_access_key("abc123")) == "user@test.com"
+
+    # Expired keys are refused until TTL deletes them
+    tokens_table.put_item(Item={
+        "UserName": "user@test.com",
+        "AccessKey": "abc123",
+        "Valid": True,
+        "ExpiresAt": int(time.time()) - 1
+    })
+    assert (await validate_access_key("abc123")) == ""
 
     tokens_table.delete_item(Key={"AccessKey": "abc123"})
 
-def test_get_registration_link(mocker):
+@pytest.mark.asyncio
+async def test_get_registration_link(mocker):
     """Test get_registration_link"""
     mocker.patch('uuid.uuid4', return_value='uuid1234')
     expected_result = f'{config.APP_ORIGIN}/confirm_email?accessKey='
-    assert get_registration_link("testuser@gmail.com")[:len(expected_result)] == expected_result
+    assert (await get_registration_link("testuser@gmail.com"))[:len(expected_result)] == expected_result
+    item = tokens_table.get_item(Key={"AccessKey": "uuid1234"})['Item']
+    assert item['ExpiresAt'] > time.time() + registration.REGISTRATION_LINK_TTL - 60
     tokens_table.delete_item(Key={"AccessKey": "uuid1234"})
 
-def test_get_reset_link(mocker):
+@pytest.mark.asyncio
+async def test_get_reset_link(mocker):
     """Test get_reset_link"""
     mocker.patch('uuid.uuid4', return_value='uuid1234')
     expected_result = f'{config.APP_ORIGIN}/set_new_password?accessKey='
-    assert get_reset_link("testuser@gmail.com")[:len(expected_result)] == expected_result
+    assert (await get_reset_link("testuser@gmail.com"))[:len(expected_result)] == expected_result
+    item = tokens_table.get_item(Key={"AccessKey": "uuid1234"})['Item']
+    assert item['ExpiresAt'] <= time.time() + registration.RESET_LINK_TTL
     tokens_table.delete_item(Key={"AccessKey": "uuid1234"})
 
-def test_send_reset_password_email(mocker):
+@pytest.mark.asyncio
+async def test_send_reset_password_email(mocker, outbox):
     """Test send_reset_password_email"""
     mocker.patch('uuid.uuid4', return_value='uuid1234')
-    mocker.patch('smtplib.SMTP_SSL')
+    smtp = mocker.patch('smtplib.SMTP_SSL')
     tokens_table.put_item(Item={
         "UserName": "user@test.com",
         "AccessKey": "abc123",
         "Valid": True
     })
     
-    assert send_reset_password_email("testuser@gmail.com") is True
+    assert (await send_reset_password_email("testuser@gmail.com")) is True
+
+    # The email is queued, not sent inline
+    assert smtp.call_count == 0
+    assert outbox.stats() == {"pending": 1}
+
+    assert await outbox.process_one() is True
+    sendmail = smtp.return_value.sendmail
+    assert sendmail.call_args[0][1] == "testuser@gmail.com"
+    assert "set_new_password?accessKey=uuid1234" in sendmail.call_args[0][2]
+    assert outbox.stats() == {}
 
     tokens_table.delete_item(Key={"AccessKey": "abc123"})
     tokens_table.delete_item(Key={"AccessKey": "uuid1234"})
 
-def test_send_registration_email(mocker):
+@pytest.mark.asyncio
+async def test_send_registration_email(mocker, outbox):
     """Test send registration email"""
     mocker.patch('uuid.uuid4', return_value='uuid1234')
-    mocker.patch('smtplib.SMTP_SSL')
-    assert send_registration_email("testuser@gmail.com") is True
+    smtp = mocker.patch('smtplib.SMTP_SSL')
+    assert (await send_registration_email("testuser@gmail.com")) is True
+
+    assert smtp.call_count == 0
+    assert await outbox.process_one() is True
+    sendmail = smtp.return_value.sendmail
+    assert "confirm_email?accessKey=uuid1234" in sendmail.call_args[0][2]
+
     tokens_table.delete_item(Key={"AccessKey": "uuid1234"})
+
+def test_smtp_transport_reuses_connections(mocker, transport):
+    """Test messages share one login until the per-connection cap"""
+    smtp = mocker.patch('smtplib.SMTP_SSL')
+    transport.max_messages = 2
+
+    for _ in range(3):
+        transport.send("registration@test.com", "user@test.com", "message")
+
+    assert smtp.call_count == 2
+    assert smtp.return_value.login.call_count == 2
+    assert smtp.return_value.sendmail.call_count == 3
+    # Every connection uses the same SSL context
+    assert {call.kwargs['context'] for call in smtp.call_args_list} == {transport.context}
+
+def test_smtp_transport_reconnects(mocker, transport):
+    """Test dropped and stale connections are replaced"""
+    smtp = mocker.patch('smtplib.SMTP_SSL')
+    transport.send("registration@test.com", "user@test.com", "message")
+
+    # The server dropped the connection while it sat in the pool
+    smtp.return_value.sendmail.side_effect = [smtplib.SMTPServerDisconnected(), {}]
+    transport.send("registration@test.com", "user@test.com", "message")
+    assert smtp.call_count == 2
+    smtp.return_value.sendmail.side_effect = None
+
+    # Connections idle for longer than the keepalive are checked with NOOP
+    transport.keepalive = 0
+    smtp.return_value.noop.return_value = (421, b'Closing')
+    transport.send("registration@test.com", "user@test.com", "message")
+    assert smtp.return_value.noop.call_count == 1
+    assert smtp.call_count == 3
+
+    transport.close()
+    assert smtp.return_value.quit.call_count == 3
@@ -0,0 +1,67 @@
+"""
+Test request stats
+"""
+
+import boto3
+import pytest
+from botocore.config import Config
+from botocore.exceptions import EndpointConnectionError
+from fastapi.testclient import TestClient
+
+from app.api import app
+from app.async_table import AsyncTable
+from app.request_stats import track, current_request_stats, instrument_dynamodb
+from app.dynamodb_tables import get_users_table
+
+users_table = AsyncTable(get_users_table("Users"))
+
+@pytest.mark.asyncio
+async def test_track():
+    """Test calls from the executor threads are accounted to the request"""
+    assert current_request_stats() is None
+    with track() as stats:
+        await users_table.put_item(Item={"UserName": "stats@test.com"})
+        response = await users_table.get_item(Key={"UserName": "stats@test.com"})
+        await users_table.delete_item(Key={"UserName": "stats@test.com"})
+
+    assert stats.calls == 3
+    assert dict(stats.operations) == {"PutItem": 1, "GetItem": 1, "DeleteItem": 1}
+    # Consumed capacity is requested while tracking
+    assert 'ConsumedCapacity' in response
+    assert stats.capacity > 0
+
+    # and not outside of it
+    response = await users_table.get_item(Key={"UserName": "stats@test.com"})
+    assert 'ConsumedCapacity' not in response
+
+def test_server_timing():
+    """Test responses carry the request's DynamoDB stats"""
+    client = TestClient(app)
+    response = client.post('/logout', json={"username": "user@test.com", "authKey": "missing"})
+    assert response.status_code == 200
+    timing = response.headers['Server-Timing']
+    assert 'dynamodb;dur=' in timing
+    assert 'desc="1 calls"' in timing
+    assert 'app;dur=' in timing
+
+def test_failed_calls():
+    """Test every attempt of a call that never got a response is accounted"""
+    client = boto3.client('dynamodb', region_name='us-east-1',
+                          config=Config(retries={"mode": "standard", "max_attempts": 2}))
+    instrument_dynamodb(client)
+
+    sent = []
+
+    def refuse(request, **kwargs):
+        sent.append(request)
+        raise EndpointConnectionError(endpoint_url=request.url)
+
+    client.meta.events.register_first('before-send.dynamodb', refuse)
+
+    with track() as stats:
+        with pytest.raises(EndpointConnectionError):
+            client.get_item(TableName='Users', Key={"UserName": {"S": "stats@test.com"}})
+
+    assert len(sent) > 1
+    assert stats.calls == len(sent)
+    assert dict(stats.operations) == {"GetItem": len(sent)}
@@ -0,0 +1,110 @@
+"""
+Test user activity rollups
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import api
+from app import rollups
+from app.api import app
+from app.rollups import compute_user_rollup, get_user_rollup, claim_rollup, UserActivity, \
+                         rollup_cache
+from app.storage_memory import MemoryStorage
+
+@pytest.fixture
+def storage(mocker):
+    """In-memory storage for the rollup to read and write"""
+    storage = MemoryStorage()
+    mocker.patch.object(rollups, 'storage', storage)
+    rollup_cache.clear()
+    yield storage
+    rollup_cache.clear()
+
+def days_ago(days: int) -> str:
+    """A LastLogin value from days ago"""
+    return str(datetime.utcnow() - timedelta(days=days))
+
+def test_user_activity():
+    """Test users are counted by role, confirmation and day of last login"""
+    today = datetime.utcnow().date()
+    first, second = UserActivity(today), UserActivity(today)
+    first.add({"AuthRole": "viewer", "LastLogin": days_ago(0)})
+    first.add({"AuthRole": "editor", "LastLogin": days_ago(3)})
+    second.add({})
+    second.add({"AuthRole": "viewer", "LastLogin": days_ago(45)})
+    first.merge(second)
+
+    summary = first.summary()
+    assert summary["Total"] == 4
+    assert summary["Unconfirmed"] == 1
+    assert summary["Roles"] == {"viewer": 2, "editor": 1}
+    assert summary["Active"] == {"1d": 1, "7d": 2, "30d": 2}
+    assert summary["LastLoginsByDay"] == {days_ago(3)[:10]: 1, days_ago(0)[:10]: 1}
+
+@pytest.mark.asyncio
+async def test_compute_user_rollup(storage, mocker):
+    """Test the rollup reads only the attributes it counts and is saved"""
+    for i in range(10):
+        await storage.users.put({
+            "UserName": f"user{i}@test.com", "Password": "hash",
+            "AuthRole": "viewer", "LastLogin": days_ago(i)
+        })
+    scan = mocker.spy(storage.users, 'scan')
+
+    rollup = await compute_user_rollup(segments=3)
+
+    assert scan.call_count == 3
+    assert all(call.args[2] == ["LastLogin", "AuthRole"] for call in scan.call_args_list)
+    assert rollup["Total"] == 10
+    assert rollup["Active"] == {"1d": 1, "7d": 7, "30d": 10}
+    assert await storage.rollups.get("users") == rollup
+
+@pytest.mark.asyncio
+async def test_get_user_rollup_is_cached(storage, mocker):
+    """Test the rollup is read once per cache period"""
+    await storage.rollups.put({"RollupId": "users", "Total": 3})
+    get = mocker.spy(storage.rollups, 'get')
+
+    assert (await get_user_rollup())["Total"] == 3
+    assert (await get_user_rollup())["Total"] == 3
+    assert get.call_count == 1
+
+def test_user_stats(storage, mocker):
+    """Test the endpoint serves the saved rollup to moderators"""
+    client = TestClient(app)
+    user = {"username": "mod@test.com", "authKey": "mod1234"}
+    validate = mocker.patch.object(api, 'validate_session_key', return_value=None)
+    moderator = mocker.patch.object(api, 'is_moderator', return_value=False)
+    assert client.post('/stats/users', json=user).status_code == 401
+
+    validate.return_value = "mod@test.com"
+    assert client.post('/stats/users', json=user).status_code == 403
+
+    moderator.return_value = True
+    assert client.post('/stats/users', json=user).status_code == 404
+
+    rollup_cache.clear()
+    storage.rollups.items["users"] = {"RollupId": "users", "Total": 3, "Unconfirmed": 1}
+    response = client.post('/stats/users', json=user)
+    assert response.status_code == 200
+    assert response.json()["Total"] == 3
+    assert "RollupId" not in response.json()
+
+@pytest.mark.asyncio
+async def test_rollup_claimed_once(storage, mocker):
+    """Test one worker process claims each interval's rollup"""
+    clock = mocker.patch.object(rollups.time, 'time', return_value=3600 * 5 + 10)
+
+    claims = await asyncio.gather(*[claim_rollup(3600) for _ in range(3)])
+    assert sorted(claims) == [False, False, True]
+    clock.return_value += 3000
+    assert not await claim_rollup(3600)
+
+    # The next interval is claimed again
+    clock.return_value += 600
+    assert await claim_rollup(3600)
+    assert not await claim_rollup(3600)
@@ -2,15 +2,33 @@
 Test for session module
 """
 
+import time
+
 import pytest
 from app import config
 
-from app.session import new_session, validate_session_key, invalidate_session
+from app.session import new_session, \
+                        validate_session_key, \
+                        invalidate_session, \
+                        revoke_user_sessions, \
+                        list_user_sessions, \
+                        count_user_sessions, \
+                        session_cache
+from app.session_tokens import revocations
+from app import session
+from app.storage import storage
 from app.dynamodb_tables import get_sessions_table, get_users_table
 
 sessions_table = get_sessions_table(config.SESSIONS_TABLE)
 users_table = get_users_table(config.USERS_TABLE)
 
+@pytest.fixture(autouse=True)
+def clear_session_cache():
+    """Start each test with an empty session cache"""
+    session_cache.clear()
+    yield
+    session_cache.clear()
+
 @pytest.mark.asyncio
 async def test_new_session(mocker):
     """Test new_session"""
@@ -43,14 +61,58 @@ async def test_new_session(mocker):
     users_table.delete_item(Key={"UserName": username})
     sessions_table.delete_item(Key={"SessionKey": session_key})
 
-def test_validate_session_key(mocker):
+@pytest.mark.asyncio
+async def test_new_session_rotates_in_one_transaction(mocker):
+    """Test the old session is retired and the user updated in a single write"""
+    username = "test@gmail.com"
+    users_table.put_item(Item={"UserName": username, "AuthKey": "old1234"})
+    sessions_table.put_item(Item={"SessionKey": "old1234", "UserName": username, "Active": True})
+    rotate_session = mocker.spy(storage, 'rotate_session')
+
+    session_key = await new_session(username)
+
+    assert rotate_session.call_count == 1
+    assert sessions_table.get_item(Key={"SessionKey": "old1234"})['Item']['Active'] is False
+    assert sessions_table.get_item(Key={"SessionKey": session_key})['Item']['Active'] is True
+    assert users_table.get_item(Key={"UserName": username})['Item']['AuthKey'] == session_key
+    assert await validate_session_key("old1234") is None
+
+    # clean up
+    users_table.delete_item(Key={"UserName": username})
+    sessions_table.delete_item(Key={"SessionKey": "old1234"})
+    sessions_table.delete_item(Key={"SessionKey": session_key})
+
+@pytest.mark.asyncio
+async def test_new_session_retries_after_a_race(mocker):
+    """Test a rotation that lost a race starts again from the winner's session"""
+    username = "test@gmail.com"
+    users_table.put_item(Item={"UserName": username, "AuthKey": "winner1234"})
+    sessions_table.put_item(Item={"SessionKey": "winner1234", "UserName": username, "Active": True})
+    # The caller still holds the key from before the other login
+    mocker.patch('app.session.get_user', return_value={"UserName": username, "AuthKey": "stale1234"})
+
+    session_key = await new_session(username)
+
+    assert sessions_table.get_item(Key={"SessionKey": "winner1234"})['Item']['Active'] is False
+    assert users_table.get_item(Key={"UserName": username})['Item']['AuthKey'] == session_key
+
+    # clean up
+    users_table.delete_item(Key={"UserName": username})
+    sessions_table.delete_item(Key={"SessionKey": "winner1234"})
+    sessions_table.delete_item(Key={"SessionKey": session_key})
+
+@pytest.mark.asyncio
+async def test_validate_session_key(mocker):
     """Test validate_session_key"""
     mocker.patch('uuid.uuid4', return_value='uuid1234')
     username = "test@gmail.com"
     session_key = "uuid1234"
 
     # Test it returns None when no value has been set
-    assert validate_session_key(session_key) is None
+    assert await validate_session_key(session_key) is None
+
+    # Test the miss was cached
+    assert session_cache.lookup(session_key) == (True, None)
 
     # Test active records return properly
     sessions_table.put_item(Item={
@@ -58,7 +120,10 @@ def test_validate_session_key(mocker):
         "UserName": username,
         "Active": True
     })
-    assert validate_session_key(session_key) == username
+    # The table was written behind the cache's back
+    session_cache.clear()
+    assert await validate_session_key(session_key) == username
+    assert session_cache.lookup(session_key) == (True, username)
     
     # Test inactive records return None
     sessions_table.update_item(
@@ -66,12 +131,24 @@ def test_validate_session_key(mocker):
         UpdateExpression="SET Active = :active",
         ExpressionAttributeValues={":active": False}
     )
-    assert validate_session_key(session_key) is None
+    session_cache.clear()
+    assert await validate_session_key(session_key) is None
+
+    # Test expired records return None before TTL deletes them
+    sessions_table.put_item(Item={
+        "SessionKey": session_key,
+        "UserName": username,
+        "Active": True,
+        "ExpiresAt": int(time.time()) - 1
+    })
+    session_cache.clear()
+    assert await validate_session_key(session_key) is None
 
     # clean up
     sessions_table.delete_item(Key={"SessionKey": session_key})
 
-def test_invalidate_session():
+@pytest.mark.asyncio
+async def test_invalidate_session():
     """Test invalidate_session"""
     session_key = "uuid1234"
     username = "test@gmail.com"
@@ -82,7 +159,10 @@ def test_invalidate_session():
         "Active": True
     })
 
-    assert invalidate_session(session_key) == None
+    assert await validate_session_key(session_key) == username
+    assert await invalidate_session(session_key) == None
+    # The cached session is invalidated immediately
+    assert await validate_session_key(session_key) is None
 
     response = sessions_table.get_item(
         Key={"SessionKey": session_key}
@@ -92,3 +172,77 @@ def test_invalidate_session():
 
     # clean up
     sessions_table.delete_item(Key={"SessionKey": session_key})
+
+@pytest.mark.asyncio
+async def test_signed_sessions(mocker):
+    """Test sessions in signed mode never touch the sessions table"""
+    mocker.patch('app.session.SESSION_MODE', 'signed')
+    mocker.patch.object(config, 'SESSION_SECRET', 'test-secret', create=True)
+    get_item = mocker.spy(storage.sessions, 'get')
+    username = "test@gmail.com"
+
+    users_table.put_item(Item={
+        "UserName": username,
+        "AuthRole": "viewer",
+        "Active": True
+    })
+
+    first = await new_session(username)
+    assert await validate_session_key(first) == username
+
+    # A new session revokes the previous one
+    second = await new_session(username)
+    assert await validate_session_key(first) is None
+    assert await validate_session_key(second) == username
+
+    await invalidate_session(second)
+    assert await validate_session_key(second) is None
+
+    # Password changes revoke every session of the user
+    third = await new_session(username)
+    await revoke_user_sessions(username)
+    assert await validate_session_key(third) is None
+
+    assert get_item.call_count == 0
+
+    # clean up
+    users_table.delete_item(Key={"UserName": username})
+    revocations.clear()
+
+@pytest.mark.asyncio
+async def test_user_sessions():
+    """Test listing, counting and revoking a user's sessions through the index"""
+    username = "many@gmail.com"
+    now = int(time.time())
+    for i, (active, expires) in enumerate([
+        (True, now + 60),
+        (True, now + 60),
+        (False, now + 60),
+        (True, now - 1),
+    ]):
+        sessions_table.put_item(Item={
+            "SessionKey": f"session{i}",
+            "UserName": username,
+            "Active": active,
+            "CreatedAt": now + i,
+            "ExpiresAt": expires
+        })
+    sessions_table.put_item(Item={
+        "SessionKey": "other", "UserName": "other@gmail.com", "Active": True, "CreatedAt": now
+    })
+    users_table.put_item(Item={"UserName": username, "AuthKey": "current"})
+
+    sessions = await list_user_sessions(username)
+    assert [item['SessionKey'] for item in sessions] == ["session1", "session0"]
+    assert await count_user_sessions(username) == 2
+
+    assert await revoke_user_sessions(username) == 3
+    assert await count_user_sessions(username) == 0
+    assert await validate_session_key("session0") is None
+    assert sessions_table.get_item(Key={"SessionKey": "session1"}).get('Item') is None
+    assert sessions_table.get_item(Key={"SessionKey": "other"}).get('Item')
+
+    # clean up
+    for key in ("session2", "session3", "other"):
+        sessions_table.delete_item(Key={"SessionKey": key})
+    users_table.delete_item(Key={"UserName": username})
@@ -0,0 +1,99 @@
+"""
+Test session_tokens
+"""
+
+import time
+
+import pytest
+
+from app import config
+from app.cache import TTLCache
+from app.session_tokens import RevocationList, issue_token, read_token, verify_token, revocations, \
+                               check_secret
+
+@pytest.fixture(autouse=True)
+def session_secret(mocker):
+    """Sign tokens with a test secret"""
+    mocker.patch.object(config, 'SESSION_SECRET', 'test-secret', create=True)
+    revocations.clear()
+    yield
+    revocations.clear()
+
+class FakeClock:
+    """Clock that only moves when told to"""
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+@pytest.mark.asyncio
+async def test_issue_token():
+    """Test issue_token and verify_token"""
+    token = issue_token("user@test.com", "viewer")
+    claims = await verify_token(token)
+    assert claims['sub'] == "user@test.com"
+    assert claims['role'] == "viewer"
+    assert claims['exp'] > time.time()
+
+@pytest.mark.asyncio
+async def test_verify_token_rejects_tampering(mocker):
+    """Test bad signatures, garbage and expired tokens are rejected"""
+    token = issue_token("user@test.com", "viewer")
+    payload, signature = token.split('.')
+    forged = issue_token("admin@test.com", "admin").split('.')[0]
+
+    assert await verify_token(f'{forged}.{signature}') is None
+    assert await verify_token(payload) is None
+    assert await verify_token('uuid1234') is None
+    assert await verify_token('') is None
+
+    mocker.patch.object(config, 'SESSION_SECRET', 'another-secret')
+    assert await verify_token(token) is None
+
+    mocker.patch.object(config, 'SESSION_SECRET', 'test-secret')
+    expired = issue_token("user@test.com", "viewer", ttl=-1)
+    assert read_token(expired)['sub'] == "user@test.com"
+    assert await verify_token(expired) is None
+
+def test_check_secret(mocker):
+    """Test a missing or short signing key is refused"""
+    with pytest.raises(ValueError):
+        check_secret()
+    mocker.patch.object(config, 'SESSION_SECRET', None)
+    with pytest.raises(ValueError):
+        check_secret()
+    mocker.patch.object(config, 'SESSION_SECRET', 'k' * 32)
+    check_secret()
+
+@pytest.mark.asyncio
+async def test_revocation_list():
+    """Test tokens can be revoked one at a time or per user"""
+    first = issue_token("revoked@test.com", "viewer")
+    second = issue_token("revoked@test.com", "viewer")
+
+    await revocations.revoke(read_token(first))
+    assert await verify_token(first) is None
+    assert await verify_token(second) is not None
+
+    await revocations.revoke_user("revoked@test.com")
+    assert await verify_token(second) is None
+    assert await verify_token(issue_token("revoked@test.com", "viewer")) is not None
+
+@pytest.mark.asyncio
+async def test_revocations_are_shared():
+    """Test revocations by one process apply in another once its cached lookups expire"""
+    clock = FakeClock()
+    other = RevocationList(cache=TTLCache(maxsize=100, ttl=5, clock=clock))
+    token = read_token(issue_token("shared@test.com", "viewer"))
+    assert not await other.is_revoked(token)
+
+    await revocations.revoke(token)
+    assert not await other.is_revoked(token)
+    clock.now = 6
+    assert await other.is_revoked(token)
+
+    user_token = read_token(issue_token("shared@test.com", "viewer"))
+    await revocations.revoke_user("shared@test.com")
+    clock.now = 12
+    assert await other.is_revoked(user_token)
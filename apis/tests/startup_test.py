@@ -0,0 +1,48 @@
+"""
+Test startup
+"""
+
+import sys
+import subprocess
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import config
+from app import registration
+from app.api import app
+from app.outbox import Outbox
+
+def test_import_is_lazy():
+    """Test importing the app doesn't create the boto3 resource"""
+    result = subprocess.run(
+        [sys.executable, '-c', "import sys, app.api; print('boto3' in sys.modules)"],
+        capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == 'False'
+
+def test_lifespan(mocker, tmp_path):
+    """Test the app initializes on startup and reports how long it took"""
+    mocker.patch.object(registration, 'outbox', Outbox(str(tmp_path / 'outbox.db'), None))
+    prewarm = mocker.patch('app.startup.prewarm_connections')
+
+    with TestClient(app) as client:
+        assert client.get('/').json() == {"test": "success"}
+        assert prewarm.call_count == 1
+        assert set(app.state.startup_report) == {
+            'tables_ms', 'prewarm_ms', 'outbox_ms', 'total_ms'
+        }
+        assert registration.outbox._tasks  # pylint: disable=protected-access
+
+    assert not registration.outbox._tasks  # pylint: disable=protected-access
+
+def test_lifespan_checks_session_secret(mocker):
+    """Test signed sessions refuse to start without a usable signing key"""
+    mocker.patch('app.session.SESSION_MODE', 'signed')
+    mocker.patch.object(config, 'SESSION_SECRET', 'short', create=True)
+    storage_start = mocker.patch('app.storage.storage.start')
+
+    with pytest.raises(ValueError):
+        with TestClient(app):
+            pass
+    assert not storage_start.called
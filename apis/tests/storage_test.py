@@ -0,0 +1,258 @@
+"""
+Test the storage backends against the same contract
+"""
+
+import time
+import uuid
+import sqlite3
+
+import pytest
+
+from app import config
+from app.storage import create_storage, RotationConflict, SessionMissing, CounterExhausted
+from app.storage_dynamodb import DynamoDBStorage
+from app.storage_sqlite import SQLiteStorage, _Transaction
+from app.storage_memory import MemoryStorage
+
+@pytest.fixture(params=['dynamodb', 'sqlite', 'memory'])
+def storage(request, tmp_path):
+    """Each backend, with the DynamoDB one on the mocked tables"""
+    if request.param == 'dynamodb':
+        backend = DynamoDBStorage()
+    elif request.param == 'sqlite':
+        backend = SQLiteStorage(str(tmp_path / 'auth.db'))
+    else:
+        backend = MemoryStorage()
+    backend.start()
+    yield backend
+    backend.close()
+
+def unique(prefix: str) -> str:
+    """Keys that don't collide with other tests sharing the DynamoDB tables"""
+    return f'{prefix}-{uuid.uuid4()}'
+
+def session_item(key: str, username: str, created_at: int, **attrs) -> dict:
+    """A session row"""
+    return {
+        "SessionKey": key,
+        "UserName": username,
+        "Active": True,
+        "LastModified": "now",
+        "CreatedAt": created_at,
+        "ExpiresAt": int(time.time()) + 60,
+        **attrs
+    }
+
+def test_create_storage():
+    """Test backends are chosen by name"""
+    assert isinstance(create_storage('memory'), MemoryStorage)
+    with pytest.raises(ValueError):
+        create_storage('mongodb')
+
+@pytest.mark.asyncio
+async def test_get_put_update(storage):
+    """Test items are written, merged and read back"""
+    username = unique('user')
+    assert await storage.users.get(username) == {}
+
+    await storage.users.put({"UserName": username, "AuthRole": "viewer"})
+    await storage.users.update(username, {"Valid": True})
+    assert await storage.users.get(username, consistent=True) == {
+        "UserName": username, "AuthRole": "viewer", "Valid": True
+    }
+
+    # Updating an item that doesn't exist creates it
+    access_key = unique('token')
+    await storage.tokens.update(access_key, {"UserName": username})
+    assert await storage.tokens.get(access_key) == {"AccessKey": access_key, "UserName": username}
+
+@pytest.mark.asyncio
+async def test_user_sessions(storage):
+    """Test a user's active sessions are listed newest first, counted and deleted"""
+    username = unique('user')
+    keys = [unique('session') for _ in range(4)]
+    await storage.sessions.put(session_item(keys[0], username, 1))
+    await storage.sessions.put(session_item(keys[1], username, 2))
+    await storage.sessions.put(session_item(keys[2], username, 3, Active=False))
+    await storage.sessions.put(session_item(keys[3], username, 4, ExpiresAt=int(time.time()) - 1))
+
+    sessions = await storage.sessions.list_for_user(username)
+    assert [session['SessionKey'] for session in sessions] == [keys[1], keys[0]]
+    assert await storage.sessions.count_for_user(username) == 2
+
+    await storage.sessions.delete_many(keys)
+    assert await storage.sessions.get(keys[0]) == {}
+    assert await storage.sessions.count_for_user(username) == 0
+
+@pytest.mark.asyncio
+async def test_rotate_session(storage):
+    """Test a rotation retires the previous session and moves the user to the new one"""
+    username = unique('user')
+    first, second = unique('session'), unique('session')
+    await storage.users.put({"UserName": username})
+
+    await storage.rotate_session(username, None, session_item(first, username, 1),
+                                 {"AuthKey": first})
+    await storage.rotate_session(username, first, session_item(second, username, 2),
+                                 {"AuthKey": second})
+
+    assert (await storage.users.get(username, consistent=True))['AuthKey'] == second
+    assert (await storage.sessions.get(first))['Active'] is False
+    assert (await storage.sessions.get(second))['Active'] is True
+
+    await storage.sessions.delete_many([first, second])
+
+@pytest.mark.asyncio
+async def test_rotate_session_conflicts(storage):
+    """Test a rotation from a stale session or a missing one changes nothing"""
+    username = unique('user')
+    current, stale, new = unique('session'), unique('session'), unique('session')
+    await storage.users.put({"UserName": username, "AuthKey": current})
+
+    with pytest.raises(RotationConflict):
+        await storage.rotate_session(username, stale, session_item(new, username, 1),
+                                     {"AuthKey": new})
+    assert await storage.sessions.get(new) == {}
+    assert (await storage.users.get(username, consistent=True))['AuthKey'] == current
+
+    # The user points at a session row that is gone
+    with pytest.raises(SessionMissing):
+        await storage.rotate_session(username, current, session_item(new, username, 1),
+                                     {"AuthKey": new})
+    assert await storage.sessions.get(new) == {}
+
+    await storage.rotate_session(username, current, session_item(new, username, 1),
+                                 {"AuthKey": new}, retire=False)
+    assert (await storage.users.get(username, consistent=True))['AuthKey'] == new
+
+    await storage.sessions.delete_many([new])
+
+@pytest.mark.asyncio
+async def test_sweep_expired(storage, mocker):
+    """Test expired tokens, sessions and revocations are deleted and current ones kept"""
+    expired, current = unique('token'), unique('token')
+    await storage.tokens.put({"AccessKey": expired, "ExpiresAt": int(time.time()) - 1})
+    await storage.tokens.put({"AccessKey": current, "ExpiresAt": int(time.time()) + 60})
+    # Revocations are only kept, and swept, in signed mode
+    mocker.patch.object(config, 'SESSION_MODE', 'signed', create=True)
+    revoked = unique('token')
+    await storage.revocations.put({"RevocationKey": revoked, "ExpiresAt": int(time.time()) - 1})
+
+    assert await storage.sweep_expired() >= 1
+    assert await storage.tokens.get(expired) == {}
+    assert await storage.tokens.get(current)
+    assert await storage.revocations.get(revoked) == {}
+
+@pytest.mark.asyncio
+async def test_scan_segments(storage):
+    """Test the segments of a scan together read every item once, with only the attributes asked"""
+    keys = {unique('rollup') for _ in range(30)}
+    for key in keys:
+        await storage.rollups.put({"RollupId": key, "Kept": 1, "Dropped": 2})
+
+    seen = []
+    for segment in range(3):
+        async for page in storage.rollups.scan(segment, 3, ["RollupId", "Kept"]):
+            seen += [item for item in page if item['RollupId'] in keys]
+
+    assert sorted(item['RollupId'] for item in seen) == sorted(keys)
+    assert all(set(item) == {"RollupId", "Kept"} for item in seen)
+
+@pytest.mark.asyncio
+async def test_query_pages(storage):
+    """Test a user's queries are written in a batch and read newest first a page at a time"""
+    username = unique('user')
+    queries = [{"QueryId": 1000 + i, "UserName": username, "CreatedAt": i // 2, "Query": f"q{i}"}
+               for i in range(5)]
+    await storage.queries.put_many(queries)
+
+    pages = []
+    after = None
+    while True:
+        page, more = await storage.queries.page_for_user(username, 2, after)
+        pages.append([query['QueryId'] for query in page])
+        if not more:
+            break
+        after = {"CreatedAt": page[-1]['CreatedAt'], "QueryId": page[-1]['QueryId']}
+
+    # Queries logged in the same millisecond are ordered by QueryId
+    assert pages == [[1004, 1003], [1002, 1001], [1000]]
+
+@pytest.mark.asyncio
+async def test_flags(storage):
+    """Test repeated flags are counted on one item, listed by status and resolved once"""
+    # Statuses of their own, so other tests' flags aren't listed
+    first, second = uuid.uuid4().int >> 65, uuid.uuid4().int >> 65
+    status = unique('open')
+
+    await storage.flagged_docs.flag(first, {"DocumentId": "a", "Status": status, "LastFlaggedAt": 1})
+    await storage.flagged_docs.flag(second, {"DocumentId": "b", "Status": status, "LastFlaggedAt": 2})
+    flag = await storage.flagged_docs.flag(first, {
+        "DocumentId": "a", "Status": status, "LastFlaggedAt": 3, "Reason": "spam"
+    })
+    assert flag["FlagCount"] == 2
+    assert flag["FirstFlaggedAt"] == 1
+    assert flag["Reason"] == "spam"
+
+    page, more = await storage.flagged_docs.page_by_status(status, 1)
+    assert [flag["FlaggedId"] for flag in page] == [first]
+    assert more
+    page, more = await storage.flagged_docs.page_by_status(
+        status, 1, {"LastFlaggedAt": page[0]["LastFlaggedAt"], "FlaggedId": page[0]["FlaggedId"]}
+    )
+    assert [flag["FlaggedId"] for flag in page] == [second]
+
+    # Only open flags are resolved
+    await storage.flagged_docs.update(second, {"Status": "open"})
+    assert await storage.flagged_docs.resolve_many([first, second], {"ResolvedBy": "mod"}) == [second]
+    assert await storage.flagged_docs.resolve_many([second], {"ResolvedBy": "mod"}) == []
+    assert (await storage.flagged_docs.get(second, consistent=True))["ResolvedBy"] == "mod"
+
+    # Flagging a resolved document opens it again
+    flag = await storage.flagged_docs.flag(second, {"DocumentId": "b", "Status": "open", "LastFlaggedAt": 4})
+    assert flag["FlagCount"] == 2
+    assert "ResolvedBy" not in flag
+
+def test_sqlite_adds_missing_columns(tmp_path):
+    """Test columns mirrored since a database was created are added and filled in"""
+    path = str(tmp_path / 'auth.db')
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE queries (key INTEGER PRIMARY KEY, item TEXT NOT NULL)')
+    db.execute("INSERT INTO queries VALUES (1, '{\"QueryId\":1,\"UserName\":\"u\",\"CreatedAt\":5}')")
+    db.commit()
+    db.close()
+
+    backend = SQLiteStorage(path)
+    backend.start()
+    assert backend.call(lambda db: db.execute(
+        'SELECT user_name, created_at FROM queries WHERE key = 1'
+    ).fetchone()) == ('u', 5)
+    backend.close()
+
+def test_sqlite_failed_commit_rolls_back():
+    """Test a transaction whose COMMIT fails doesn't stay open on the connection"""
+    db = sqlite3.connect(':memory:', isolation_level=None)
+    db.execute('PRAGMA foreign_keys=ON')
+    db.execute('CREATE TABLE parents (key INTEGER PRIMARY KEY)')
+    db.execute('CREATE TABLE children (key INTEGER PRIMARY KEY, parent INTEGER '
+               'REFERENCES parents (key) DEFERRABLE INITIALLY DEFERRED)')
+
+    # Deferred foreign keys are only checked by COMMIT
+    with pytest.raises(sqlite3.IntegrityError):
+        with _Transaction(db):
+            db.execute('INSERT INTO children VALUES (1, 1)')
+    assert not db.in_transaction
+
+    with _Transaction(db):
+        db.execute('INSERT INTO parents VALUES (1)')
+    assert db.execute('SELECT COUNT(*) FROM parents').fetchone() == (1,)
+
+@pytest.mark.asyncio
+async def test_counters(storage):
+    """Test counters are added to atomically up to a limit"""
+    name = unique('counter')
+    assert await storage.counters.add(name, 10, 100) == 10
+    assert await storage.counters.add(name, 10, 100) == 20
+    with pytest.raises(CounterExhausted):
+        await storage.counters.add(name, 90, 100)
+    assert await storage.counters.add(name, 80, 100) == 100
@@ -0,0 +1,87 @@
+"""
+Test unit_of_work
+"""
+
+import pytest
+
+from app import config
+from app.dynamodb_tables import get_users_table
+from app.unit_of_work import UserUnitOfWork, current_unit_of_work, update_expression
+from app.user import get_user, set_user_role, update_timestamp, write_user
+from app.storage import storage
+
+users_table = get_users_table(config.USERS_TABLE)
+
+def test_update_expression():
+    """Test update_expression"""
+    assert update_expression({"AuthRole": "viewer", "Valid": True}) == {
+        "UpdateExpression": "SET #a0 = :a0, #a1 = :a1",
+        "ExpressionAttributeNames": {"#a0": "AuthRole", "#a1": "Valid"},
+        "ExpressionAttributeValues": {":a0": "viewer", ":a1": True}
+    }
+
+@pytest.mark.asyncio
+async def test_unit_of_work():
+    """Test the identity map and the deferred writes"""
+    writes = []
+
+    async def write(username, attrs):
+        writes.append((username, attrs))
+
+    assert current_unit_of_work() is None
+    async with UserUnitOfWork(write) as unit_of_work:
+        assert current_unit_of_work() is unit_of_work
+        assert unit_of_work.get("user@test.com") is None
+
+        unit_of_work.load("user@test.com", {"UserName": "user@test.com"})
+        unit_of_work.stage("user@test.com", {"AuthRole": "viewer"})
+        unit_of_work.stage("user@test.com", {"Valid": True})
+
+        assert unit_of_work.get("user@test.com") == {
+            "UserName": "user@test.com",
+            "AuthRole": "viewer",
+            "Valid": True
+        }
+        assert not writes
+
+    assert current_unit_of_work() is None
+    assert writes == [("user@test.com", {"AuthRole": "viewer", "Valid": True})]
+
+@pytest.mark.asyncio
+async def test_unit_of_work_discards_on_error():
+    """Test nothing is written when the request fails"""
+    writes = []
+
+    async def write(username, attrs):
+        writes.append((username, attrs))
+
+    with pytest.raises(ValueError):
+        async with UserUnitOfWork(write) as unit_of_work:
+            unit_of_work.stage("user@test.com", {"AuthRole": "viewer"})
+            raise ValueError()
+
+    assert not writes
+
+@pytest.mark.asyncio
+async def test_user_reads_and_writes(mocker):
+    """Test each user is read once and written once per unit of work"""
+    users_table.put_item(Item={"UserName": "user@test.com", "AuthRole": "viewer"})
+    get_item = mocker.spy(storage.users, 'get')
+    update_item = mocker.spy(storage.users, 'update')
+
+    async with UserUnitOfWork(write_user):
+        await get_user("user@test.com")
+        await set_user_role("user@test.com", "editor")
+        await update_timestamp("user@test.com")
+        user = await get_user("user@test.com")
+        assert user.get('AuthRole') == "editor"
+        assert update_item.call_count == 0
+
+    assert get_item.call_count == 1
+    assert update_item.call_count == 1
+
+    item = users_table.get_item(Key={"UserName": "user@test.com"}).get('Item', {})
+    assert item.get('AuthRole') == "editor"
+    assert item.get('LastLogin') is not None
+
+    users_table.delete_item(Key={"UserName": "user@test.com"})
@@ -1,5 +1,6 @@
 """Tests for the user module"""
 
+import asyncio
 import hashlib
 
 import pytest
@@ -16,7 +17,12 @@ from app.user import get_user, \
                 set_user_auth, \
                 create_new_user, \
                 set_user_role, \
-                update_user_password
+                update_user_password, \
+                verify_password, \
+                rehash_password, \
+                PasswordHasher, \
+                HashingOverloaded, \
+                last_logins
 
 users_table = get_users_table(config.USERS_TABLE)
 
@@ -42,6 +48,44 @@ def test_compare_to_hash():
     password = 'testpass'
     pw_hash = hashlib.sha3_256(password.encode()).hexdigest()
     assert compare_to_hash(password, pw_hash)
+    assert not compare_to_hash('wrongpass', pw_hash)
+    assert not compare_to_hash(password, None)
+
+def test_password_hasher():
+    """Test hashes are salted and carry their cost settings"""
+    hasher = PasswordHasher(n=2 ** 10, r=8, p=1, workers=1, max_pending=1)
+    first = hasher.hash('testpass')
+    second = hasher.hash('testpass')
+
+    assert first != second
+    assert first.startswith('scrypt$1024$8$1$')
+    assert hasher.verify('testpass', first)
+    assert not hasher.verify('wrongpass', first)
+    assert not hasher.verify('testpass', 'scrypt$garbage')
+
+    assert not hasher.needs_rehash(first)
+    assert hasher.needs_rehash(hashlib.sha3_256(b'testpass').hexdigest())
+    # Raising the cost flags older hashes for a rehash, which still verify
+    stronger = PasswordHasher(n=2 ** 11, r=8, p=1, workers=1, max_pending=1)
+    assert stronger.needs_rehash(first)
+    assert stronger.verify('testpass', first)
+
+@pytest.mark.asyncio
+async def test_password_hasher_pool():
+    """Test hashing in the process pool and the queue depth limit"""
+    hasher = PasswordHasher(n=2 ** 10, r=8, p=1, workers=1, max_pending=1)
+    try:
+        pw_hash = await hasher.hash_async('testpass')
+        assert await hasher.verify_async('testpass', pw_hash)
+        assert not await hasher.verify_async('wrongpass', pw_hash)
+
+        with pytest.raises(HashingOverloaded):
+            await asyncio.gather(hasher.hash_async('first'), hasher.hash_async('second'))
+
+        # Workers don't fork the server process
+        assert hasher.pool._mp_context.get_start_method() in ('forkserver', 'spawn')  # pylint: disable=protected-access
+    finally:
+        hasher.shutdown()
 
 @pytest.fixture(autouse=True)
 def create_records():
@@ -61,29 +105,33 @@ def create_records():
 
     users_table.delete_item(Key={"UserName": username})
 
-def test_validate_auth_key():
+@pytest.mark.asyncio
+async def test_validate_auth_key():
     """Test validate_auth_key"""
     username = "test@gmail.com"
     auth_key = "abc123"
-    assert validate_auth_key(username) == auth_key
+    assert await validate_auth_key(username) == auth_key
 
-def test_create_new_user():
+@pytest.mark.asyncio
+async def test_create_new_user():
     """Test create_new_user"""
     username = "testuser@gmail.com"
     password = "P@ssw0rd"
-    assert create_new_user(username, password) is None
+    assert await create_new_user(username, password) is None
 
     response = users_table.get_item(Key={"UserName": username}).get('Item', {})
 
     assert response.get('UserName') == username
-    assert response.get('Password') == hashlib.sha3_256(password.encode()).hexdigest()
+    assert response.get('Password').startswith('scrypt$')
+    assert compare_to_hash(password, response.get('Password'))
     assert response.get('AuthKey') is None
     assert response.get('Active') is None
 
     # This user has a different name than the test fixture
     users_table.delete_item(Key={"UserName": username})
     
-def test_get_user():
+@pytest.mark.asyncio
+async def test_get_user():
     """Test get_user"""
     username = "test@gmail.com"
     password = "P@ssw0rd"
@@ -95,23 +143,45 @@ def test_get_user():
         "AuthRole": 'viewer',
         'UserName': 'test@gmail.com'
     }
-    assert get_user(username) == expected_result
+    assert await get_user(username) == expected_result
 
-def test_update_timestamp():
+@pytest.mark.asyncio
+async def test_update_timestamp():
     """Test update_timestamp"""
     username = "test@gmail.com"
 
     response = users_table.get_item(Key={"UserName": username}).get('Item', {})
     assert response.get('LastLogin') is None
 
-    response = update_timestamp(username)
-    response_status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    await update_timestamp(username)
 
-    assert response_status == 200
+    # The timestamp is buffered until the next flush
+    response = users_table.get_item(Key={"UserName": username}).get('Item', {})
+    assert response.get('LastLogin') is None
 
+    assert await last_logins.flush() == 1
     response = users_table.get_item(Key={"UserName": username}).get('Item', {})
     assert response.get('LastLogin') is not None
 
+@pytest.mark.asyncio
+async def test_last_login_recorded_during_flush(monkeypatch):
+    """Test a LastLogin recorded while a flush is writing isn't overwritten by the older one"""
+    first, second = "flush-a@test.com", "flush-b@test.com"
+    monkeypatch.setattr(last_logins, 'batch_size', 1)
+    last_logins.record(first, {"LastLogin": "1"})
+    last_logins.record(second, {"LastLogin": "1"})
+
+    # The second user logs in again while the first one is being written
+    flush = asyncio.ensure_future(last_logins.flush())
+    await asyncio.sleep(0)
+    last_logins.record(second, {"LastLogin": "2"})
+    assert await flush == 2
+
+    assert last_logins.pending == {second: {"LastLogin": "2"}}
+    assert await last_logins.flush() == 1
+    response = users_table.get_item(Key={"UserName": second}).get('Item', {})
+    assert response['LastLogin'] == "2"
+
 @pytest.mark.asyncio
 async def test_set_user_auth():
     """Test set_user_auth"""
@@ -121,9 +191,7 @@ async def test_set_user_auth():
     response = users_table.get_item(Key={"UserName": username}).get('Item', {})
     assert response.get('AuthKey') == 'abc123'
 
-    response =  await set_user_auth(username, auth_key)
-    response_status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
-    assert response_status == 200
+    await set_user_auth(username, auth_key)
 
     response = users_table.get_item(Key={"UserName": username}).get('Item', {})
     assert response.get('AuthKey') == 'xyz789'
@@ -137,9 +205,7 @@ async def test_set_user_role():
     response = users_table.get_item(Key={"UserName": username}).get('Item', {})
     assert response.get('AuthRole') == 'viewer'
 
-    response = await set_user_role(username, role)
-    response_status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
-    assert response_status == 200
+    await set_user_role(username, role)
 
     response = users_table.get_item(Key={"UserName": username}).get('Item', {})
     assert response.get('AuthRole') == 'editor'
@@ -153,9 +219,21 @@ async def test_update_user_password():
     response = users_table.get_item(Key={"UserName": username}).get('Item', {})
     assert response.get('Password') == hashlib.sha3_256("P@ssw0rd".encode()).hexdigest()
 
-    response = await update_user_password(username, password)
-    response_status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
-    assert response_status == 200
+    await update_user_password(username, password)
 
     response = users_table.get_item(Key={"UserName": username}).get('Item', {})
-    assert response.get('Password') == hashlib.sha3_256(password.encode()).hexdigest()
+    assert response.get('Password').startswith('scrypt$')
+    assert compare_to_hash(password, response.get('Password'))
+
+@pytest.mark.asyncio
+async def test_rehash_password():
+    """Test legacy hashes are upgraded after a successful login"""
+    username = "test@gmail.com"
+    legacy_hash = hashlib.sha3_256("P@ssw0rd".encode()).hexdigest()
+    assert await verify_password("P@ssw0rd", legacy_hash)
+
+    await rehash_password(username, "P@ssw0rd", legacy_hash)
+
+    pw_hash = (await get_user(username)).get('Password')
+    assert pw_hash.startswith('scrypt$')
+    assert await verify_password("P@ssw0rd", pw_hash)
@@ -2,13 +2,29 @@
 Test for util module
 """
 
-from app import config
+import json
+from decimal import Decimal
+
+import pytest
+from fastapi import HTTPException
 
-from app.util import http_response
+from app import config
+from app import util
+from app.util import http_response, encode_cursor, decode_cursor
 
 def test_http_response():
-    """Test hhtp_response"""
-    expected_result = {
+    """Test http_response serializes the body once, without the envelope"""
+    response = http_response(201, {"authKey": '12bc45ad367', "count": Decimal('3'),
+                                    "message": "Test success"})
+    assert response.status_code == 201
+    assert response.body == b'{"authKey":"12bc45ad367","count":3,"message":"Test success"}'
+    assert response.headers["content-type"] == "application/json"
+    assert response.headers["content-length"] == str(len(response.body))
+
+def test_http_response_envelope(mocker):
+    """Test the statusCode and headers fields are kept for older clients when configured"""
+    mocker.patch.object(util, 'RESPONSE_ENVELOPE', True)
+    assert json.loads(http_response(200, {"message": "Success!"}).body) == {
         "statusCode": 200,
         "message": "Success!",
         "headers": {
@@ -16,17 +32,19 @@ def test_http_response():
             "Access-Control-Allow-Origin": config.APP_ORIGIN
         }
     }
-    assert http_response(200, { "message": "Success!" }) == expected_result
 
-# Tests
-def test_http_response_with_data():
-    """Test """
-    assert http_response(200, {"authKey": '12bc45ad367', "message": "Test success"}) == {
-        "statusCode": 200,
-        "authKey": '12bc45ad367',
-        "message": "Test success",
-        "headers": {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": config.APP_ORIGIN
-        }
-    }
\ No newline at end of file
+def test_http_response_error():
+    """Test error statuses are raised for FastAPI to answer"""
+    with pytest.raises(HTTPException) as err:
+        http_response(403, {"message": "Forbidden"})
+    assert err.value.status_code == 403
+    assert err.value.detail == "Forbidden"
+
+def test_cursor():
+    """Test cursors round trip and bad ones are rejected"""
+    fields = ("CreatedAt", "QueryId")
+    cursor = encode_cursor({"CreatedAt": 1700000000000, "QueryId": 123, "Query": "q"}, fields)
+    assert decode_cursor(cursor, fields) == {"CreatedAt": 1700000000000, "QueryId": 123}
+    for bad in ("not a cursor", cursor[:-4], "e30=", encode_cursor({"A": 1}, ("A",))):
+        with pytest.raises(ValueError):
+            decode_cursor(bad, fields)
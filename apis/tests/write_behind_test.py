@@ -0,0 +1,81 @@
+"""
+Test the write-behind buffer
+"""
+
+import asyncio
+
+import pytest
+
+from app.write_behind import WriteBehindBuffer
+
+@pytest.mark.asyncio
+async def test_updates_are_coalesced():
+    """Test repeated updates to a key are written once with the latest values"""
+    writes = []
+
+    async def write(key, attrs):
+        writes.append((key, attrs))
+
+    buffer = WriteBehindBuffer(write, batch_size=2)
+    for i in range(3):
+        buffer.record("a@test.com", {"LastLogin": str(i)})
+    buffer.record("b@test.com", {"LastLogin": "0"})
+    buffer.record("c@test.com", {"LastLogin": "0"})
+    assert not writes
+
+    assert await buffer.flush() == 3
+    assert sorted(writes) == [
+        ("a@test.com", {"LastLogin": "2"}),
+        ("b@test.com", {"LastLogin": "0"}),
+        ("c@test.com", {"LastLogin": "0"})
+    ]
+    assert len(buffer) == 0
+
+@pytest.mark.asyncio
+async def test_take():
+    """Test a key taken by a caller isn't written by the buffer"""
+    writes = []
+
+    async def write(key, attrs):
+        writes.append((key, attrs))
+
+    buffer = WriteBehindBuffer(write)
+    buffer.record("a@test.com", {"LastLogin": "0"})
+    assert buffer.take("a@test.com") == {"LastLogin": "0"}
+    assert buffer.take("a@test.com") == {}
+
+    assert await buffer.flush() == 0
+    assert not writes
+
+@pytest.mark.asyncio
+async def test_failed_writes_are_kept():
+    """Test a failed write is retried without overwriting newer values"""
+    async def write(key, attrs):
+        # A newer value arrives while the write is in flight
+        buffer.record(key, {"LastLogin": "1"})
+        raise RuntimeError('throttled')
+
+    buffer = WriteBehindBuffer(write)
+    buffer.record("a@test.com", {"LastLogin": "0", "Valid": True})
+
+    assert await buffer.flush() == 0
+    assert buffer.take("a@test.com") == {"LastLogin": "1", "Valid": True}
+
+@pytest.mark.asyncio
+async def test_stop_flushes():
+    """Test the background flushes and the flush at shutdown"""
+    writes = []
+
+    async def write(key, attrs):
+        writes.append(key)
+
+    buffer = WriteBehindBuffer(write, interval=0.01)
+    await buffer.start()
+    buffer.record("a@test.com", {"LastLogin": "0"})
+    await asyncio.sleep(0.05)
+    assert writes == ["a@test.com"]
+
+    buffer.record("b@test.com", {"LastLogin": "0"})
+    buffer.interval = 60
+    await buffer.stop()
+    assert writes == ["a@test.com", "b@test.com"]
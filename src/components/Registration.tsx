@@ -71,7 +71,7 @@ const Registration = () => {
                     }
                 );
 
-                if (response?.status !== 200) {
+                if (response?.status !== 201) {
                     throw new Error(`Request failed with status ${response?.status}`);
                 }
 